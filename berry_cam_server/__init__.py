@@ -73,6 +73,25 @@ def create_app(test_config=None):
     # Check if upload dir exists and is writable
     check_upload_dir(app)
 
+    Config.open_camera_states(
+        app.config.get("CAMERA_STATE_FILE", os.path.join(app.config["UPLOAD_DIR"], 'camera_state.sqlite')),
+        app.config.get("CAMERA_STATE_FLUSH_INTERVAL", 10))
+
+    from .common import events, layout, metrics, near_duplicates, picture_index, recompression, retention, sprites, \
+        storage, thumbnails, timing
+    storage.init_app(app)
+    picture_index.init_app(app)
+    thumbnails.init_app(app)
+    sprites.init_app(app)
+    retention.init_app(app)
+    near_duplicates.init_app(app)
+    recompression.init_app(app)
+    events.init_app(app)
+    metrics.init_app(app)
+    # Before the blueprints, so that their request hooks are measured as well
+    timing.init_app(app)
+    app.cli.add_command(layout.shard_uploads_command)
+
     # Api initialisation
     from .api import blueprint as api
     app.register_blueprint(api)
@@ -89,4 +108,9 @@ def create_app(test_config=None):
     app.register_blueprint(viewer.bp)
     app.add_url_rule('/', endpoint='index')
 
+    # Previews that were still queued when the server stopped
+    from .api.picture import queue_pending_previews
+    with app.app_context():
+        queue_pending_previews()
+
     return app
@@ -1,12 +1,22 @@
+from http import HTTPStatus
+
+from flask import current_app, request
 from flask_restx import Resource, Namespace
 
 from berry_cam_server import auth, Config
+from berry_cam_server.common.camera_state import settings_version
 
 api = Namespace('camera', description='Api endpoints to send camera infos to the server and fetch configurations.')
 
 camera_name_parser = auth.api_key_parser.copy()
 camera_name_parser.add_argument('name', type=str, help="The name of the camera.", required=True)
 
+camera_poll_parser = camera_name_parser.copy()
+camera_poll_parser.add_argument('version', type=str,
+                                help="The settings version known to the camera. Can also be sent as If-None-Match.")
+camera_poll_parser.add_argument('wait', type=float, default=0,
+                                help="Seconds to wait for a change of the settings if the version is still current.")
+
 camera_enabled_parser = camera_name_parser.copy()
 camera_enabled_parser.add_argument('enabled', type=str, help="If the camera is enabled or not", required=True)
 
@@ -19,20 +29,37 @@ class Camera(Resource):
     """
     ALIVE_QUEUE = None
 
-    @api.doc(responses={200: 'OK', 403: 'On invalid API key'})
+    @api.doc(responses={200: 'OK',
+                        304: 'If the settings did not change compared to the given version',
+                        403: 'On invalid API key'})
     @auth.api_key_required
-    @api.expect(camera_name_parser)
+    @api.expect(camera_poll_parser)
     def get(self):
+        """
+        Returns the state of the camera. If the settings version known to the camera is sent, the request blocks
+        until the settings change or the wait time expires, so changes done by the user reach the camera directly.
+
+        :return: The camera state together with the version of its settings
+        :rtype: dict
+        """
         # This will also check that mandatory file key is available in arguments and stop execution if not.
-        args = camera_name_parser.parse_args()
+        args = camera_poll_parser.parse_args()
+
+        version = args.version or next(iter(request.if_none_match), None)
+        wait = min(max(args.wait, 0), current_app.config.get("CAMERA_LONG_POLL_TIMEOUT", 60))
+        if version and wait:
+            camera = Config.wait_for_camera_change(args.name, version, wait)
+        else:
+            camera = Config.get_camera(args.name)
 
-        cameras = Config.get_connected_cameras()
-        if args.name in cameras:
-            return cameras[args.name]
+        current_version = settings_version(camera)
+        headers = {"ETag": '"{}"'.format(current_version)}
+        if current_version == version:
+            return None, HTTPStatus.NOT_MODIFIED, headers
 
-        return {
-            "enabled": False
-        }
+        camera = camera or {"enabled": False}
+        camera["version"] = current_version
+        return camera, HTTPStatus.OK, headers
 
     @api.doc(responses={200: 'OK', 403: 'On invalid API key'})
     @auth.api_key_required
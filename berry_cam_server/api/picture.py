@@ -1,19 +1,390 @@
+import hashlib
+import json
+import logging
 import os
+import secrets
+import shutil
+import tempfile
+import time
+from contextlib import closing
 from datetime import datetime, timezone
 from http import HTTPStatus
 
 from PIL import Image
-from flask import current_app
-from flask_restx import Resource, Namespace, abort
+from flask import current_app, g, request
+from flask_restx import Resource, Namespace, abort, reqparse
 from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import secure_filename
 
-from berry_cam_server import auth
+from berry_cam_server import auth, Config
+from berry_cam_server.common.config_writer import file_lock
+from berry_cam_server.common.layout import picture_file
+from berry_cam_server.common.metrics import INGESTED_BYTES, OTHER_CAMERA, UPLOAD_COLLISIONS, UPLOAD_DURATION
+from berry_cam_server.common.near_duplicates import DROP
+from berry_cam_server.common.picture_index import get_picture_index, PREVIEW_STORING, PREVIEW_PENDING, PREVIEW_DONE, \
+    PREVIEW_FAILED
+from berry_cam_server.common.storage import get_storage
+from berry_cam_server.common.thumbnails import PREVIEW_SIZE, preview_file
+from berry_cam_server.common.timing import span
+
+LOG = logging.getLogger(__name__)
 
 api = Namespace('picture', description='Api endpoints to interact with the pictures stored in the server.')
 
+# The supported image types with the extension used for the raw images
+CONTENT_TYPES = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg'
+}
+
 upload_parser = auth.api_key_parser.copy()
 upload_parser.add_argument('file', location='files',
                            type=FileStorage, help="The picture to upload.", required=True)
+upload_parser.add_argument('camera', type=str, help="The name of the camera that took the picture.")
+
+batch_upload_parser = auth.api_key_parser.copy()
+batch_upload_parser.add_argument('file', location='files', action='append',
+                                 type=FileStorage, help="The pictures to upload.", required=True)
+batch_upload_parser.add_argument('camera', type=str, help="The name of the camera that took the pictures.")
+
+upload_session_parser = auth.api_key_parser.copy()
+upload_session_parser.add_argument('content_type', type=str, help="The type of the picture to upload.",
+                                   required=True)
+upload_session_parser.add_argument('camera', type=str, help="The name of the camera that took the picture.")
+
+chunk_parser = reqparse.RequestParser()
+chunk_parser.add_argument('offset', type=int, location='args', required=True,
+                          help="The position in the picture where the chunk given as request body starts.")
+
+# The maximum amount of pictures per camera in the same hundredth of a second
+MAX_SEQUENCE = 1000
+
+# Size of the blocks used to copy uploaded data
+COPY_BLOCK_SIZE = 64 * 1024
+
+# The endings of the files of upload sessions in the staging directory: the session info, the uploaded data and
+# the lock of the uploaded data
+UPLOAD_SESSION_FILES = ('.json', '.part', '.part.lock')
+
+
+def _check_content_type(content_type):
+    """
+    Aborts the request if the given content type is not supported.
+
+    :param str content_type: The content type of an uploaded picture.
+    :return: The extension to use for the raw image.
+    :rtype: str
+    """
+    if content_type not in CONTENT_TYPES:
+        abort(HTTPStatus.BAD_REQUEST,
+              "Invalid file type given. Only images allowed. Given file type: {}".format(content_type))
+
+    return CONTENT_TYPES[content_type]
+
+
+def _create_raw_image(extension, camera):
+    """
+    Creates a new, empty raw image file in the staging directory. The picture name consists of the current utc
+    unix timestamp in hundredths of a second, the camera name and a sequence number that is increased for each
+    picture of the camera in the same hundredth of a second.
+    Aborts the request if there is no free sequence number left.
+
+    :param str extension: The extension of the raw image.
+    :param str camera: The camera that took the picture. Might be None.
+    :return: The picture name, the timestamp, the file name and the opened file of the new raw image.
+    :rtype: tuple
+    """
+    timestamp = datetime.now(timezone.utc).timestamp()
+    prefix = "{}-{}".format(int(timestamp * 100), secure_filename(camera or "") or "unknown")
+    staging_dir = _staging_dir()
+    storage = get_storage()
+
+    for sequence in range(MAX_SEQUENCE):
+        name = "{}-{:03d}".format(prefix, sequence)
+        raw_image = os.path.join(staging_dir, "{}.{}".format(name, extension))
+
+        # Exclusive creation, so that parallel uploads can't write to the same file. Names have to be unique
+        # also across the extensions, so a file claimed by another upload with a different extension is a collision.
+        # Stored pictures are checked after claiming the name, as staged files are moved to the storage atomically
+        # or only removed after they are stored. Duplicates are only stored in the picture index.
+        try:
+            raw_file = open(raw_image, 'xb')
+        except FileExistsError:
+            continue
+
+        if any(os.path.exists(os.path.join(staging_dir, "{}.{}".format(name, other)))
+               for other in CONTENT_TYPES.values() if other != extension) \
+                or any(storage.exists(picture_file('raw', name, other)) for other in CONTENT_TYPES.values()) \
+                or get_picture_index().get(name) is not None:
+            raw_file.close()
+            os.remove(raw_image)
+            continue
+
+        return name, timestamp, raw_image, raw_file
+
+    UPLOAD_COLLISIONS.inc()
+    abort(HTTPStatus.TOO_MANY_REQUESTS, "Please don't spam the server and reduce image upload frequency.")
+
+
+def _file_hash(file):
+    """
+    :param str file: The file to hash.
+    :return: The sha256 hash of the file content.
+    :rtype: str
+    """
+    content_hash = hashlib.sha256()
+    with open(file, 'rb') as data:
+        for block in iter(lambda: data.read(COPY_BLOCK_SIZE), b''):
+            content_hash.update(block)
+
+    return content_hash.hexdigest()
+
+
+def _picture_info(name, timestamp, extension, raw_image, camera, content_hash):
+    """
+    Reads the picture information of a completely uploaded raw image for the picture index.
+    Aborts the request if the raw image is not a valid image.
+
+    :param str name: The name of the picture.
+    :param float timestamp: The upload timestamp.
+    :param str extension: The extension of the raw image.
+    :param str raw_image: The raw image file.
+    :param str camera: The camera that took the picture. Might be None.
+    :param str content_hash: The sha256 hash of the raw image.
+    :return: The picture information for PictureIndex.add_deduplicated.
+    :rtype: dict
+    """
+    # Only reads the image header, decoding is done while creating the preview
+    try:
+        with span('pillow'), Image.open(raw_image) as image:
+            width, height = image.size
+    except IOError:
+        os.remove(raw_image)
+        abort(HTTPStatus.BAD_REQUEST, "Invalid image given, could not read image data.")
+
+    return {
+        "name": name,
+        "timestamp": timestamp,
+        "raw_extension": extension,
+        "raw_size": os.path.getsize(raw_image),
+        "width": width,
+        "height": height,
+        "camera": camera,
+        "user": g.api_user,
+        "preview_status": PREVIEW_STORING,
+        "content_hash": content_hash
+    }
+
+
+def _store_picture(name, timestamp, extension, raw_image):
+    """
+    Moves the staged raw image of an indexed picture to the storage and queues the creation of its previews.
+    The raw image is stored before the upload is answered, only then duplicates can reference the picture.
+    Previews are created from local files, if the storage
+    doesn't store files locally, a copy of the raw image is kept in the staging directory until the previews are
+    created and moved to the storage.
+    Once the previews exist, the picture is checked for being a near duplicate of the previous frame. Unless it is
+    dropped as near duplicate, the default preview is added to the sprite sheets and the picture is published to the
+    live feeds of the viewer.
+
+    :param str name: The name of the picture.
+    :param float timestamp: The upload timestamp.
+    :param str extension: The extension of the raw image.
+    :param str raw_image: The staged raw image file.
+    """
+    storage = get_storage()
+    raw_key = picture_file('raw', name, extension)
+
+    previews_dir = storage.local_path('previews')
+    if previews_dir is not None:
+        storage.put_file(raw_key, raw_image)
+        raw_image = storage.local_path(raw_key)
+        work_dir = None
+    else:
+        work_dir = previews_dir = tempfile.mkdtemp(prefix=name, dir=_staging_dir())
+        try:
+            work_raw_image = os.path.join(work_dir, os.path.basename(raw_image))
+            os.replace(raw_image, work_raw_image)
+            raw_image = work_raw_image
+            with open(raw_image, 'rb') as stream:
+                storage.save(raw_key, stream)
+        except Exception:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+
+    get_picture_index().update_blob(name, preview_status=PREVIEW_PENDING)
+    _queue_previews(name, timestamp, raw_image, previews_dir, work_dir)
+
+
+def _queue_previews(name, timestamp, raw_image, previews_dir, work_dir):
+    """
+    Queues the creation of the previews of a stored picture, see _store_picture.
+
+    :param str name: The name of the picture blob.
+    :param float timestamp: The upload timestamp.
+    :param str raw_image: The local raw image file.
+    :param str previews_dir: The directory to create the previews in.
+    :param str work_dir: The staging directory of a storage that doesn't store files locally or None. Removed once the
+                         previews are moved to the storage.
+    """
+    index = get_picture_index()
+    storage = get_storage()
+    sprites = current_app.extensions['sprites']
+    near_duplicates = current_app.extensions['near_duplicates']
+    picture_events = current_app.extensions['picture_events']
+
+    def previews_created(preview_sizes, error):
+        preview_image = preview_file(previews_dir, name, PREVIEW_SIZE)
+        frame_hash = None
+        if not error and near_duplicates.enabled:
+            with span('pillow'):
+                frame_hash = near_duplicates.hash_preview(preview_image)
+
+        try:
+            if work_dir is not None:
+                for size in preview_sizes or ():
+                    storage.put_file(preview_file('previews', name, size), preview_file(work_dir, name, size))
+
+            # Also updates the duplicates uploaded while the previews were created
+            if error:
+                index.update_blob(name, preview_status=PREVIEW_FAILED)
+            else:
+                index.update_blob(name, preview_status=PREVIEW_DONE, preview_size=preview_sizes[PREVIEW_SIZE])
+
+            # Dropped pictures must not get a sprite sheet cell, cells are never reused
+            if frame_hash is not None and near_duplicates.check(name, frame_hash) \
+                    and near_duplicates.action == DROP:
+                return
+
+            if not error and sprites is not None:
+                with span('pillow'):
+                    sprites.add(name, timestamp, preview_image)
+        finally:
+            if work_dir is not None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        picture_events.publish({"name": name})
+
+    current_app.extensions['thumbnails'].submit(raw_image, previews_dir, name, previews_created)
+
+
+def queue_pending_previews():
+    """
+    Queues the creation of all previews that are still pending, e.g. since the server stopped while they were queued.
+    Runs when the server starts. If several server processes start at the same time, the previews may be created
+    more than once, which is harmless.
+    Pictures whose raw image was being stored are queued if the raw image exists. Otherwise they are removed from
+    the index once they are older than STORING_TIMEOUT seconds (default one hour), as their upload failed.
+    """
+    storage = get_storage()
+    index = get_picture_index()
+    abandoned = time.time() - current_app.config.get("STORING_TIMEOUT", 60 * 60)
+    for picture in index.pending_previews():
+        name = picture["name"]
+        raw_key = picture_file('raw', name, picture["raw_extension"])
+        previews_dir = storage.local_path('previews')
+        work_dir = None
+
+        if picture["preview_status"] == PREVIEW_STORING:
+            if not storage.exists(raw_key):
+                if picture["timestamp"] < abandoned:
+                    LOG.warning("Removing picture %s, its raw image was never stored", name)
+                    index.remove([name])
+                continue
+
+            index.update_blob(name, preview_status=PREVIEW_PENDING)
+
+        try:
+            if previews_dir is not None:
+                raw_image = storage.local_path(raw_key)
+                if not os.path.exists(raw_image):
+                    raise FileNotFoundError(raw_image)
+            else:
+                work_dir = previews_dir = tempfile.mkdtemp(prefix=name, dir=_staging_dir())
+                raw_image = os.path.join(work_dir, os.path.basename(raw_key))
+                with closing(storage.open(raw_key)) as stream, open(raw_image, 'wb') as raw_file:
+                    shutil.copyfileobj(stream, raw_file)
+        except FileNotFoundError:
+            LOG.warning("Raw image of picture %s with pending previews is missing", name)
+            get_picture_index().update_blob(name, preview_status=PREVIEW_FAILED)
+            if work_dir is not None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            continue
+
+        LOG.info("Queueing pending previews of picture %s", name)
+        _queue_previews(name, picture["timestamp"], raw_image, previews_dir, work_dir)
+
+
+def _add_pictures(pictures):
+    """
+    Adds uploaded pictures to the picture index. Pictures with new content are moved to the storage and their
+    previews are queued, the staged raw images of duplicates are removed and the duplicates are published directly
+    to the live feeds of the viewer.
+    If a raw image can't be stored, the pictures that are not stored yet are removed from the index and the error is
+    raised, so that uploading them again stores them.
+
+    :param list pictures: The picture information from _picture_info and the staged raw image of each picture.
+    """
+    index = get_picture_index()
+    new_pictures = {picture["name"] for picture in index.add_deduplicated([picture for picture, _ in pictures])}
+
+    for position, (picture, raw_image) in enumerate(pictures):
+        # Only cameras known to the server get their own label
+        known_camera = picture["camera"] is not None and Config.get_camera(picture["camera"]) is not None
+        INGESTED_BYTES.labels(picture["camera"] if known_camera else OTHER_CAMERA).inc(picture["raw_size"])
+        if picture["name"] not in new_pictures:
+            os.remove(raw_image)
+            current_app.extensions['picture_events'].publish({"name": picture["name"]})
+            continue
+
+        try:
+            _store_picture(picture["name"], picture["timestamp"], picture["raw_extension"], raw_image)
+        except Exception:
+            remaining = pictures[position:]
+            index.remove([other["name"] for other, _ in remaining if other["name"] in new_pictures])
+            for _, other_raw_image in remaining:
+                if os.path.exists(other_raw_image):
+                    os.remove(other_raw_image)
+            raise
+
+
+def _ingest(name, timestamp, extension, raw_image, camera, content_hash):
+    """
+    Adds a completely uploaded raw image to the picture index and the storage and queues the creation of its previews.
+    Aborts the request if the raw image is not a valid image.
+
+    :param str name: The name of the picture.
+    :param float timestamp: The upload timestamp.
+    :param str extension: The extension of the raw image.
+    :param str raw_image: The staged raw image file.
+    :param str camera: The camera that took the picture. Might be None.
+    :param str content_hash: The sha256 hash of the raw image.
+    """
+    _add_pictures([(_picture_info(name, timestamp, extension, raw_image, camera, content_hash), raw_image)])
+
+
+def _save_upload(upload, camera):
+    """
+    Stores an uploaded file as new raw image. The file is hashed while it is written.
+
+    :param FileStorage upload: The uploaded file.
+    :param str camera: The camera that took the picture. Might be None.
+    :return: The picture name, the timestamp, the extension, the staged file and the sha256 hash of the new raw image.
+    :rtype: tuple
+    """
+    extension = _check_content_type(upload.content_type)
+    name, timestamp, raw_image, raw_file = _create_raw_image(extension, camera)
+
+    content_hash = hashlib.sha256()
+    with UPLOAD_DURATION.labels('save').time(), span('save'), raw_file:
+        for block in iter(lambda: upload.stream.read(COPY_BLOCK_SIZE), b''):
+            content_hash.update(block)
+            raw_file.write(block)
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+
+    return name, timestamp, extension, raw_image, content_hash.hexdigest()
 
 
 @api.route('/')
@@ -26,14 +397,13 @@ class Pictures(Resource):
     @api.doc(responses={200: 'Success',
                         400: 'Invalid file types',
                         429: 'On too many requests',
-                        403: 'On invalid API key',
-                        500: 'On errors while creating thumbnails.'})
+                        403: 'On invalid API key'})
     @auth.api_key_required
     @api.expect(upload_parser)
     def post(self):
         """
-        Will store the given image with current utc unix timestamp as file name.
-        Maximum one request per second allowed.
+        Will store the given image, named by current utc unix timestamp, camera and a sequence number.
+        The preview image is created in the background, see preview_status of the picture.
 
         :return: "Success" on success
         :rtype: str
@@ -41,26 +411,271 @@ class Pictures(Resource):
         # This will also check that mandatory file key is available in arguments and stop execution if not.
         args = upload_parser.parse_args()
 
-        if args.file.content_type not in ['image/png', 'image/jpeg']:
-            abort(HTTPStatus.BAD_REQUEST,
-                  "Invalid file type given. Only images allowed. Given file type: {}".format(args.file.content_type))
+        with UPLOAD_DURATION.labels('total').time():
+            name, timestamp, extension, raw_image, content_hash = _save_upload(args.file, args.camera)
+            _ingest(name, timestamp, extension, raw_image, args.camera, content_hash)
+
+        return "Success"
 
-        filename = int(datetime.now(timezone.utc).timestamp() * 100)
-        extension = 'png' if args.file.content_type == 'image/png' else 'jpg'
-        raw_image = os.path.join(current_app.config["UPLOAD_DIR"], "raw", "{}.{}".format(filename, extension))
 
-        if os.path.exists(raw_image):
-            abort(HTTPStatus.TOO_MANY_REQUESTS, "Please don't spam the server and reduce image upload frequency.")
+@api.route('/batch')
+@api.expect(auth.api_key_parser)
+class PictureBatch(Resource):
+    """
+    Handler class to upload many pictures with a single request, e.g. pictures that were buffered by a camera
+    while it was offline.
+    """
 
-        args.file.save(raw_image)
+    @api.doc(responses={200: 'Success, see the results for the state of each picture',
+                        403: 'On invalid API key'})
+    @auth.api_key_required
+    @api.expect(batch_upload_parser)
+    def post(self):
+        """
+        Will store all given images, like single uploads.
+        The preview images are created in the background, see preview_status of the pictures.
+
+        :return: The result of each uploaded file, in upload order.
+        :rtype: dict
+        """
+        args = batch_upload_parser.parse_args()
+
+        results = []
+        pictures = []
+        for upload in args.file:
+            try:
+                name, timestamp, extension, raw_image, content_hash = _save_upload(upload, args.camera)
+                pictures.append((_picture_info(name, timestamp, extension, raw_image, args.camera, content_hash),
+                                 raw_image))
+                results.append({"file": upload.filename, "status": HTTPStatus.OK, "name": name})
+            except HTTPException as error:
+                results.append({"file": upload.filename,
+                                "status": error.code,
+                                "message": getattr(error, 'data', {}).get('message', error.description)})
+
+        _add_pictures(pictures)
+
+        return {"results": results}
+
+
+def _staging_dir():
+    """
+    :return: The directory that contains the data of running resumable uploads and of not yet stored pictures.
+    :rtype: str
+    """
+    staging_dir = os.path.join(current_app.config["UPLOAD_DIR"], "staging")
+    os.makedirs(staging_dir, exist_ok=True)
+    return staging_dir
+
+
+def _remove_expired_upload_sessions():
+    """
+    Removes all upload sessions that were not modified for longer than the upload session timeout.
+    Only the files of upload sessions are removed, pictures that are staged for other reasons are kept.
+    """
+    expired = time.time() - current_app.config.get("UPLOAD_SESSION_TIMEOUT", 24 * 60 * 60)
+    staging_dir = _staging_dir()
+    for file_name in os.listdir(staging_dir):
+        if not file_name.endswith(UPLOAD_SESSION_FILES):
+            continue
 
         try:
-            with Image.open(args.file.stream) as thumbnail:
-                thumbnail.thumbnail((128, 128))
-                thumbnail.save(
-                    os.path.join(current_app.config["UPLOAD_DIR"], "previews", "{}.jpg".format(filename)), "JPEG")
-        except IOError:
-            os.remove(raw_image)
-            abort(HTTPStatus.INTERNAL_SERVER_ERROR, "Could not create thumbnail")
+            if os.path.getmtime(os.path.join(staging_dir, file_name)) < expired:
+                os.remove(os.path.join(staging_dir, file_name))
+        except OSError:
+            # Removed in parallel
+            continue
+
+
+def _load_upload_session(upload_id):
+    """
+    Loads an upload session of the current api user. Aborts the request if the session doesn't exist.
+
+    :param str upload_id: The id of the upload session.
+    :return: The session info and the file that contains the uploaded data.
+    :rtype: tuple
+    """
+    session_file = os.path.join(_staging_dir(), "{}.json".format(upload_id))
+    data_file = os.path.join(_staging_dir(), "{}.part".format(upload_id))
+
+    upload_session = None
+    if upload_id.isalnum():
+        try:
+            with open(session_file) as session:
+                upload_session = json.load(session)
+        except (OSError, ValueError):
+            pass
+
+    if not upload_session or upload_session["user"] != g.api_user:
+        abort(HTTPStatus.NOT_FOUND, "Unknown upload session {}".format(upload_id))
+
+    upload_session["upload_id"] = upload_id
+    return upload_session, data_file
+
+
+def _remove_upload_session(upload_id):
+    """
+    Removes all files of an upload session.
+
+    :param str upload_id: The id of the upload session.
+    """
+    for extension in ("part", "part.lock", "json"):
+        try:
+            os.remove(os.path.join(_staging_dir(), "{}.{}".format(upload_id, extension)))
+        except FileNotFoundError:
+            pass
+
+
+@api.route('/uploads/')
+@api.expect(auth.api_key_parser)
+class UploadSessions(Resource):
+    """
+    Handler class for resumable uploads. Pictures are uploaded in chunks, so that interrupted uploads
+    only need to send the missing data. Flow: create an upload session, send the chunks with their offsets,
+    commit the session.
+    """
+
+    @api.doc(responses={200: 'Success',
+                        400: 'Invalid file types',
+                        403: 'On invalid API key'})
+    @auth.api_key_required
+    @api.expect(upload_session_parser)
+    def post(self):
+        """
+        Creates a new upload session.
+
+        :return: The upload id and the current offset of the upload.
+        :rtype: dict
+        """
+        args = upload_session_parser.parse_args()
+        _check_content_type(args.content_type)
+
+        _remove_expired_upload_sessions()
+
+        upload_id = secrets.token_hex(16)
+        open(os.path.join(_staging_dir(), "{}.part".format(upload_id)), 'xb').close()
+        with open(os.path.join(_staging_dir(), "{}.json".format(upload_id)), 'x') as session:
+            json.dump({"content_type": args.content_type, "camera": args.camera, "user": g.api_user}, session)
+
+        return {"upload_id": upload_id, "offset": 0}
+
+
+@api.route('/uploads/<string:upload_id>')
+@api.expect(auth.api_key_parser)
+class UploadSession(Resource):
+    """
+    Handler class for a single resumable upload.
+    """
+
+    @api.doc(responses={200: 'Success',
+                        403: 'On invalid API key',
+                        404: 'On unknown upload session'})
+    @auth.api_key_required
+    def get(self, upload_id):
+        """
+        Returns the current offset of an upload, e.g. to continue an interrupted upload.
+
+        :param str upload_id: The id of the upload session.
+        :return: The upload id and the current offset of the upload.
+        :rtype: dict
+        """
+        _, data_file = _load_upload_session(upload_id)
+        return {"upload_id": upload_id, "offset": os.path.getsize(data_file)}
+
+    @api.doc(responses={200: 'Success',
+                        403: 'On invalid API key',
+                        404: 'On unknown upload session',
+                        409: 'If the offset does not match the current offset of the upload',
+                        413: 'If the picture is too large'})
+    @auth.api_key_required
+    @api.expect(chunk_parser)
+    def put(self, upload_id):
+        """
+        Appends the request body to the upload. The offset has to match the amount of data uploaded so far.
+
+        :param str upload_id: The id of the upload session.
+        :return: The upload id and the new offset of the upload.
+        :rtype: dict
+        """
+        args = chunk_parser.parse_args()
+        _, data_file = _load_upload_session(upload_id)
+        max_size = current_app.config.get("MAX_PICTURE_SIZE", 64 * 1024 * 1024)
+
+        with span('save'), file_lock(data_file + '.lock'), open(data_file, 'ab') as data:
+            offset = os.fstat(data.fileno()).st_size
+            if args.offset != offset:
+                abort(HTTPStatus.CONFLICT, "Invalid offset, current offset is {}".format(offset), offset=offset)
+
+            while True:
+                block = request.stream.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+
+                offset += len(block)
+                if offset > max_size:
+                    abort(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Picture is too large")
+
+                data.write(block)
+
+            data.flush()
+            os.fsync(data.fileno())
+
+        return {"upload_id": upload_id, "offset": offset}
+
+    @api.doc(responses={200: 'Success',
+                        403: 'On invalid API key',
+                        404: 'On unknown upload session'})
+    @auth.api_key_required
+    def delete(self, upload_id):
+        """
+        Aborts an upload and removes all uploaded data.
+
+        :param str upload_id: The id of the upload session.
+        :return: "Success" on success
+        :rtype: str
+        """
+        _load_upload_session(upload_id)
+        _remove_upload_session(upload_id)
+        return "Success"
+
+
+@api.route('/uploads/<string:upload_id>/commit')
+@api.expect(auth.api_key_parser)
+class UploadCommit(Resource):
+    """
+    Handler class to finish resumable uploads.
+    """
+
+    @api.doc(responses={200: 'Success',
+                        400: 'Invalid image',
+                        403: 'On invalid API key',
+                        404: 'On unknown upload session',
+                        429: 'On too many requests'})
+    @auth.api_key_required
+    def post(self, upload_id):
+        """
+        Finishes an upload. The uploaded data is moved to the pictures and the upload session is removed.
+        The preview image is created in the background, see preview_status of the picture.
+
+        :param str upload_id: The id of the upload session.
+        :return: "Success" on success
+        :rtype: str
+        """
+        upload_session, data_file = _load_upload_session(upload_id)
+        extension = CONTENT_TYPES[upload_session["content_type"]]
+
+        name, timestamp, raw_image, raw_file = _create_raw_image(extension, upload_session["camera"])
+        raw_file.close()
+
+        with file_lock(data_file + '.lock'):
+            if not os.path.exists(data_file):
+                # Committed in parallel
+                os.remove(raw_image)
+                abort(HTTPStatus.NOT_FOUND, "Unknown upload session {}".format(upload_id))
+
+            os.replace(data_file, raw_image)
+            _remove_upload_session(upload_id)
+
+        _ingest(name, timestamp, extension, raw_image, upload_session["camera"], _file_hash(raw_image))
 
         return "Success"
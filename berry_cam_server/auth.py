@@ -7,6 +7,7 @@ from flask import Blueprint, flash, redirect, url_for, render_template, request,
 from flask_restx import abort, reqparse
 
 from .common.conf import Config
+from .common.timing import span
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -57,13 +58,14 @@ def load_logged_in_user():
     Initialisation of user info session.
     Called for each request and initializing global information for current user.
     """
-    username = session.get('username')
+    with span('auth'):
+        username = session.get('username')
 
-    if not username:
-        g.user = None
-    else:
-        g.user = Config.get_user_config(username)
-        g.user["username"] = username
+        if not username:
+            g.user = None
+        else:
+            g.user = Config.get_user_config(username)
+            g.user["username"] = username
 
 
 def login_required(view):
@@ -90,6 +92,7 @@ def api_key_required(func):
     """
     Will check for api_key entry in REST api. If api key is missing, it will abort the call and display
     a proper message. Same also if the api key is invalid.
+    On success, the user owning the api key is stored as g.api_user.
 
     :param function func: The REST function to check
     :return: Either an http response containing information that the api key is missing or the function result.
@@ -97,11 +100,13 @@ def api_key_required(func):
     """
     @functools.wraps(func)
     def wrapped_command(*args, **kwargs):
-        # This will also check that mandatory api key is available in arguments and stop execution if not.
-        custom_args = api_key_parser.parse_args()
+        with span('auth'):
+            # This will also check that mandatory api key is available in arguments and stop execution if not.
+            custom_args = api_key_parser.parse_args()
 
-        if custom_args.api_key not in Config.get_api_keys():
-            abort(HTTPStatus.FORBIDDEN, "Invalid api_key given")
+            g.api_user = Config.get_api_key_user(custom_args.api_key)
+            if not g.api_user:
+                abort(HTTPStatus.FORBIDDEN, "Invalid api_key given")
 
         return func(*args, **kwargs)
 
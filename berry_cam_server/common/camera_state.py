@@ -0,0 +1,238 @@
+import atexit
+import hashlib
+import sqlite3
+import threading
+import time
+
+# Keys of a camera state that are configured by the user and fetched by the camera
+SETTINGS = ("enabled",)
+
+
+def settings_version(camera):
+    """
+    Returns a version of the settings of a camera that changes whenever one of the settings changes.
+
+    :param dict camera: The camera state or None if the camera is unknown.
+    :return: The version of the camera settings.
+    :rtype: str
+    """
+    camera = camera or {}
+    settings = ",".join("{}={}".format(key, camera.get(key, False)) for key in SETTINGS)
+    return hashlib.sha1(settings.encode('utf-8')).hexdigest()[:16]
+
+
+class CameraStates:
+    """
+    Stores the state of all connected cameras in a sqlite database.
+
+    All states are kept in memory. Heartbeats of the cameras only update the in-memory state and are persisted
+    periodically, changes done by the user (enabling, disabling and removal of cameras) are written directly.
+    Changes done by other processes are detected via the database's data version and loaded on next access.
+    Cameras can wait for changes of their settings with :meth:`wait_for_change`.
+    """
+
+    def __init__(self, db_file, flush_interval=10):
+        """
+        Opens the camera state database. Creates it if it doesn't exist.
+
+        :param str db_file: The sqlite database file to use.
+        :param float flush_interval: Seconds after which camera heartbeats are written to the database.
+        """
+        self.flush_interval = flush_interval
+
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._db = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cameras ('
+                         'name TEXT PRIMARY KEY, '
+                         'last_connection INTEGER NOT NULL, '
+                         'camera_enabled INTEGER NOT NULL, '
+                         'enabled INTEGER NOT NULL DEFAULT 0)')
+
+        self._cameras = {}
+        self._dirty = set()
+        self._data_version = None
+        self._flush_timer = None
+
+        atexit.register(self.close)
+
+    def _refresh(self, force=False):
+        """
+        Reloads all camera states from the database if it was modified by another connection.
+        Heartbeats that are not yet written are kept.
+
+        :param bool force: Reload also if there were no modifications by other connections, e.g. after own writes.
+        """
+        data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version and not force:
+            return
+
+        cameras = {}
+        for name, last_connection, camera_enabled, enabled in self._db.execute(
+                'SELECT name, last_connection, camera_enabled, enabled FROM cameras'):
+            cameras[name] = {
+                "last_connection": last_connection,
+                "camera_enabled": bool(camera_enabled),
+                "enabled": bool(enabled)
+            }
+
+        for name in self._dirty:
+            cameras.setdefault(name, {"enabled": False}).update(
+                last_connection=self._cameras[name]["last_connection"],
+                camera_enabled=self._cameras[name]["camera_enabled"])
+
+        self._cameras = cameras
+        self._data_version = data_version
+        self._changed.notify_all()
+
+    def get(self, name):
+        """
+        Returns the state of a single camera.
+
+        :param str name: The name of the camera.
+        :return: A copy of the camera state or None if the camera is unknown.
+        :rtype: dict
+        """
+        with self._lock:
+            self._refresh()
+            if name in self._cameras:
+                return dict(self._cameras[name])
+
+            return None
+
+    def wait_for_change(self, name, version, timeout, poll_interval=1.0):
+        """
+        Blocks until the settings of a camera differ from the given version or the timeout expires.
+        Own changes wake up the waiting threads directly, changes of other processes are detected by polling the
+        database's data version.
+
+        :param str name: The name of the camera.
+        :param str version: The settings version known to the camera, see :func:`settings_version`.
+        :param float timeout: Maximum seconds to wait for a change.
+        :param float poll_interval: Seconds after which the database is checked for changes of other processes.
+        :return: A copy of the current camera state or None if the camera is unknown.
+        :rtype: dict
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                camera = self.get(name)
+                remaining = deadline - time.monotonic()
+                if settings_version(camera) != version or remaining <= 0:
+                    return camera
+
+                self._changed.wait(min(remaining, poll_interval))
+
+    def get_all(self):
+        """
+        Returns the states of all cameras.
+
+        :return: Copies of all camera states by camera name.
+        :rtype: dict
+        """
+        with self._lock:
+            self._refresh()
+            return {name: dict(camera) for name, camera in self._cameras.items()}
+
+    def heartbeat(self, name, camera_enabled, last_connection):
+        """
+        Updates the state sent by a camera. Will be written to the database with the next flush.
+
+        :param str name: The name of the camera.
+        :param bool camera_enabled: If the camera is currently enabled.
+        :param int last_connection: The unix timestamp of the connection.
+        """
+        with self._lock:
+            self._refresh()
+            camera = self._cameras.setdefault(name, {"enabled": False})
+            camera["last_connection"] = last_connection
+            camera["camera_enabled"] = camera_enabled
+            self._dirty.add(name)
+
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def set_enabled(self, name, enabled):
+        """
+        Sets the enabled state as requested by the user and writes it directly.
+        The camera is added if it is not written yet, e.g. if its heartbeats are still pending in another process.
+
+        :param str name: The name of the camera.
+        :param bool enabled: If the camera should be enabled.
+        """
+        with self._lock:
+            self.flush()
+            camera = self._cameras.get(name, {})
+            # No upsert, it needs sqlite 3.24
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.execute(
+                    'INSERT OR IGNORE INTO cameras (name, last_connection, camera_enabled) VALUES (?, ?, ?)',
+                    (name, camera.get("last_connection", 0), camera.get("camera_enabled", False)))
+                self._db.execute('UPDATE cameras SET enabled = ? WHERE name = ?', (enabled, name))
+            self._refresh(force=True)
+
+    def remove(self, name):
+        """
+        Removes a camera and writes the removal directly.
+
+        :param str name: The name of the camera to remove.
+        """
+        with self._lock:
+            self._dirty.discard(name)
+            self._db.execute('DELETE FROM cameras WHERE name = ?', (name,))
+            self._refresh(force=True)
+
+    def migrate(self, cameras):
+        """
+        Imports camera states e.g. from the former cameras section of the config file.
+        Cameras that already exist are not changed.
+
+        :param dict cameras: The camera states by camera name.
+        """
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO cameras (name, last_connection, camera_enabled, enabled) VALUES (?, ?, ?, ?)',
+                [(name, int(camera.get("last_connection", 0)), bool(camera.get("camera_enabled", False)),
+                  bool(camera.get("enabled", False))) for name, camera in cameras.items()])
+            self._refresh(force=True)
+
+    def flush(self):
+        """
+        Writes all pending heartbeats to the database.
+        """
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            if not self._dirty or self._db is None:
+                return
+
+            with self._db:
+                self._db.execute('BEGIN')
+                states = [(self._cameras[name]["last_connection"], self._cameras[name]["camera_enabled"], name)
+                          for name in self._dirty]
+                # No upsert, it needs sqlite 3.24
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO cameras (last_connection, camera_enabled, name) VALUES (?, ?, ?)', states)
+                self._db.executemany('UPDATE cameras SET last_connection = ?, camera_enabled = ? WHERE name = ?',
+                                     states)
+
+            self._dirty.clear()
+
+    def close(self):
+        """
+        Writes all pending heartbeats and closes the database.
+        """
+        with self._lock:
+            if self._db is None:
+                return
+
+            self.flush()
+            self._db.close()
+            self._db = None
+            atexit.unregister(self.close)
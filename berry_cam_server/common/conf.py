@@ -1,19 +1,103 @@
+import copy
+import hashlib
+import hmac
 import os
 import secrets
+import threading
+import time
 from datetime import datetime, timezone
 
 import yaml
 
+from .camera_state import CameraStates
+from .config_writer import ConfigWriter
+from .metrics import CONFIG_IO_DURATION
+from .timing import span
+
 
 class Config:
     """
     This class handles all configuration related implementation.
     It will read server and user config from given config file and will handle also api key updates.
+    The state of the connected cameras is kept in a separate camera state store.
+
+    The parsed config file is cached in process and only parsed again if the config file changed on disk
+    (path, inode, size or modification time) or if the cache got invalidated explicitly.
     """
 
     # The config file to parse. Public so that it can be overwritten e.g. for testing purpose.
     config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conf.yaml')
 
+    # Files modified less than this amount of seconds before they were parsed could be modified again without
+    # a visible change of the modification time (coarse file system timestamps). Such cache entries are not trusted.
+    RACY_WINDOW = 1.0
+
+    _cache = None
+    _cache_key = None
+    _cache_racy = False
+    _cache_lock = threading.Lock()
+
+    # Api key lookup built together with the cache. Maps the sha256 digest of each api key to key and username.
+    _api_key_index = {}
+
+    # Serializes and coalesces all modifications of the config file
+    _writer = ConfigWriter()
+
+    # The state of all connected cameras, see open_camera_states
+    camera_states = None
+
+    @staticmethod
+    def _load_config():
+        """
+        Returns the parsed content of the config file. Uses the cached content if the file did not change.
+        The returned dict is shared, so callers must not modify it.
+
+        :return: The parsed config file.
+        :rtype: dict
+        """
+        stat = os.stat(Config.config_file)
+        cache_key = (Config.config_file, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        with Config._cache_lock:
+            if Config._cache is None or Config._cache_racy or Config._cache_key != cache_key:
+                with CONFIG_IO_DURATION.labels('read').time(), span('config'), \
+                        open(Config.config_file, 'r') as config_file:
+                    Config._cache = yaml.safe_load(config_file)
+
+                Config._api_key_index = {
+                    hashlib.sha256(user["api_key"].encode('utf-8')).digest(): (user["api_key"], username)
+                    for username, user in Config._cache["user"].items()
+                }
+
+                Config._cache_key = cache_key
+                Config._cache_racy = time.time() - stat.st_mtime < Config.RACY_WINDOW
+
+            return Config._cache
+
+    @staticmethod
+    def invalidate_cache():
+        """
+        Drops the cached config file content, so that the next access parses the config file again.
+        Called after each write to the config file.
+        """
+        with Config._cache_lock:
+            Config._cache = None
+            Config._cache_key = None
+
+    @staticmethod
+    def _update_config(modification):
+        """
+        Applies a modification to the config file and invalidates the cache.
+
+        :param function modification: Function that gets the complete configuration and updates it in place.
+        :return: The return value of the modification.
+        :rtype: Any
+        """
+        try:
+            return Config._writer.submit(Config.config_file, modification)
+        finally:
+            Config.invalidate_cache()
+
     @staticmethod
     def get_user_config(username):
         """
@@ -24,13 +108,12 @@ class Config:
         :return: The user configuration or None.
         :rtype: dict
         """
-        with open(Config.config_file) as config_file:
-            config = yaml.safe_load(config_file)
+        config = Config._load_config()
 
-            if username in config["user"]:
-                return config["user"][username]
+        if username in config["user"]:
+            return copy.deepcopy(config["user"][username])
 
-            return None
+        return None
 
     @staticmethod
     def get_server_config():
@@ -39,13 +122,12 @@ class Config:
         :return: The server configuration.
         :rtype: dict
         """
-        with open(Config.config_file) as config_file:
-            config = yaml.safe_load(config_file)
-            server_config = {}
-            for key in config["server"]:
-                server_config[key.upper()] = config["server"][key]
+        config = Config._load_config()
+        server_config = {}
+        for key in config["server"]:
+            server_config[key.upper()] = copy.deepcopy(config["server"][key])
 
-            return server_config
+        return server_config
 
     @staticmethod
     def update_api_key(username):
@@ -56,14 +138,13 @@ class Config:
         :return: The new api key
         :rtype: str
         """
-        with open(Config.config_file, 'r') as config_file:
-            config = yaml.safe_load(config_file)
+        new_key = secrets.token_hex(nbytes=16)
 
-        with open(Config.config_file, 'w') as config_file:
-            new_key = secrets.token_hex(nbytes=16)
+        def modification(config):
             config["user"][username]["api_key"] = new_key
-            yaml.safe_dump(config, config_file)
-            return new_key
+
+        Config._update_config(modification)
+        return new_key
 
     @staticmethod
     def get_api_keys():
@@ -73,50 +154,104 @@ class Config:
         :return: A set of all api keys
         :rtype: set
         """
-        api_keys = set()
-        with open(Config.config_file, 'r') as config_file:
-            config = yaml.safe_load(config_file)
-            for user in config["user"]:
-                api_keys.add(config["user"][user]["api_key"])
+        Config._load_config()
+        return {api_key for api_key, _ in Config._api_key_index.values()}
+
+    @staticmethod
+    def get_api_key_user(api_key):
+        """
+        Returns the user that owns the given api key. The key comparison is done in constant time.
 
-        return api_keys
+        :param str api_key: The api key to check.
+        :return: The username or None if the api key is invalid.
+        :rtype: str
+        """
+        Config._load_config()
+        api_key = api_key.encode('utf-8')
+        valid_key, username = Config._api_key_index.get(hashlib.sha256(api_key).digest(), ('', None))
+
+        if hmac.compare_digest(valid_key.encode('utf-8'), api_key):
+            return username
+
+        return None
 
     @staticmethod
-    def set_camera_info(name, enabled):
-        with open(Config.config_file, 'r') as config_file:
-            config = yaml.safe_load(config_file)
+    def open_camera_states(db_file, flush_interval=10):
+        """
+        Opens the camera state store. Cameras that are still stored in the config file are moved to the store.
 
-        with open(Config.config_file, 'w') as config_file:
-            if "cameras" not in config:
-                config["cameras"] = {}
+        :param str db_file: The sqlite database file to store the camera states in.
+        :param float flush_interval: Seconds after which camera heartbeats are written to the database.
+        """
+        if Config.camera_states is not None:
+            Config.camera_states.close()
+
+        Config.camera_states = CameraStates(db_file, flush_interval)
 
-            if name not in config["cameras"]:
-                config["cameras"][name] = {}
+        cameras = Config._load_config().get("cameras")
+        if cameras:
+            Config.camera_states.migrate(cameras)
+            Config._update_config(lambda config: config.pop("cameras", None))
+
+    @staticmethod
+    def set_camera_info(name, enabled):
+        """
+        Stores the state reported by a camera.
 
-            config["cameras"][name]["last_connection"] = int(datetime.now(tz=timezone.utc).timestamp())
-            config["cameras"][name]["camera_enabled"] = enabled
-            yaml.safe_dump(config, config_file)
+        :param str name: The name of the camera.
+        :param bool enabled: If the camera is currently enabled.
+        """
+        Config.camera_states.heartbeat(name, enabled, int(datetime.now(tz=timezone.utc).timestamp()))
 
     @staticmethod
     def enable_camera(name, enabled):
-        with open(Config.config_file, 'r') as config_file:
-            config = yaml.safe_load(config_file)
+        """
+        Sets if a camera should be enabled.
 
-        with open(Config.config_file, 'w') as config_file:
-            config["cameras"][name]["enabled"] = enabled
-            yaml.safe_dump(config, config_file)
+        :param str name: The name of the camera.
+        :param bool enabled: If the camera should be enabled.
+        """
+        Config.camera_states.set_enabled(name, enabled)
 
     @staticmethod
     def remove_camera(name):
-        with open(Config.config_file, 'r') as config_file:
-            config = yaml.safe_load(config_file)
+        """
+        Removes a camera.
 
-        with open(Config.config_file, 'w') as config_file:
-            del config["cameras"][name]
-            yaml.safe_dump(config, config_file)
+        :param str name: The name of the camera.
+        """
+        Config.camera_states.remove(name)
+
+    @staticmethod
+    def get_camera(name):
+        """
+        Returns the state of a single camera.
+
+        :param str name: The name of the camera.
+        :return: The camera state or None if the camera is unknown.
+        :rtype: dict
+        """
+        return Config.camera_states.get(name)
+
+    @staticmethod
+    def wait_for_camera_change(name, version, timeout):
+        """
+        Waits until the settings of a camera differ from the given version or the timeout expires.
+
+        :param str name: The name of the camera.
+        :param str version: The settings version known to the camera.
+        :param float timeout: Maximum seconds to wait for a change.
+        :return: The camera state or None if the camera is unknown.
+        :rtype: dict
+        """
+        return Config.camera_states.wait_for_change(name, version, timeout)
 
     @staticmethod
     def get_connected_cameras():
-        with open(Config.config_file, 'r') as config_file:
-            config = yaml.safe_load(config_file)
-            return config.get("cameras", {})
+        """
+        Returns the states of all cameras.
+
+        :return: The camera states by camera name.
+        :rtype: dict
+        """
+        return Config.camera_states.get_all()
@@ -0,0 +1,204 @@
+import copy
+import os
+import stat
+import tempfile
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import yaml
+
+from .metrics import CONFIG_IO_DURATION
+from .timing import span
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on windows, only one process can write then
+    fcntl = None
+
+
+@contextmanager
+def file_lock(lock_file_name):
+    """
+    Context manager that holds an exclusive lock on the given lock file. The lock is shared across
+    processes, e.g. between multiple server workers.
+
+    :param str lock_file_name: The file to lock. Will be created if it doesn't exist.
+    """
+    with open(lock_file_name, 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class ProcessLock:
+    """
+    A lock file that is held by at most one process, e.g. to run background tasks in only one of multiple server
+    workers. Once acquired, the lock is held until it is released or the process ends, then another process can
+    acquire it.
+    """
+
+    def __init__(self, lock_file_name):
+        """
+        :param str lock_file_name: The file to lock. Will be created if it doesn't exist.
+        """
+        self.lock_file_name = lock_file_name
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    def acquire(self):
+        """
+        Acquires the lock if no other process holds it, without waiting.
+
+        :return: If this process holds the lock.
+        :rtype: bool
+        """
+        with self._lock:
+            if self._lock_file is not None:
+                return True
+
+            lock_file = open(self.lock_file_name, 'a')
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    return False
+
+            self._lock_file = lock_file
+            return True
+
+    def release(self):
+        """
+        Releases the lock, if this process holds it.
+        """
+        with self._lock:
+            if self._lock_file is not None:
+                # Closing the file releases the lock
+                self._lock_file.close()
+                self._lock_file = None
+
+
+def atomic_dump(config, config_file_name):
+    """
+    Writes the given configuration to a temporary file and renames it to the config file afterwards.
+    Readers will thus always see either the old or the new configuration, never a partially written one.
+
+    :param dict config: The configuration to write.
+    :param str config_file_name: The config file to replace.
+    """
+    directory = os.path.dirname(os.path.abspath(config_file_name))
+    handle, temp_file_name = tempfile.mkstemp(dir=directory, prefix='.conf-', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as temp_file:
+            yaml.safe_dump(config, temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        if os.path.exists(config_file_name):
+            os.chmod(temp_file_name, stat.S_IMODE(os.stat(config_file_name).st_mode))
+
+        os.replace(temp_file_name, config_file_name)
+    except BaseException:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+
+class ConfigWriter:
+    """
+    Serializes all modifications of config files.
+
+    Modifications are functions that get the complete configuration and update it in place. Concurrent modifications
+    are queued while a write is running and written afterwards together in a single read-modify-write cycle.
+    Each cycle reads the current config file and takes a file lock, so also multiple processes can write safely.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._writing = False
+
+        # Amount of config file writes done by this writer
+        self.writes = 0
+
+    def submit(self, config_file_name, modification):
+        """
+        Applies the given modification to the config file. Blocks until the modification is written.
+
+        :param str config_file_name: The config file to modify.
+        :param function modification: Function that will be called with the configuration to update.
+        :return: The return value of the modification.
+        :rtype: Any
+        """
+        result = Future()
+
+        with self._lock:
+            self._pending.append((config_file_name, modification, result))
+            write = not self._writing
+            self._writing = True
+
+        # The first caller writes all queued modifications, all others just wait for their results
+        if write:
+            self._write_pending()
+
+        return result.result()
+
+    def _write_pending(self):
+        """
+        Writes all queued modifications until the queue is empty.
+        """
+        while True:
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+
+                if not pending:
+                    self._writing = False
+                    return
+
+            config_files = {}
+            for config_file_name, modification, result in pending:
+                config_files.setdefault(config_file_name, []).append((modification, result))
+
+            for config_file_name, modifications in config_files.items():
+                self._write(config_file_name, modifications)
+
+    def _write(self, config_file_name, modifications):
+        """
+        Applies the given modifications to the config file in a single write.
+
+        :param str config_file_name: The config file to modify.
+        :param list modifications: Tuples of modification function and the future to store its result in.
+        """
+        results = []
+        try:
+            with CONFIG_IO_DURATION.labels('write').time(), span('config'), file_lock(config_file_name + '.lock'):
+                with open(config_file_name, 'r') as config_file:
+                    config = yaml.safe_load(config_file)
+
+                for modification, result in modifications:
+                    # Work on a copy, so that a failing modification doesn't leave partial changes behind
+                    updated_config = copy.deepcopy(config)
+                    try:
+                        results.append((result, modification(updated_config)))
+                        config = updated_config
+                    except Exception as error:
+                        result.set_exception(error)
+
+                if results:
+                    atomic_dump(config, config_file_name)
+                    self.writes += 1
+
+        except Exception as error:
+            for _, result in modifications:
+                if not result.done():
+                    result.set_exception(error)
+            return
+
+        for result, value in results:
+            result.set_result(value)
@@ -0,0 +1,183 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .picture_index import PREVIEW_DONE, PREVIEW_FAILED
+
+LOG = logging.getLogger(__name__)
+
+# The amount of published picture names remembered, to not publish pictures twice
+PUBLISHED_NAMES = 1000
+
+# The maximum amount of pictures read from the picture index per poll
+POLL_LIMIT = 100
+
+# The time in seconds after which pictures with unfinished previews are skipped by the polls, e.g. if the server
+# process creating the previews stopped
+POLL_MAX_WAIT = 5 * 60
+
+
+class PictureEvents:
+    """
+    Publishes new pictures to all subscribers within this process, e.g. the live feeds of the viewer.
+
+    Each subscriber gets its own queue, so slow subscribers don't block the publishers. If the queue of a subscriber
+    is full, new events are dropped for this subscriber.
+    Pictures uploaded to other server processes are found by polling the picture index while there are subscribers.
+    """
+
+    def __init__(self, queue_size=100, index=None, poll_interval=1.0):
+        """
+        :param int queue_size: The maximum amount of events kept for each subscriber.
+        :param PictureIndex index: The picture index to poll for pictures of other server processes. Not polled if
+                                   None.
+        :param float poll_interval: The time in seconds between two polls of the picture index.
+        """
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+
+        self._index = index
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._published = OrderedDict()
+        self._cursor = None
+        self._data_version = None
+        self._stopped = threading.Event()
+        self._poll_thread = None
+
+    @contextmanager
+    def subscribe(self):
+        """
+        Subscribes to new pictures for the duration of the with block.
+
+        :return: The queue the published events are put into.
+        :rtype: queue.Queue
+        """
+        subscriber = queue.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._index is not None and self._poll_thread is None:
+                self._poll_thread = threading.Thread(target=self._poll, name='picture-events', daemon=True)
+                self._poll_thread.start()
+
+        try:
+            yield subscriber
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        """
+        Sends an event to all current subscribers. Each picture is only published once.
+
+        :param dict event: The event to send.
+        """
+        with self._lock:
+            if not self._remember(event["name"]):
+                return
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                LOG.debug("Dropped event for slow subscriber: %s", event)
+
+    def _remember(self, name):
+        """
+        Remembers a published picture. Must be called with the lock held.
+
+        :param str name: The name of the picture.
+        :return: If the picture was not published before.
+        :rtype: bool
+        """
+        if name in self._published:
+            return False
+
+        self._published[name] = True
+        if len(self._published) > PUBLISHED_NAMES:
+            self._published.popitem(last=False)
+
+        return True
+
+    def _poll(self):
+        """
+        The background thread, polls the picture index once per poll interval.
+        """
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.poll_once()
+            except Exception:
+                LOG.exception("Polling the picture index failed")
+
+    def poll_once(self):
+        """
+        Publishes the pictures that other server processes added to the picture index since the last poll, once their
+        previews are created. Only polls while there are subscribers.
+        """
+        if not self.subscribers:
+            # Pictures added without subscribers are not published later
+            self._cursor = None
+            return
+
+        data_version = self._index.data_version()
+        if self._cursor is None:
+            newest = self._index.latest(1)
+            self._cursor = (newest[0]["timestamp"], newest[0]["name"]) if newest else (0, '')
+        elif data_version == self._data_version:
+            # Not modified by another process
+            return
+
+        self._data_version = data_version
+        pictures, _ = self._index.page(after=self._cursor, limit=POLL_LIMIT)
+
+        # Oldest first, the cursor stays at the oldest picture whose previews are not created yet
+        waiting = False
+        for picture in reversed(pictures):
+            if picture["preview_status"] not in (PREVIEW_DONE, PREVIEW_FAILED) and \
+                    picture["timestamp"] > time.time() - POLL_MAX_WAIT:
+                waiting = True
+                continue
+
+            if not waiting:
+                self._cursor = (picture["timestamp"], picture["name"])
+
+            self.publish({"name": picture["name"]})
+
+        if waiting:
+            # Polls again also without modifications, e.g. if the previews were created by this process
+            self._data_version = None
+
+    def stop(self):
+        """
+        Stops polling the picture index.
+        """
+        self._stopped.set()
+        if self._poll_thread is not None:
+            self._poll_thread.join()
+            self._poll_thread = None
+
+    @property
+    def subscribers(self):
+        """
+        :return: The amount of current subscribers.
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._subscribers)
+
+
+def init_app(app):
+    """
+    Creates the publisher of new pictures for the given app. Pictures of other server processes are published after
+    at most PICTURE_EVENTS_POLL_INTERVAL seconds (default 1), None disables the polling.
+
+    :param Flask app: The flask application.
+    """
+    poll_interval = app.config.get("PICTURE_EVENTS_POLL_INTERVAL", 1.0)
+    app.extensions['picture_events'] = PictureEvents(app.config.get("PICTURE_EVENTS_QUEUE_SIZE", 100),
+                                                     app.extensions['picture_index'] if poll_interval else None,
+                                                     poll_interval)
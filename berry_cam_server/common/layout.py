@@ -0,0 +1,113 @@
+import logging
+import os
+from datetime import datetime, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+LOG = logging.getLogger(__name__)
+
+
+def shard_dir(name):
+    """
+    Returns the directory of a picture, relative to the raw or previews directory.
+    Pictures are sharded by upload date (YYYY/MM/DD), to keep the amount of files per directory small.
+
+    :param str name: The name of the picture, starting with the upload timestamp in hundredths of a second.
+    :return: The shard directory or None if the name doesn't start with a timestamp.
+    :rtype: str
+    """
+    timestamp = name.split('-', 1)[0]
+    if not timestamp.isdigit():
+        return None
+
+    try:
+        return datetime.fromtimestamp(int(timestamp) / 100, timezone.utc).strftime('%Y/%m/%d')
+    except (OverflowError, OSError, ValueError):
+        return None
+
+
+def picture_file(base_dir, name, extension):
+    """
+    Returns the file of a picture in the sharded layout.
+
+    :param str base_dir: The raw or previews directory.
+    :param str name: The name of the picture.
+    :param str extension: The file extension.
+    :return: The file.
+    :rtype: str
+    """
+    shard = shard_dir(name)
+    file_name = "{}.{}".format(name, extension)
+    if shard is None:
+        return os.path.join(base_dir, file_name)
+
+    return os.path.join(base_dir, shard, file_name)
+
+
+def find_picture_file(base_dir, file_name, exists=os.path.exists):
+    """
+    Finds the file of a picture. Uses the sharded layout and falls back to the former flat layout.
+
+    :param str base_dir: The raw or previews directory.
+    :param str file_name: The file name of the picture, without directories.
+    :param function exists: Checks if a file exists, e.g. Storage.exists for files of a storage backend.
+    :return: The file, relative to the base directory.
+    :rtype: str
+    """
+    name, extension = os.path.splitext(file_name)
+    sharded_file = os.path.relpath(picture_file(base_dir, name, extension[1:]), base_dir)
+    if sharded_file != file_name and not exists(os.path.join(base_dir, sharded_file)) \
+            and exists(os.path.join(base_dir, file_name)):
+        return file_name
+
+    return sharded_file
+
+
+def migrate_flat_layout(upload_dir, preview_sizes=()):
+    """
+    Moves all pictures from the flat raw and previews directories to the sharded layout.
+    Files which are already in the sharded layout are kept.
+
+    :param str upload_dir: The upload directory.
+    :param list preview_sizes: The sizes of the previews stored in sub directories of the previews directory.
+    :return: The amount of moved files.
+    :rtype: int
+    """
+    base_dirs = [os.path.join(upload_dir, 'raw'), os.path.join(upload_dir, 'previews')]
+    base_dirs.extend(os.path.join(upload_dir, 'previews', str(size)) for size in preview_sizes)
+
+    moved = 0
+    for base_dir in base_dirs:
+        if not os.path.isdir(base_dir):
+            continue
+
+        for entry in os.scandir(base_dir):
+            name, extension = os.path.splitext(entry.name)
+            if not entry.is_file() or not extension:
+                continue
+
+            target = picture_file(base_dir, name, extension[1:])
+            if target == entry.path:
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(entry.path, target)
+            moved += 1
+
+    LOG.info("Moved %d files to sharded layout in %s", moved, upload_dir)
+    return moved
+
+
+@click.command('shard-uploads')
+@with_appcontext
+def shard_uploads_command():
+    """
+    Moves all pictures uploaded with the flat directory layout to the sharded layout.
+    """
+    from .thumbnails import PREVIEW_SIZE
+
+    sizes = [size for size in current_app.extensions['thumbnails'].sizes if size != PREVIEW_SIZE]
+    moved = migrate_flat_layout(current_app.config["UPLOAD_DIR"], sizes)
+    click.echo("Moved {} files.".format(moved))
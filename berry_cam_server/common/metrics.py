@@ -0,0 +1,408 @@
+import abc
+import atexit
+import bisect
+import glob
+import hmac
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from http import HTTPStatus
+
+from flask import Response, abort, current_app, g, request
+
+LOG = logging.getLogger(__name__)
+
+# The default histogram buckets in seconds, same as used by the prometheus client libraries
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+# The content type of the prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The camera label of metrics for pictures of unknown cameras, so that uploads can't add arbitrary label values
+OTHER_CAMERA = 'other'
+
+
+def _format_value(value):
+    """
+    :param float value: The value of a sample.
+    :return: The value in the prometheus text format.
+    :rtype: str
+    """
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    """
+    :param list labels: The label names and values of a sample.
+    :return: The labels in the prometheus text format.
+    :rtype: str
+    """
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                           .replace('\n', r'\n'))
+                          for name, value in labels) + '}'
+
+
+class Registry:
+    """
+    Collects all metrics of the server process and renders them in the prometheus text format.
+
+    With multiple server processes, each process only counts its own requests. If a directory is shared with
+    share_samples, each process writes its samples to a file in the directory once per interval and the exposition
+    contains the sum of the samples of all processes, like the multiprocess mode of the prometheus client. The
+    samples of stopped processes are kept, so that counters never decrease.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._directory = None
+        self._samples_file = None
+        self._write_timer = None
+
+    def register(self, metric):
+        """
+        :param Metric metric: The metric to add.
+        """
+        with self._lock:
+            self._metrics.append(metric)
+
+    def share_samples(self, directory, interval=1.0):
+        """
+        Shares the samples of this process with the other server processes using the given directory, see the class
+        documentation.
+
+        :param str directory: The directory shared by all server processes.
+        :param float interval: The time in seconds between two writes of the samples of this process.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            if self._samples_file is None:
+                atexit.register(self.write_samples)
+            self._directory = directory
+            # The process id might be reused by a later process
+            self._samples_file = os.path.join(directory, '{}-{}.json'.format(os.getpid(), uuid.uuid4().hex))
+
+        self._schedule_write(interval)
+
+    def _schedule_write(self, interval):
+        """
+        Writes the samples of this process once per interval.
+
+        :param float interval: The time in seconds between two writes.
+        """
+        def write():
+            self.write_samples()
+            self._schedule_write(interval)
+
+        with self._lock:
+            if self._write_timer is not None:
+                self._write_timer.cancel()
+            self._write_timer = threading.Timer(interval, write)
+            self._write_timer.daemon = True
+            self._write_timer.start()
+
+    def _samples(self):
+        """
+        :return: The registered metrics and the name suffix, labels and value of all samples of this process.
+        :rtype: tuple
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+
+        return metrics, [(metric.name + suffix, labels, value)
+                         for metric in metrics for suffix, labels, value in metric.samples()]
+
+    def write_samples(self):
+        """
+        Writes the samples of this process to the shared directory, if any.
+        """
+        samples_file = self._samples_file
+        if samples_file is None:
+            return
+
+        _, samples = self._samples()
+        temp_file = samples_file + '.tmp'
+        try:
+            with open(temp_file, 'w') as file:
+                json.dump(samples, file)
+            os.replace(temp_file, samples_file)
+        except OSError as error:
+            LOG.warning("Writing the metrics to %s failed: %s", samples_file, error)
+
+    def exposition(self):
+        """
+        :return: All metrics in the prometheus text format, summed over all server processes if shared.
+        :rtype: str
+        """
+        metrics, samples = self._samples()
+
+        values = OrderedDict()
+        for name, labels, value in samples:
+            values[(name, tuple(map(tuple, labels)))] = value
+
+        samples_file = self._samples_file
+        if samples_file is not None:
+            # Keeps the samples seen by the other processes up to date
+            self.write_samples()
+            for other_file in sorted(glob.glob(os.path.join(self._directory, '*.json'))):
+                if other_file == samples_file:
+                    continue
+                try:
+                    with open(other_file) as file:
+                        other_samples = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                for name, labels, value in other_samples:
+                    key = (name, tuple(map(tuple, labels)))
+                    values[key] = values.get(key, 0) + value
+
+        by_metric = OrderedDict((metric.name, []) for metric in metrics)
+        for (name, labels), value in values.items():
+            for metric in metrics:
+                if name.startswith(metric.name) and name[len(metric.name):] in metric.suffixes:
+                    by_metric[metric.name].append((name, labels, value))
+                    break
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in by_metric[metric.name]:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+# The registry all metrics of the server are added to
+REGISTRY = Registry()
+
+
+class Metric(abc.ABC):
+    """
+    Base class of all metrics. Metrics with label names have one child per combination of label values,
+    see labels, metrics without labels are used directly.
+    """
+    type = None
+    # The suffixes of the sample names
+    suffixes = ()
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        """
+        :param str name: The name of the metric.
+        :param str documentation: The help text of the metric.
+        :param list labelnames: The names of the labels of the metric.
+        :param Registry registry: The registry to add the metric to.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._create_child()
+
+        registry.register(self)
+
+    def labels(self, *values):
+        """
+        :param values: The values of all labels, in the order of the label names.
+        :return: The child of the metric for the given label values.
+        :rtype: Any
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError("Expected values for the labels {}".format(self.labelnames))
+
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            if values not in self._children:
+                self._children[values] = self._create_child()
+            return self._children[values]
+
+    def samples(self):
+        """
+        :return: Tuples of name suffix, labels and value of all samples of the metric.
+        :rtype: list
+        """
+        with self._lock:
+            children = list(self._children.items())
+
+        samples = []
+        for values, child in children:
+            for suffix, labels, value in child.samples():
+                samples.append((suffix, list(zip(self.labelnames, values)) + labels, value))
+
+        return samples
+
+    @abc.abstractmethod
+    def _create_child(self):
+        """
+        :return: A new child of the metric, used for one combination of label values.
+        """
+
+    def __getattr__(self, name):
+        # Metrics without labels are used like their only child
+        children = self.__dict__.get('_children', {})
+        if name.startswith('_') or () not in children:
+            raise AttributeError(name)
+
+        return getattr(children[()], name)
+
+
+class _CounterChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def inc(self, amount=1):
+        """
+        :param float amount: The amount to increase the counter by. Must not be negative.
+        """
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+
+        with self._lock:
+            self._value += amount
+
+    def samples(self):
+        with self._lock:
+            return [('_total', [], self._value)]
+
+
+class Counter(Metric):
+    """
+    A value that only increases, e.g. the amount of requests. The name must not contain the _total suffix.
+    """
+    type = 'counter'
+    suffixes = ('_total',)
+
+    def _create_child(self):
+        return _CounterChild()
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        """
+        :param float value: The value to add to the histogram.
+        """
+        bucket = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[bucket] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the duration of the with block in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(('_bucket', [('le', _format_value(bound))], cumulative))
+
+        samples.append(('_count', [], cumulative))
+        samples.append(('_sum', [], total))
+        return samples
+
+
+class Histogram(Metric):
+    """
+    Counts values in buckets, e.g. request durations.
+    """
+    type = 'histogram'
+    suffixes = ('_bucket', '_count', '_sum')
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        """
+        :param str name: The name of the metric.
+        :param str documentation: The help text of the metric.
+        :param list labelnames: The names of the labels of the metric.
+        :param Registry registry: The registry to add the metric to.
+        :param list buckets: The upper bounds of the buckets, without +Inf.
+        """
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _create_child(self):
+        return _HistogramChild(self.buckets)
+
+
+UPLOAD_DURATION = Histogram(
+    'berrycam_upload_duration_seconds',
+    'Duration of picture uploads. Phase total is the whole single picture upload request, save is receiving and '
+    'writing the picture and thumbnail is the creation of the previews including the time queued.',
+    ['phase'])
+INGESTED_BYTES = Counter(
+    'berrycam_ingested_bytes',
+    'Bytes of uploaded pictures by camera, including duplicates. Pictures of cameras that never connected to the '
+    'server are counted as camera "{}".'.format(OTHER_CAMERA),
+    ['camera'])
+UPLOAD_COLLISIONS = Counter(
+    'berrycam_upload_collisions',
+    'Uploads rejected with 429 since no free picture name was found for the upload second.')
+CONFIG_IO_DURATION = Histogram(
+    'berrycam_config_io_duration_seconds', 'Duration of reads and writes of the config file.', ['operation'])
+VIEWER_RENDER_DURATION = Histogram(
+    'berrycam_viewer_render_duration_seconds', 'Duration of rendering viewer pages.')
+VIEWER_SCANNED_PICTURES = Counter(
+    'berrycam_viewer_scanned_pictures', 'Pictures read from the picture index to render viewer pages.')
+
+
+def metrics():
+    """
+    Returns all metrics of this server process in the prometheus text format.
+    Requires a logged in user or the METRICS_TOKEN as bearer token, e.g. for the prometheus server.
+
+    :return: The metrics.
+    :rtype: Response
+    """
+    token = current_app.config.get("METRICS_TOKEN")
+    authorized = token and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)
+    if not authorized and not g.get('user'):
+        abort(HTTPStatus.UNAUTHORIZED)
+
+    return Response(REGISTRY.exposition(), content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """
+    Adds the /metrics endpoint to the given app, unless disabled by METRICS_ENABLED. Without a logged in user, the
+    metrics can only be read with the METRICS_TOKEN.
+    The metrics of all server processes are summed up using the METRICS_DIR (default the metrics directory in the
+    upload directory). The directory should be emptied when the server is started, e.g. to reset the counters.
+
+    :param Flask app: The flask application.
+    """
+    if app.config.get("METRICS_ENABLED", True):
+        REGISTRY.share_samples(app.config.get("METRICS_DIR", os.path.join(app.config["UPLOAD_DIR"], 'metrics')))
+        app.add_url_rule('/metrics', 'metrics', metrics)
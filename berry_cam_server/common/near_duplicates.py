@@ -0,0 +1,150 @@
+import logging
+import threading
+
+import numpy
+from PIL import Image
+
+from .retention import delete_pictures
+from .thumbnails import PREVIEW_SIZE
+
+LOG = logging.getLogger(__name__)
+
+# The width and height of the difference hash grid, the hash has HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+# Near duplicates are kept and marked in the picture index
+MARK = 'mark'
+
+# Near duplicates are deleted
+DROP = 'drop'
+
+
+def difference_hash(image, hash_size=HASH_SIZE):
+    """
+    Computes the difference hash of an image. The image is reduced to a grayscale grid of (hash_size + 1) x hash_size
+    pixels, each bit of the hash tells if a pixel is brighter than its left neighbour.
+    Visually similar images have hashes that differ only in few bits.
+
+    :param Image image: The image to hash, e.g. a preview.
+    :param int hash_size: The height of the grid.
+    :return: The hash as hex string.
+    :rtype: str
+    """
+    pixels = numpy.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=numpy.int16)
+    return numpy.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+
+def hamming_distance(first_hash, second_hash):
+    """
+    :param str first_hash: A hash from difference_hash.
+    :param str second_hash: Another hash from difference_hash, of the same size.
+    :return: The amount of different bits of the hashes.
+    :rtype: int
+    """
+    difference = numpy.bitwise_xor(numpy.frombuffer(bytes.fromhex(first_hash), numpy.uint8),
+                                   numpy.frombuffer(bytes.fromhex(second_hash), numpy.uint8))
+    return int(numpy.unpackbits(difference).sum())
+
+
+class NearDuplicateFilter:
+    """
+    Detects frames of a camera that are visually (nearly) identical to the last accepted frame of the camera,
+    e.g. frames of an empty scene. The frames are compared by the difference hash of their previews.
+    Near duplicates are either marked in the picture index or deleted.
+    """
+
+    def __init__(self, storage, index, threshold=None, action=MARK, preview_sizes=(PREVIEW_SIZE,)):
+        """
+        Creates a new near duplicate filter.
+
+        :param Storage storage: The storage of the pictures.
+        :param PictureIndex index: The index of the pictures in the storage.
+        :param int threshold: Frames with a hash distance below the threshold are near duplicates. None disables
+                              the filter.
+        :param str action: What to do with near duplicates, MARK or DROP.
+        :param list preview_sizes: The sizes of the previews to delete together with dropped pictures.
+        """
+        if action not in (MARK, DROP):
+            raise ValueError("Unknown near duplicate action {}".format(action))
+
+        self._storage = storage
+        self._index = index
+        self.threshold = threshold
+        self.action = action
+        self._preview_sizes = preview_sizes
+
+        self._lock = threading.Lock()
+        self._stats = {
+            'marked': 0,
+            'dropped': 0
+        }
+
+    @property
+    def enabled(self):
+        """
+        :return: If a threshold is configured.
+        :rtype: bool
+        """
+        return self.threshold is not None
+
+    @staticmethod
+    def hash_preview(preview_image):
+        """
+        :param str preview_image: The preview image file.
+        :return: The difference hash of the preview.
+        :rtype: str
+        """
+        with Image.open(preview_image) as image:
+            return difference_hash(image)
+
+    def check(self, name, frame_hash):
+        """
+        Compares a picture with the last accepted frame of the same camera and marks or drops it if it is a near
+        duplicate. Otherwise the picture is the new last accepted frame.
+
+        :param str name: The name of the picture.
+        :param str frame_hash: The difference hash of the picture.
+        :return: If the picture is a near duplicate.
+        :rtype: bool
+        """
+        picture = self._index.get(name)
+        if picture is None:
+            # Deleted in the meantime
+            return False
+
+        reference = self._index.last_accepted_frame(picture)
+        if reference is None or hamming_distance(frame_hash, reference['frame_hash']) >= self.threshold:
+            self._index.update_blob(name, frame_hash=frame_hash)
+            return False
+
+        if self.action == DROP:
+            delete_pictures(self._storage, self._index, [picture], self._preview_sizes)
+        else:
+            self._index.update_blob(name, frame_hash=frame_hash, near_duplicate_of=reference['name'])
+
+        LOG.debug("Picture %s is a near duplicate of %s", name, reference['name'])
+        with self._lock:
+            self._stats['dropped' if self.action == DROP else 'marked'] += 1
+
+        return True
+
+    def stats(self):
+        """
+        :return: The amount of marked and dropped near duplicates since the server started.
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+def init_app(app):
+    """
+    Creates the near duplicate filter for the given app.
+
+    :param Flask app: The flask application.
+    """
+    app.extensions['near_duplicates'] = NearDuplicateFilter(app.extensions['storage'],
+                                                            app.extensions['picture_index'],
+                                                            app.config.get("NEAR_DUPLICATE_THRESHOLD"),
+                                                            app.config.get("NEAR_DUPLICATE_ACTION", MARK),
+                                                            app.extensions['thumbnails'].sizes)
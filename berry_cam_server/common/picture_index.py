@@ -0,0 +1,574 @@
+import os
+import sqlite3
+import threading
+
+from flask import current_app
+
+# The states of the preview creation. While the raw image of a new picture is stored, the picture is storing and
+# can't be referenced by duplicates, since its blob might not exist yet
+PREVIEW_STORING = 'storing'
+PREVIEW_PENDING = 'pending'
+PREVIEW_DONE = 'done'
+PREVIEW_FAILED = 'failed'
+
+# The columns of the picture index with their definitions, in the order used for inserts
+COLUMNS = (
+    ('name', 'TEXT PRIMARY KEY'),
+    ('timestamp', 'REAL NOT NULL'),
+    ('raw_extension', 'TEXT NOT NULL'),
+    ('raw_size', 'INTEGER'),
+    ('preview_size', 'INTEGER'),
+    ('width', 'INTEGER'),
+    ('height', 'INTEGER'),
+    ('camera', 'TEXT'),
+    ('user', 'TEXT'),
+    ('preview_status', "TEXT NOT NULL DEFAULT '{}'".format(PREVIEW_DONE)),
+    ('content_hash', 'TEXT'),
+    ('blob_name', 'TEXT'),
+    ('frame_hash', 'TEXT'),
+    ('near_duplicate_of', 'TEXT'),
+    ('original_size', 'INTEGER'),
+    ('sprite', 'TEXT'),
+    ('sprite_slot', 'INTEGER'),
+    ('sprite_version', 'INTEGER'),
+)
+
+# Values used for columns that are not given on insert
+DEFAULTS = {
+    'preview_status': PREVIEW_DONE
+}
+
+
+class PictureIndex:
+    """
+    Index of all uploaded pictures, stored in a sqlite database in the upload directory.
+    Allows to list the pictures without scanning the upload directory.
+
+    Pictures with identical content share their files (the blob): blob_name is the name of the picture the raw
+    image and previews are stored for. Pictures added before deduplication have no blob_name and use their own name.
+    """
+
+    # The name of the database file in the upload directory
+    FILE_NAME = 'pictures.sqlite'
+
+    def __init__(self, db_file):
+        """
+        Opens the picture index. Creates it if it doesn't exist.
+
+        :param str db_file: The sqlite database file to use.
+        """
+        self._lock = threading.Lock()
+        # Transactions take the write lock when they begin (BEGIN IMMEDIATE). Deferred transactions that read before
+        # writing fail directly instead of waiting, if another process wrote in between
+        self._db = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS pictures ({})'.format(
+            ', '.join('{} {}'.format(column, definition) for column, definition in COLUMNS)))
+
+        # Add columns that were introduced after the index was created
+        existing_columns = {row['name'] for row in self._db.execute('PRAGMA table_info(pictures)')}
+        for column, definition in COLUMNS:
+            if column not in existing_columns:
+                self._db.execute('ALTER TABLE pictures ADD COLUMN {} {}'.format(column, definition))
+
+        self._db.execute('CREATE INDEX IF NOT EXISTS pictures_timestamp ON pictures (timestamp, name)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pictures_camera ON pictures (camera, timestamp, name)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pictures_content_hash ON pictures (content_hash)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pictures_blob_name ON pictures (blob_name)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pictures_sprite ON pictures (sprite, sprite_slot)')
+        # The accepted frames the near duplicate detection compares new pictures with, see last_accepted_frame
+        self._db.execute('CREATE INDEX IF NOT EXISTS pictures_accepted_frames ON pictures (camera, timestamp, name) '
+                         'WHERE near_duplicate_of IS NULL AND frame_hash IS NOT NULL')
+
+        # The amount of slots ever reserved per sprite sheet and the version of the last write of the sheet. Slots of
+        # deleted pictures are never reused, so that the cells of a sprite sheet never change. Filled from the pictures
+        # for indexes created before the table existed. Sheets written before the versions existed got a write per
+        # slot, the pictures without version use their slot as version
+        self._db.execute('CREATE TABLE IF NOT EXISTS sprite_sheets '
+                         '(name TEXT PRIMARY KEY, slots INTEGER NOT NULL, version INTEGER NOT NULL DEFAULT 0)')
+        if 'version' not in {row['name'] for row in self._db.execute('PRAGMA table_info(sprite_sheets)')}:
+            self._db.execute('ALTER TABLE sprite_sheets ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+            self._db.execute('UPDATE sprite_sheets SET version = slots')
+        self._db.execute('INSERT OR IGNORE INTO sprite_sheets (name, slots, version) '
+                         'SELECT sprite, MAX(sprite_slot) + 1, MAX(sprite_slot) + 1 FROM pictures '
+                         'WHERE sprite IS NOT NULL GROUP BY sprite')
+
+        # The cameras that have pictures in the index, kept up to date on inserts and removals, so that listing them
+        # doesn't need to scan the pictures. Filled from the pictures for indexes created before the table existed
+        if self._db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cameras'").fetchone() is None:
+            self._db.execute('CREATE TABLE cameras (name TEXT PRIMARY KEY)')
+            self._db.execute('INSERT INTO cameras (name) SELECT DISTINCT camera FROM pictures WHERE camera IS NOT NULL')
+
+    @staticmethod
+    def for_upload_dir(upload_dir):
+        """
+        Opens the picture index of the given upload directory.
+        If the index doesn't exist yet, all pictures that are already in the upload directory are added.
+
+        :param str upload_dir: The upload directory.
+        :return: The picture index.
+        :rtype: PictureIndex
+        """
+        db_file = os.path.join(upload_dir, PictureIndex.FILE_NAME)
+        new_index = not os.path.exists(db_file)
+
+        index = PictureIndex(db_file)
+        if new_index:
+            index.import_directory(upload_dir)
+
+        return index
+
+    def add(self, name, timestamp, raw_extension, **info):
+        """
+        Adds a picture to the index.
+
+        :param str name: The name of the picture, without extension.
+        :param float timestamp: The unix timestamp the picture was uploaded.
+        :param str raw_extension: The extension of the raw image.
+        :param info: Further picture information, see COLUMNS and DEFAULTS.
+        """
+        self.add_many([dict(info, name=name, timestamp=timestamp, raw_extension=raw_extension)])
+
+    def add_many(self, pictures):
+        """
+        Adds multiple pictures to the index in a single transaction. Existing pictures are replaced.
+
+        :param list pictures: The pictures as dicts, see COLUMNS for the keys.
+        """
+        with self._lock, self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.executemany(
+                'INSERT OR REPLACE INTO pictures ({}) VALUES ({})'.format(
+                    ', '.join(column for column, _ in COLUMNS), ', '.join('?' * len(COLUMNS))),
+                [tuple(picture.get(column, DEFAULTS.get(column)) for column, _ in COLUMNS) for picture in pictures])
+            self._add_cameras(pictures)
+
+    def add_deduplicated(self, pictures):
+        """
+        Adds multiple pictures to the index in a single transaction, like add_many.
+        Pictures with the same content_hash as a picture in the index reference the blob of that picture and take over
+        its raw extension, preview state and sprite, they don't have to be stored again. Pictures whose raw image is
+        still being stored (PREVIEW_STORING) are not referenced.
+
+        :param list pictures: The pictures as dicts, see COLUMNS for the keys.
+        :return: The added pictures with new content, which have to be stored.
+        :rtype: list
+        """
+        insert = 'INSERT OR REPLACE INTO pictures ({}) VALUES ({})'.format(
+            ', '.join(column for column, _ in COLUMNS), ', '.join('?' * len(COLUMNS)))
+
+        new_pictures = []
+        with self._lock, self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            for picture in pictures:
+                existing = None
+                if picture.get('content_hash'):
+                    existing = self._db.execute(
+                        'SELECT name, blob_name, raw_extension, preview_status, preview_size, sprite, sprite_slot, '
+                        'sprite_version FROM pictures WHERE content_hash = ? AND preview_status != ? LIMIT 1',
+                        (picture['content_hash'], PREVIEW_STORING)).fetchone()
+
+                if existing:
+                    picture = dict(picture,
+                                   blob_name=existing['blob_name'] or existing['name'],
+                                   raw_extension=existing['raw_extension'],
+                                   preview_status=existing['preview_status'],
+                                   preview_size=existing['preview_size'],
+                                   sprite=existing['sprite'],
+                                   sprite_slot=existing['sprite_slot'],
+                                   sprite_version=existing['sprite_version'])
+                else:
+                    picture = dict(picture, blob_name=picture['name'])
+                    new_pictures.append(picture)
+
+                self._db.execute(insert, tuple(picture.get(column, DEFAULTS.get(column)) for column, _ in COLUMNS))
+
+            self._add_cameras(pictures)
+
+        return new_pictures
+
+    def _add_cameras(self, pictures):
+        """
+        Adds the cameras of new pictures to the cameras table. Must be called within the transaction of the insert.
+
+        :param list pictures: The added pictures as dicts.
+        """
+        self._db.executemany('INSERT OR IGNORE INTO cameras (name) VALUES (?)',
+                             {(picture['camera'],) for picture in pictures if picture.get('camera') is not None})
+
+    def update(self, name, **info):
+        """
+        Updates the information of a picture.
+
+        :param str name: The name of the picture.
+        :param info: The picture information to update, see COLUMNS.
+        """
+        with self._lock:
+            self._db.execute(
+                'UPDATE pictures SET {} WHERE name = ?'.format(', '.join('{} = ?'.format(column) for column in info)),
+                tuple(info.values()) + (name,))
+
+    def update_blob(self, blob_name, **info):
+        """
+        Updates the information of all pictures that share the given blob, e.g. the preview state.
+
+        :param str blob_name: The name of the blob.
+        :param info: The picture information to update, see COLUMNS.
+        """
+        with self._lock:
+            self._db.execute(
+                'UPDATE pictures SET {} WHERE blob_name = ? OR (name = ? AND blob_name IS NULL)'.format(
+                    ', '.join('{} = ?'.format(column) for column in info)),
+                tuple(info.values()) + (blob_name, blob_name))
+
+    def reserve_sprite(self, blob_name, bucket, slots):
+        """
+        Reserves the next unused slot of the newest sprite sheet of a time bucket for a blob. The slot is assigned to
+        the pictures of the blob once the sprite sheet is written, see sprites_written.
+        A new sprite sheet is started if the newest one is full. Slots are never reserved twice, also if the pictures
+        using them were removed.
+
+        :param str blob_name: The name of the blob.
+        :param str bucket: The time bucket, sprite sheets are named by bucket and a sequence number.
+        :param int slots: The amount of slots per sprite sheet.
+        :return: The sprite sheet and the slot.
+        :rtype: tuple
+        """
+        with self._lock, self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            newest = self._db.execute(
+                'SELECT name, slots FROM sprite_sheets WHERE name > ? AND name < ? ORDER BY name DESC LIMIT 1',
+                (bucket + '-', bucket + '.')).fetchone()
+
+            if newest is None:
+                sheet, slot = '{}-000'.format(bucket), 0
+            elif newest['slots'] < slots:
+                sheet, slot = newest['name'], newest['slots']
+            else:
+                sheet, slot = '{}-{:03d}'.format(bucket, int(newest['name'].rsplit('-', 1)[1]) + 1), 0
+
+            self._db.execute('INSERT OR IGNORE INTO sprite_sheets (name, slots) VALUES (?, 0)', (sheet,))
+            self._db.execute('UPDATE sprite_sheets SET slots = ? WHERE name = ?', (slot + 1, sheet))
+            return sheet, slot
+
+    def sprites_written(self, sheet, cells):
+        """
+        Assigns the cells of a written sprite sheet to the pictures of their blobs. Each write of a sprite sheet gets a
+        new version, which contains all cells of the previous versions.
+
+        :param str sheet: The name of the sprite sheet.
+        :param list cells: The name of the blob and the slot of each cell added by the write.
+        :return: The version of the written sprite sheet.
+        :rtype: int
+        """
+        with self._lock, self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute('UPDATE sprite_sheets SET version = version + 1 WHERE name = ?', (sheet,))
+            version = self._db.execute('SELECT version FROM sprite_sheets WHERE name = ?', (sheet,)).fetchone()[0]
+            self._db.executemany('UPDATE pictures SET sprite = ?, sprite_slot = ?, sprite_version = ? '
+                                 'WHERE blob_name = ? OR (name = ? AND blob_name IS NULL)',
+                                 ((sheet, slot, version, blob_name, blob_name) for blob_name, slot in cells))
+            return version
+
+    def pending_previews(self):
+        """
+        Returns the blobs whose previews were not created yet, e.g. since the server stopped before. Includes the
+        blobs whose raw images were being stored.
+
+        :return: The name, the oldest upload timestamp, the raw extension and the preview status of each blob.
+        :rtype: list
+        """
+        with self._lock:
+            return [dict(row) for row in self._db.execute(
+                'SELECT COALESCE(blob_name, name) AS name, MIN(timestamp) AS timestamp, raw_extension, preview_status '
+                'FROM pictures WHERE preview_status IN (?, ?) GROUP BY COALESCE(blob_name, name) ORDER BY timestamp',
+                (PREVIEW_STORING, PREVIEW_PENDING))]
+
+    def sprite_used(self, sheet):
+        """
+        :param str sheet: The name of a sprite sheet.
+        :return: If any picture uses the sprite sheet.
+        :rtype: bool
+        """
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM pictures WHERE sprite = ? LIMIT 1', (sheet,)).fetchone() is not None
+
+    def find_blob(self, blob_name):
+        """
+        Returns a picture that uses the given blob.
+
+        :param str blob_name: The name of the blob.
+        :return: The picture as dict or None if no picture uses the blob.
+        :rtype: dict
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM pictures WHERE blob_name = ? OR (name = ? AND blob_name IS NULL) '
+                                   'LIMIT 1', (blob_name, blob_name)).fetchone()
+            return dict(row) if row else None
+
+    def get(self, name):
+        """
+        Returns a single picture.
+
+        :param str name: The name of the picture.
+        :return: The picture as dict or None if it doesn't exist.
+        :rtype: dict
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM pictures WHERE name = ?', (name,)).fetchone()
+            return dict(row) if row else None
+
+    def latest(self, limit=None):
+        """
+        Returns the latest pictures.
+
+        :param int limit: The maximum amount of pictures to return. All if not set.
+        :return: The pictures as dicts, newest first.
+        :rtype: list
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT * FROM pictures ORDER BY timestamp DESC, name DESC LIMIT ?',
+                (limit if limit is not None else -1,))
+            return [dict(row) for row in rows]
+
+    def page(self, before=None, after=None, limit=50, camera=None):
+        """
+        Returns a single page of pictures, using (timestamp, name) of pictures as cursor.
+
+        :param tuple before: Cursor to return the pictures older than the given one.
+        :param tuple after: Cursor to return the pictures newer than the given one.
+        :param int limit: The maximum amount of pictures to return.
+        :param str camera: Only return pictures of the given camera.
+        :return: The pictures as dicts (newest first) and if there are more pictures in the requested direction.
+        :rtype: tuple
+        """
+        conditions = []
+        parameters = []
+        order = 'DESC'
+        if after is not None:
+            conditions.append('(timestamp, name) > (?, ?)')
+            parameters.extend(after)
+            order = 'ASC'
+        elif before is not None:
+            conditions.append('(timestamp, name) < (?, ?)')
+            parameters.extend(before)
+
+        if camera is not None:
+            conditions.append('camera = ?')
+            parameters.append(camera)
+
+        query = 'SELECT * FROM pictures {} ORDER BY timestamp {order}, name {order} LIMIT ?'.format(
+            'WHERE ' + ' AND '.join(conditions) if conditions else '', order=order)
+        parameters.append(limit + 1)
+
+        with self._lock:
+            pictures = [dict(row) for row in self._db.execute(query, parameters)]
+
+        more = len(pictures) > limit
+        pictures = pictures[:limit]
+        if after is not None:
+            pictures.reverse()
+
+        return pictures, more
+
+    def oldest(self, limit, before=None, camera=None):
+        """
+        Returns the oldest pictures.
+
+        :param int limit: The maximum amount of pictures to return.
+        :param float before: Only return pictures uploaded before the given timestamp.
+        :param str camera: Only return pictures of the given camera. Use None for all cameras.
+        :return: The pictures as dicts, oldest first.
+        :rtype: list
+        """
+        conditions = []
+        parameters = []
+        if before is not None:
+            conditions.append('timestamp < ?')
+            parameters.append(before)
+
+        if camera is not None:
+            conditions.append('camera = ?')
+            parameters.append(camera)
+
+        query = 'SELECT * FROM pictures {} ORDER BY timestamp ASC, name ASC LIMIT ?'.format(
+            'WHERE ' + ' AND '.join(conditions) if conditions else '')
+        parameters.append(limit)
+
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query, parameters)]
+
+    def remove(self, names):
+        """
+        Removes pictures from the index.
+
+        :param list names: The names of the pictures to remove.
+        """
+        with self._lock, self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            cameras = set()
+            for name in names:
+                row = self._db.execute('SELECT camera FROM pictures WHERE name = ?', (name,)).fetchone()
+                if row is not None and row['camera'] is not None:
+                    cameras.add(row['camera'])
+                self._db.execute('DELETE FROM pictures WHERE name = ?', (name,))
+
+            # Cameras without any pictures left
+            self._db.executemany('DELETE FROM cameras WHERE name = ? AND NOT EXISTS '
+                                 '(SELECT 1 FROM pictures WHERE camera = ?)',
+                                 ((camera, camera) for camera in cameras))
+
+    def last_accepted_frame(self, picture):
+        """
+        Returns the newest picture of the same camera before the given picture, that has a frame hash and is no
+        near duplicate.
+
+        :param dict picture: The picture from the picture index.
+        :return: The picture as dict or None if there is no such picture.
+        :rtype: dict
+        """
+        with self._lock:
+            # Uses the partial index of the accepted frames, without scanning the near duplicates
+            row = self._db.execute(
+                'SELECT * FROM pictures INDEXED BY pictures_accepted_frames '
+                'WHERE camera IS ? AND (timestamp, name) < (?, ?) '
+                'AND frame_hash IS NOT NULL AND near_duplicate_of IS NULL '
+                'ORDER BY timestamp DESC, name DESC LIMIT 1',
+                (picture['camera'], picture['timestamp'], picture['name'])).fetchone()
+            return dict(row) if row else None
+
+    def recompression_candidates(self, extensions, limit):
+        """
+        Returns the oldest pictures with raw images that were not recompressed yet.
+        Pictures with pending previews are skipped, as their raw images are still in use or not stored yet.
+
+        :param list extensions: The extensions of the raw images to recompress.
+        :param int limit: The maximum amount of pictures to return.
+        :return: The pictures as dicts, oldest first.
+        :rtype: list
+        """
+        with self._lock:
+            return [dict(row) for row in self._db.execute(
+                'SELECT * FROM pictures WHERE raw_extension IN ({}) AND original_size IS NULL '
+                'AND preview_status NOT IN (?, ?) ORDER BY timestamp ASC, name ASC LIMIT ?'.format(
+                    ', '.join('?' * len(extensions))),
+                tuple(extensions) + (PREVIEW_STORING, PREVIEW_PENDING, limit))]
+
+    def recompression_savings(self):
+        """
+        :return: The amount of bytes saved by recompressing raw images. Shared blobs are only counted once.
+        :rtype: int
+        """
+        with self._lock:
+            return int(self._db.execute(
+                'SELECT TOTAL(saved) FROM (SELECT MAX(original_size - raw_size) AS saved FROM pictures '
+                'WHERE original_size IS NOT NULL GROUP BY IFNULL(blob_name, name))').fetchone()[0])
+
+    def cameras(self):
+        """
+        :return: The names of all cameras that have pictures in the index.
+        :rtype: list
+        """
+        with self._lock:
+            return [row['name'] for row in self._db.execute('SELECT name FROM cameras ORDER BY name')]
+
+    def count(self):
+        """
+        :return: The amount of pictures in the index.
+        :rtype: int
+        """
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM pictures').fetchone()[0]
+
+    def camera_counts(self):
+        """
+        :return: The amount of pictures by camera. Pictures without camera are counted for None.
+        :rtype: dict
+        """
+        with self._lock:
+            return {row['camera']: row['pictures'] for row in
+                    self._db.execute('SELECT camera, COUNT(*) AS pictures FROM pictures GROUP BY camera')}
+
+    def total_size(self):
+        """
+        :return: The size of all raw images and default previews in bytes. Shared blobs are only counted once.
+        :rtype: int
+        """
+        with self._lock:
+            return int(self._db.execute(
+                'SELECT TOTAL(size) FROM (SELECT MAX(IFNULL(raw_size, 0) + IFNULL(preview_size, 0)) AS size '
+                'FROM pictures GROUP BY IFNULL(blob_name, name))').fetchone()[0])
+
+    def clear(self):
+        """
+        Removes all pictures from the index.
+        """
+        with self._lock, self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute('DELETE FROM pictures')
+            self._db.execute('DELETE FROM cameras')
+
+    def import_directory(self, upload_dir):
+        """
+        Adds all pictures from the given upload directory, e.g. ones uploaded before the index existed.
+        The upload timestamp is taken from the file name.
+
+        :param str upload_dir: The upload directory.
+        """
+        pictures = []
+        for preview in os.listdir(os.path.join(upload_dir, 'previews')):
+            name, extension = os.path.splitext(preview)
+            if extension != '.jpg':
+                # E.g. directories of other preview sizes
+                continue
+
+            raw_file_without_ext = os.path.join(upload_dir, 'raw', name)
+            raw_extension = 'jpg' if os.path.exists(raw_file_without_ext + '.jpg') else 'png'
+
+            try:
+                pictures.append({
+                    'name': name,
+                    'timestamp': float(name) / 100,
+                    'raw_extension': raw_extension,
+                    'raw_size': os.path.getsize(raw_file_without_ext + '.' + raw_extension),
+                    'preview_size': os.path.getsize(os.path.join(upload_dir, 'previews', preview))
+                })
+            except (ValueError, OSError):
+                # Not an uploaded picture or raw image missing
+                continue
+
+        self.add_many(pictures)
+
+    def data_version(self):
+        """
+        :return: A number that changes whenever another connection, e.g. of another server process, modified the index.
+        :rtype: int
+        """
+        with self._lock:
+            return self._db.execute('PRAGMA data_version').fetchone()[0]
+
+    def close(self):
+        """
+        Closes the index.
+        """
+        with self._lock:
+            self._db.close()
+
+
+def init_app(app):
+    """
+    Opens the picture index for the upload directory of the given app.
+
+    :param Flask app: The flask application.
+    """
+    app.extensions['picture_index'] = PictureIndex.for_upload_dir(app.config["UPLOAD_DIR"])
+
+
+def get_picture_index():
+    """
+    :return: The picture index of the current app.
+    :rtype: PictureIndex
+    """
+    return current_app.extensions['picture_index']
@@ -0,0 +1,219 @@
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import closing
+
+from PIL import Image, features
+
+from .config_writer import ProcessLock
+from .layout import find_picture_file, picture_file
+from .storage import CHUNK_SIZE
+
+LOG = logging.getLogger(__name__)
+
+# The supported target formats with the extension used for the raw images. The extensions are also the names of
+# the Pillow features required to write the formats
+FORMATS = {
+    'WEBP': 'webp',
+    'AVIF': 'avif'
+}
+
+# Not known to all python versions
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+
+class RecompressionService:
+    """
+    Rewrites raw images in the background to a more efficient image format, e.g. PNG uploads to WebP.
+    Raw images are only replaced if the recompressed image is smaller. The picture index is updated before the
+    original raw image is deleted, so that the viewer always links an existing file.
+    """
+
+    def __init__(self, storage, index, image_format=None, quality=80, lossless=False, extensions=('png',),
+                 batch_size=10, interval=300, process_lock=None):
+        """
+        Creates a new recompression service. The service is not started automatically.
+
+        :param Storage storage: The storage of the pictures.
+        :param PictureIndex index: The index of the pictures in the storage.
+        :param str image_format: The target format, see FORMATS. None disables the service. The format must be
+                                 supported by the installed Pillow.
+        :param int quality: The quality of the recompressed images, 0 to 100.
+        :param bool lossless: If the images should be compressed lossless.
+        :param list extensions: The extensions of the raw images to recompress.
+        :param int batch_size: The maximum amount of pictures recompressed per run.
+        :param float interval: The time in seconds between two runs of the background thread.
+        :param ProcessLock process_lock: If given, pictures are only recompressed by the process holding the lock.
+        """
+        if image_format is not None and image_format not in FORMATS:
+            raise ValueError("Unsupported recompression format {}".format(image_format))
+        if image_format is not None and not features.check(FORMATS[image_format]):
+            raise ValueError("Recompression format {} is not supported by the installed Pillow".format(image_format))
+
+        self._storage = storage
+        self._index = index
+        self.image_format = image_format
+        self._quality = quality
+        self._lossless = lossless
+        self._extensions = [extension for extension in extensions if extension != FORMATS.get(image_format)]
+        self._batch_size = batch_size
+        self._interval = interval
+        self._process_lock = process_lock
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {
+            'recompressed_pictures': 0,
+            'skipped_pictures': 0
+        }
+
+    @property
+    def enabled(self):
+        """
+        :return: If a target format is configured.
+        :rtype: bool
+        """
+        return self.image_format is not None
+
+    def start(self):
+        """
+        Starts the background thread, if a target format is configured.
+        """
+        if not self.enabled or self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='recompression', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread. A currently recompressed picture is finished first.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._process_lock is not None:
+            self._process_lock.release()
+
+    def _run(self):
+        """
+        The background thread, recompresses a batch of pictures once per interval.
+        """
+        while not self._stopped.wait(self._interval):
+            # Another server process recompresses the pictures
+            if self._process_lock is not None and not self._process_lock.acquire():
+                continue
+
+            try:
+                while self.run_once() == self._batch_size and not self._stopped.is_set():
+                    continue
+            except Exception:
+                LOG.exception("Recompressing raw images failed")
+
+    def run_once(self):
+        """
+        Recompresses a single batch of pictures.
+
+        :return: The amount of processed pictures, including the ones that were not replaced.
+        :rtype: int
+        """
+        pictures = self._index.recompression_candidates(self._extensions, self._batch_size)
+        for picture in pictures:
+            if self._stopped.is_set():
+                break
+            self._recompress(picture)
+
+        return len(pictures)
+
+    def _recompress(self, picture):
+        """
+        Recompresses the raw image of a single picture and all pictures sharing its blob.
+
+        :param dict picture: The picture from the picture index.
+        """
+        blob_name = picture['blob_name'] or picture['name']
+        raw_key = 'raw/' + find_picture_file('raw', blob_name + '.' + picture['raw_extension'], self._storage.exists)
+        extension = FORMATS[self.image_format]
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            raw_image = self._storage.local_path(raw_key)
+            if raw_image is None:
+                raw_image = os.path.join(work_dir, 'raw')
+                with closing(self._storage.open(raw_key)) as stream, open(raw_image, 'wb') as raw_file:
+                    shutil.copyfileobj(stream, raw_file, CHUNK_SIZE)
+
+            original_size = os.path.getsize(raw_image)
+            recompressed_image = os.path.join(work_dir, 'recompressed.' + extension)
+            try:
+                with Image.open(raw_image) as image:
+                    image.save(recompressed_image, self.image_format, quality=self._quality, lossless=self._lossless)
+            except (IOError, ValueError) as error:
+                LOG.warning("Could not recompress %s: %s", raw_key, error)
+                self._skip(blob_name, original_size)
+                return
+
+            size = os.path.getsize(recompressed_image)
+            if size >= original_size:
+                self._skip(blob_name, original_size)
+                return
+
+            self._storage.put_file(picture_file('raw', blob_name, extension), recompressed_image)
+
+        self._index.update_blob(blob_name, raw_extension=extension, raw_size=size, original_size=original_size)
+        self._storage.delete(raw_key)
+
+        with self._lock:
+            self._stats['recompressed_pictures'] += 1
+
+    def _skip(self, blob_name, original_size):
+        """
+        Keeps the original raw image of a blob and excludes it from further recompressions.
+
+        :param str blob_name: The name of the blob.
+        :param int original_size: The size of the raw image.
+        """
+        self._index.update_blob(blob_name, original_size=original_size)
+        with self._lock:
+            self._stats['skipped_pictures'] += 1
+
+    def stats(self):
+        """
+        :return: The configuration, the amount of pictures processed since the server started and the amount of
+                 bytes saved by all recompressed pictures.
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats['format'] = self.image_format
+        stats['quality'] = self._quality
+        stats['lossless'] = self._lossless
+        stats['saved_bytes'] = self._index.recompression_savings()
+        return stats
+
+
+def init_app(app):
+    """
+    Creates and starts the recompression service for the given app. If multiple server processes use the same
+    upload directory, only one of them recompresses the pictures.
+
+    :param Flask app: The flask application.
+    """
+    service = RecompressionService(app.extensions['storage'],
+                                   app.extensions['picture_index'],
+                                   app.config.get("RECOMPRESS_FORMAT"),
+                                   app.config.get("RECOMPRESS_QUALITY", 80),
+                                   app.config.get("RECOMPRESS_LOSSLESS", False),
+                                   app.config.get("RECOMPRESS_EXTENSIONS", ('png',)),
+                                   app.config.get("RECOMPRESS_BATCH_SIZE", 10),
+                                   app.config.get("RECOMPRESS_INTERVAL", 300),
+                                   ProcessLock(os.path.join(app.config["UPLOAD_DIR"], 'recompression.lock')))
+    service.start()
+    app.extensions['recompression'] = service
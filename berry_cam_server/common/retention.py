@@ -0,0 +1,308 @@
+import logging
+import os
+import threading
+import time
+
+from .config_writer import ProcessLock
+
+from .layout import find_picture_file
+from .sprites import sprite_key
+from .thumbnails import PREVIEW_SIZE
+
+LOG = logging.getLogger(__name__)
+
+
+def _picture_files(storage, picture, preview_sizes):
+    """
+    :param Storage storage: The storage of the pictures.
+    :param dict picture: The picture from the picture index.
+    :param list preview_sizes: The sizes of the previews of the picture.
+    :return: The storage keys of all files of the picture blob, i.e. the raw image and all previews.
+    :rtype: list
+    """
+    blob_name = picture['blob_name'] or picture['name']
+    directories = [('raw', blob_name + '.' + picture['raw_extension'])]
+    for size in set(preview_sizes) | {PREVIEW_SIZE}:
+        directories.append(('previews' if size == PREVIEW_SIZE else 'previews/{}'.format(size), blob_name + '.jpg'))
+
+    return [directory + '/' + find_picture_file(directory, file_name, storage.exists)
+            for directory, file_name in directories]
+
+
+def delete_pictures(storage, index, pictures, preview_sizes):
+    """
+    Deletes pictures from the index and the storage.
+    The files of blobs are kept as long as other pictures with the same content use them, sprite sheets as long as
+    they contain previews of other pictures.
+
+    :param Storage storage: The storage of the pictures.
+    :param PictureIndex index: The index of the pictures in the storage.
+    :param list pictures: The pictures from the picture index.
+    :param list preview_sizes: The sizes of the previews of the pictures.
+    :return: The amount of bytes reclaimed.
+    :rtype: int
+    """
+    # Remove from the index first, so that the viewer doesn't show pictures with missing files
+    index.remove([picture['name'] for picture in pictures])
+
+    reclaimed = 0
+    for picture in pictures:
+        if index.find_blob(picture['blob_name'] or picture['name']) is not None:
+            continue
+
+        for file in _picture_files(storage, picture, preview_sizes):
+            reclaimed += storage.delete(file)
+
+    for sheet in {picture['sprite'] for picture in pictures if picture['sprite']}:
+        if not index.sprite_used(sheet):
+            reclaimed += storage.delete(sprite_key(sheet))
+
+    return reclaimed
+
+
+class RetentionService:
+    """
+    Deletes old pictures in the background, according to the configured retention policies:
+    - max_age: Pictures older than the given amount of seconds are deleted.
+    - max_pictures_per_camera: Only the given amount of the newest pictures is kept for each named camera.
+    - max_bytes: The oldest pictures are deleted as long as all pictures take more than the given amount of bytes.
+
+    Pictures are deleted oldest first, in small batches, so that the picture index is only locked for short times.
+    All pictures can also be deleted at once, see start_cleanup.
+    """
+
+    def __init__(self, storage, index, preview_sizes=(PREVIEW_SIZE,), max_age=None, max_bytes=None,
+                 max_pictures_per_camera=None, batch_size=100, interval=60, process_lock=None):
+        """
+        Creates a new retention service. The service is not started automatically.
+
+        :param Storage storage: The storage of the pictures.
+        :param PictureIndex index: The index of the pictures in the storage.
+        :param list preview_sizes: The sizes of the previews to delete together with the raw images.
+        :param int max_age: The maximum age of pictures in seconds. Unlimited if None.
+        :param int max_bytes: The maximum size of all pictures in bytes. Unlimited if None.
+        :param int max_pictures_per_camera: The maximum amount of pictures per camera. Unlimited if None.
+        :param int batch_size: The maximum amount of pictures deleted at once.
+        :param float interval: The time in seconds between two runs of the background thread.
+        :param ProcessLock process_lock: If given, the policies are only applied by the process holding the lock.
+        """
+        self._storage = storage
+        self._index = index
+        self._preview_sizes = set(preview_sizes) | {PREVIEW_SIZE}
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.max_pictures_per_camera = max_pictures_per_camera
+        self._batch_size = batch_size
+        self._interval = interval
+        self._process_lock = process_lock
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._cleanup_thread = None
+        self._stats = {
+            'runs': 0,
+            'last_run': None,
+            'deleted_pictures': 0,
+            'reclaimed_bytes': 0
+        }
+
+    @property
+    def enabled(self):
+        """
+        :return: If any retention policy is configured.
+        :rtype: bool
+        """
+        return any(limit is not None for limit in (self.max_age, self.max_bytes, self.max_pictures_per_camera))
+
+    def start(self):
+        """
+        Starts the background thread, if any retention policy is configured.
+        """
+        if not self.enabled or self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background threads. A currently running batch is finished first.
+        """
+        self._stopped.set()
+        for thread in (self._thread, self._cleanup_thread):
+            if thread is not None:
+                thread.join()
+        self._thread = None
+        self._cleanup_thread = None
+
+        if self._process_lock is not None:
+            self._process_lock.release()
+
+    def _run(self):
+        """
+        The background thread, applies the retention policies once per interval.
+        """
+        while not self._stopped.wait(self._interval):
+            # Another server process applies the policies
+            if self._process_lock is not None and not self._process_lock.acquire():
+                continue
+
+            try:
+                self.run_once()
+            except Exception:
+                LOG.exception("Applying the retention policies failed")
+
+    def start_cleanup(self):
+        """
+        Deletes all pictures uploaded until now in a background thread, in batches like the retention policies.
+        Pictures uploaded in the meantime are kept.
+
+        :return: The thread deleting the pictures.
+        :rtype: threading.Thread
+        """
+        with self._lock:
+            if self._cleanup_thread is None or not self._cleanup_thread.is_alive():
+                self._cleanup_thread = threading.Thread(target=self._cleanup, args=(time.time(),),
+                                                        name='cleanup', daemon=True)
+                self._cleanup_thread.start()
+
+            return self._cleanup_thread
+
+    def _cleanup(self, before):
+        """
+        The background thread of start_cleanup.
+
+        :param float before: Pictures uploaded before this timestamp are deleted.
+        """
+        deleted = 0
+        try:
+            while not self._stopped.is_set():
+                pictures = self._index.oldest(self._batch_size, before=before)
+                if not pictures:
+                    break
+
+                deleted += self._delete(pictures)
+        except Exception:
+            LOG.exception("Deleting all pictures failed")
+
+        LOG.info("Cleanup deleted %d pictures", deleted)
+
+    def run_once(self):
+        """
+        Applies all retention policies once.
+
+        :return: The amount of deleted pictures.
+        :rtype: int
+        """
+        deleted = 0
+        for next_batch in (self._expired, self._over_camera_limit, self._over_size_limit):
+            while not self._stopped.is_set():
+                pictures = next_batch()
+                if not pictures:
+                    break
+
+                deleted += self._delete(pictures)
+
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['last_run'] = time.time()
+
+        if deleted:
+            LOG.info("Retention policies deleted %d pictures", deleted)
+
+        return deleted
+
+    def _expired(self):
+        """
+        :return: The next batch of pictures older than the maximum age.
+        :rtype: list
+        """
+        if self.max_age is None:
+            return []
+
+        return self._index.oldest(self._batch_size, before=time.time() - self.max_age)
+
+    def _over_camera_limit(self):
+        """
+        :return: The next batch of pictures of cameras with more pictures than allowed.
+        :rtype: list
+        """
+        if self.max_pictures_per_camera is None:
+            return []
+
+        for camera, count in self._index.camera_counts().items():
+            # Pictures uploaded without camera name are not limited
+            if camera is not None and count > self.max_pictures_per_camera:
+                return self._index.oldest(min(self._batch_size, count - self.max_pictures_per_camera), camera=camera)
+
+        return []
+
+    def _over_size_limit(self):
+        """
+        :return: The next batch of pictures to delete to get below the maximum size of all pictures.
+        :rtype: list
+        """
+        if self.max_bytes is None:
+            return []
+
+        excess = self._index.total_size() - self.max_bytes
+        pictures = []
+        for picture in self._index.oldest(self._batch_size) if excess > 0 else []:
+            pictures.append(picture)
+            excess -= (picture['raw_size'] or 0) + (picture['preview_size'] or 0)
+            if excess <= 0:
+                break
+
+        return pictures
+
+    def _delete(self, pictures):
+        """
+        Deletes the given pictures, see delete_pictures.
+
+        :param list pictures: The pictures from the picture index.
+        :return: The amount of deleted pictures.
+        :rtype: int
+        """
+        reclaimed = delete_pictures(self._storage, self._index, pictures, self._preview_sizes)
+
+        with self._lock:
+            self._stats['deleted_pictures'] += len(pictures)
+            self._stats['reclaimed_bytes'] += reclaimed
+
+        return len(pictures)
+
+    def stats(self):
+        """
+        :return: The configured policies and the amount of pictures and bytes deleted since the server started.
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats['policies'] = {
+            'max_age': self.max_age,
+            'max_bytes': self.max_bytes,
+            'max_pictures_per_camera': self.max_pictures_per_camera
+        }
+        return stats
+
+
+def init_app(app):
+    """
+    Creates and starts the retention service for the given app. If multiple server processes use the same upload
+    directory, only one of them applies the retention policies.
+
+    :param Flask app: The flask application.
+    """
+    service = RetentionService(app.extensions['storage'],
+                               app.extensions['picture_index'],
+                               app.extensions['thumbnails'].sizes,
+                               app.config.get("RETENTION_MAX_AGE"),
+                               app.config.get("RETENTION_MAX_BYTES"),
+                               app.config.get("RETENTION_MAX_PICTURES_PER_CAMERA"),
+                               app.config.get("RETENTION_BATCH_SIZE", 100),
+                               app.config.get("RETENTION_INTERVAL", 60),
+                               ProcessLock(os.path.join(app.config["UPLOAD_DIR"], 'retention.lock')))
+    service.start()
+    app.extensions['retention'] = service
@@ -0,0 +1,172 @@
+import atexit
+import io
+import logging
+import os
+import tempfile
+import threading
+from contextlib import closing
+
+from PIL import Image
+
+from .config_writer import file_lock
+from .thumbnails import PREVIEW_SIZE
+
+LOG = logging.getLogger(__name__)
+
+# The width and height of a cell of a sprite sheet, each cell contains a single default sized preview
+CELL_SIZE = PREVIEW_SIZE
+
+# The amount of cells per row and per column of a sprite sheet
+GRID_SIZE = 10
+
+# The length of the time buckets in seconds. The previews of the pictures uploaded in the same bucket are combined
+# into the same sprite sheets, so that the pictures of a viewer page are usually in one or two sprite sheets.
+BUCKET_LENGTH = 60 * 60
+
+# The color of the cell areas not covered by the previews
+BACKGROUND_COLOR = (255, 255, 255)
+
+
+def cell_position(slot):
+    """
+    :param int slot: The slot of a preview in its sprite sheet.
+    :return: The x and y position of the top left corner of the cell in pixels.
+    :rtype: tuple
+    """
+    return (slot % GRID_SIZE) * CELL_SIZE, (slot // GRID_SIZE) * CELL_SIZE
+
+
+def sprite_key(sheet):
+    """
+    :param str sheet: The name of a sprite sheet.
+    :return: The storage key of the sprite sheet.
+    :rtype: str
+    """
+    return 'sprites/{}.png'.format(sheet)
+
+
+class SpriteSheets:
+    """
+    Combines the default sized previews into sprite sheets, so that the viewer can show many previews with a single
+    image request. Previews are added to the sprite sheets once they are created, the cells of a sprite sheet are
+    filled in order and never change afterwards. The position of a preview is stored in the picture index once the
+    sprite sheet containing it is written, until then the viewer shows the preview itself.
+    Sprite sheets are stored losslessly, since they are decoded and encoded again for each write. To write each sheet
+    less often, added previews are collected for a short delay and written together.
+    """
+
+    def __init__(self, storage, index, lock_file, delay=1.0):
+        """
+        Creates a new sprite sheet builder.
+
+        :param Storage storage: The storage of the pictures.
+        :param PictureIndex index: The index of the pictures in the storage.
+        :param str lock_file: A file used to lock sprite sheet updates across processes.
+        :param float delay: The time in seconds added previews are collected before the sprite sheets are written.
+                            With 0, the sprite sheets are written directly.
+        """
+        self._storage = storage
+        self._index = index
+        self._lock_file = lock_file
+        self.delay = delay
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flush_timer = None
+
+        atexit.register(self.flush)
+
+    def add(self, name, timestamp, preview_image):
+        """
+        Adds the preview of a picture to the sprite sheet of its time bucket.
+
+        :param str name: The name of the picture blob.
+        :param float timestamp: The upload timestamp of the picture.
+        :param str preview_image: The default sized preview image file. Can be removed once the call returned.
+        :return: The sprite sheet and the slot of the preview or None if the picture doesn't exist anymore.
+        :rtype: tuple
+        """
+        picture = self._index.find_blob(name)
+        if picture is None:
+            return None
+        if picture['sprite'] is not None:
+            # Already added, e.g. since the previews were created again
+            return picture['sprite'], picture['sprite_slot']
+
+        with Image.open(preview_image) as preview:
+            preview = preview.convert('RGB')
+
+        sheet, slot = self._index.reserve_sprite(name, str(int(timestamp // BUCKET_LENGTH)), GRID_SIZE * GRID_SIZE)
+        with self._lock:
+            self._pending.setdefault(sheet, []).append((name, slot, preview))
+            if self.delay and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.delay, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+        if not self.delay:
+            self.flush()
+
+        return sheet, slot
+
+    def flush(self):
+        """
+        Writes all added previews to their sprite sheets. Each sprite sheet is written once.
+        """
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            pending, self._pending = self._pending, {}
+
+        for sheet, cells in pending.items():
+            try:
+                self._write(sheet, cells)
+            except Exception:
+                LOG.exception("Writing sprite sheet %s failed", sheet)
+
+    def _write(self, sheet, cells):
+        """
+        Adds previews to a sprite sheet and assigns their cells to the pictures once the sheet is written.
+
+        :param str sheet: The name of the sprite sheet.
+        :param list cells: The name of the blob, the slot and the preview image of each added preview.
+        """
+        with file_lock(self._lock_file):
+            key = sprite_key(sheet)
+            if not self._storage.exists(key):
+                sprite_sheet = Image.new('RGB', (GRID_SIZE * CELL_SIZE, GRID_SIZE * CELL_SIZE), BACKGROUND_COLOR)
+            else:
+                with closing(self._storage.open(key)) as stream:
+                    sprite_sheet = Image.open(io.BytesIO(stream.read()))
+                    sprite_sheet.load()
+
+            for _, slot, preview in cells:
+                x, y = cell_position(slot)
+                sprite_sheet.paste(preview,
+                                   (x + (CELL_SIZE - preview.width) // 2, y + (CELL_SIZE - preview.height) // 2))
+
+            with tempfile.TemporaryDirectory() as work_dir:
+                sprite_file = os.path.join(work_dir, 'sprite.png')
+                # Fast compression, the sheet is encoded again for each write
+                sprite_sheet.save(sprite_file, 'PNG', compress_level=1)
+                self._storage.put_file(key, sprite_file)
+
+            # Only written cells are used by the viewer
+            self._index.sprites_written(sheet, [(name, slot) for name, slot, _ in cells])
+
+
+def init_app(app):
+    """
+    Creates the sprite sheet builder for the given app, if enabled by SPRITE_SHEETS (default). Added previews are
+    written to the sprite sheets after SPRITE_SHEET_DELAY seconds (default 1).
+
+    :param Flask app: The flask application.
+    """
+    app.extensions['sprites'] = None
+    if app.config.get("SPRITE_SHEETS", True):
+        app.extensions['sprites'] = SpriteSheets(app.extensions['storage'],
+                                                 app.extensions['picture_index'],
+                                                 os.path.join(app.config["UPLOAD_DIR"], 'sprites.lock'),
+                                                 app.config.get("SPRITE_SHEET_DELAY", 1.0))
@@ -0,0 +1,376 @@
+import abc
+import errno
+import os
+import posixpath
+import shutil
+import tempfile
+
+from flask import current_app
+from werkzeug.security import safe_join
+
+# The size of the chunks used to copy, stream and upload files
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class Storage(abc.ABC):
+    """
+    Interface of the storage backends for raw images and previews.
+
+    Files are addressed by keys, which are paths relative to the storage root using '/' as separator,
+    e.g. "raw/2020/01/10/157864380512-front-000.jpg". Files are copied in chunks of CHUNK_SIZE, they are never
+    loaded into memory as a whole.
+    """
+
+    @abc.abstractmethod
+    def save(self, key, stream):
+        """
+        Stores a file. An existing file with the same key is replaced.
+
+        :param str key: The key of the file.
+        :param stream: A readable binary file object with the file content.
+        :return: The size of the stored file in bytes.
+        :rtype: int
+        """
+
+    def put_file(self, key, file):
+        """
+        Moves a local file into the storage. The local file is removed.
+
+        :param str key: The key of the file.
+        :param str file: The local file.
+        :return: The size of the stored file in bytes.
+        :rtype: int
+        """
+        with open(file, 'rb') as stream:
+            size = self.save(key, stream)
+
+        os.remove(file)
+        return size
+
+    @abc.abstractmethod
+    def open(self, key):
+        """
+        Opens a stored file for reading.
+
+        :param str key: The key of the file.
+        :return: A readable binary file object. Must be closed by the caller.
+        :raises FileNotFoundError: If there is no file with the given key.
+        """
+
+    def stream(self, key, chunk_size=CHUNK_SIZE):
+        """
+        Reads a stored file in chunks, e.g. to send it in a response.
+
+        :param str key: The key of the file.
+        :param int chunk_size: The maximum size of the chunks.
+        :return: A generator of the file content chunks.
+        :raises FileNotFoundError: If there is no file with the given key.
+        """
+        stream = self.open(key)
+
+        def chunks():
+            with stream:
+                chunk = stream.read(chunk_size)
+                while chunk:
+                    yield chunk
+                    chunk = stream.read(chunk_size)
+
+        return chunks()
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """
+        Deletes a stored file.
+
+        :param str key: The key of the file.
+        :return: The size of the deleted file in bytes, 0 if there was no file with the given key.
+        :rtype: int
+        """
+
+    @abc.abstractmethod
+    def list(self, prefix):
+        """
+        Lists the stored files in a directory, including all sub directories.
+
+        :param str prefix: The directory, e.g. "raw".
+        :return: A generator of the keys of the files.
+        """
+
+    @abc.abstractmethod
+    def exists(self, key):
+        """
+        :param str key: The key of the file.
+        :return: If a file with the given key is stored.
+        :rtype: bool
+        """
+
+    def local_path(self, key):
+        """
+        Returns the path of a file (or directory) on the local file system, e.g. to pass it to worker processes.
+
+        :param str key: The key of the file.
+        :return: The path or None if the storage doesn't store files on the local file system.
+        :rtype: str
+        """
+        return None
+
+
+class FileSystemStorage(Storage):
+    """
+    Stores the files in a directory on the local file system.
+    """
+
+    def __init__(self, base_dir):
+        """
+        Creates a new file system storage.
+
+        :param str base_dir: The directory to store the files in.
+        """
+        self._base_dir = base_dir
+
+    def _path(self, key):
+        """
+        :param str key: The key of a file.
+        :return: The path of the file.
+        :rtype: str
+        :raises FileNotFoundError: If the key points outside of the base directory.
+        """
+        path = safe_join(self._base_dir, key)
+        if path is None:
+            raise FileNotFoundError("Invalid storage key {}".format(key))
+
+        return path
+
+    def save(self, key, stream):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so that partially written files are never visible
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', delete=False) as file:
+            try:
+                shutil.copyfileobj(stream, file, CHUNK_SIZE)
+                file.flush()
+                os.fsync(file.fileno())
+            except BaseException:
+                os.remove(file.name)
+                raise
+
+        os.replace(file.name, path)
+        return os.path.getsize(path)
+
+    def put_file(self, key, file):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(file, path)
+        except OSError as error:
+            # E.g. files in a temporary directory on tmpfs, these are copied
+            if error.errno != errno.EXDEV:
+                raise
+            return super().put_file(key, file)
+
+        return os.path.getsize(path)
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def delete(self, key):
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+
+        # Remove empty shard directories, but keep the top level directories like raw and previews
+        top_level_dir = os.path.join(self._base_dir, key.split('/', 1)[0])
+        directory = os.path.dirname(path)
+        while directory.startswith(top_level_dir + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+        return size
+
+    def list(self, prefix):
+        directory = self._path(prefix)
+        for root, _, files in os.walk(directory):
+            for file in files:
+                if not file.startswith('.'):
+                    yield os.path.relpath(os.path.join(root, file), self._base_dir).replace(os.sep, '/')
+
+    def exists(self, key):
+        try:
+            return os.path.isfile(self._path(key))
+        except FileNotFoundError:
+            return False
+
+    def local_path(self, key):
+        return self._path(key)
+
+
+class S3Storage(Storage):
+    """
+    Stores the files in a bucket of a S3 compatible object store.
+    Uses a boto3 compatible client, e.g. boto3.client('s3', endpoint_url=...).
+    Files larger than CHUNK_SIZE are uploaded with multipart uploads.
+    """
+
+    # The error codes of the client errors for missing objects
+    NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+    def __init__(self, client, bucket, prefix=''):
+        """
+        Creates a new S3 storage.
+
+        :param client: The S3 client.
+        :param str bucket: The bucket to store the files in.
+        :param str prefix: Prefix for all object keys, e.g. to share a bucket.
+        """
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def _key(self, key):
+        """
+        :param str key: The key of a file.
+        :return: The object key of the file.
+        :rtype: str
+        :raises FileNotFoundError: If the key contains relative path components.
+        """
+        if key.startswith('/') or '..' in key.split('/'):
+            raise FileNotFoundError("Invalid storage key {}".format(key))
+
+        return posixpath.join(self._prefix, key) if self._prefix else key
+
+    def _not_found(self, error):
+        """
+        :param Exception error: An error raised by the client.
+        :return: If the error was raised because of a missing object.
+        :rtype: bool
+        """
+        return str(getattr(error, 'response', {}).get('Error', {}).get('Code')) in self.NOT_FOUND_CODES
+
+    def save(self, key, stream):
+        object_key = self._key(key)
+
+        first_chunk = stream.read(CHUNK_SIZE)
+        chunk = stream.read(CHUNK_SIZE) if len(first_chunk) == CHUNK_SIZE else b''
+        if not chunk:
+            self._client.put_object(Bucket=self._bucket, Key=object_key, Body=first_chunk)
+            return len(first_chunk)
+
+        upload_id = self._client.create_multipart_upload(Bucket=self._bucket, Key=object_key)['UploadId']
+        parts = []
+        size = 0
+        try:
+            for part in (first_chunk, chunk):
+                size += len(part)
+                parts.append(self._upload_part(object_key, upload_id, len(parts) + 1, part))
+
+            chunk = stream.read(CHUNK_SIZE)
+            while chunk:
+                size += len(chunk)
+                parts.append(self._upload_part(object_key, upload_id, len(parts) + 1, chunk))
+                chunk = stream.read(CHUNK_SIZE)
+
+            self._client.complete_multipart_upload(Bucket=self._bucket, Key=object_key, UploadId=upload_id,
+                                                   MultipartUpload={'Parts': parts})
+        except BaseException:
+            self._client.abort_multipart_upload(Bucket=self._bucket, Key=object_key, UploadId=upload_id)
+            raise
+
+        return size
+
+    def _upload_part(self, object_key, upload_id, part_number, data):
+        """
+        Uploads a single part of a multipart upload.
+
+        :return: The part information for completing the upload.
+        :rtype: dict
+        """
+        response = self._client.upload_part(Bucket=self._bucket, Key=object_key, UploadId=upload_id,
+                                            PartNumber=part_number, Body=data)
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def open(self, key):
+        try:
+            return self._client.get_object(Bucket=self._bucket, Key=self._key(key))['Body']
+        except Exception as error:
+            if self._not_found(error):
+                raise FileNotFoundError(key) from error
+            raise
+
+    def _head(self, key):
+        """
+        :param str key: The key of a file.
+        :return: The object metadata or None if the object doesn't exist.
+        :rtype: dict
+        """
+        try:
+            return self._client.head_object(Bucket=self._bucket, Key=self._key(key))
+        except FileNotFoundError:
+            return None
+        except Exception as error:
+            if self._not_found(error):
+                return None
+            raise
+
+    def delete(self, key):
+        head = self._head(key)
+        if head is None:
+            return 0
+
+        self._client.delete_object(Bucket=self._bucket, Key=self._key(key))
+        return head['ContentLength']
+
+    def list(self, prefix):
+        object_prefix = self._key(prefix.rstrip('/') + '/')
+        arguments = {'Bucket': self._bucket, 'Prefix': object_prefix}
+        while True:
+            response = self._client.list_objects_v2(**arguments)
+            for content in response.get('Contents', []):
+                yield content['Key'][len(self._prefix) + 1 if self._prefix else 0:]
+
+            if not response.get('IsTruncated'):
+                break
+            arguments['ContinuationToken'] = response['NextContinuationToken']
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+
+def init_app(app):
+    """
+    Creates the storage backend for the given app, configured by STORAGE_BACKEND:
+    - "filesystem" (default): Stores the files in the upload directory.
+    - "s3": Stores the files in the bucket S3_BUCKET, using boto3. The endpoint (e.g. of a local object store)
+            can be set with S3_ENDPOINT_URL, the credentials with S3_ACCESS_KEY and S3_SECRET_KEY.
+            Otherwise the default boto3 configuration is used.
+
+    :param Flask app: The flask application.
+    """
+    backend = app.config.get("STORAGE_BACKEND", "filesystem")
+    if backend == "filesystem":
+        app.extensions['storage'] = FileSystemStorage(app.config["UPLOAD_DIR"])
+    elif backend == "s3":
+        # Optional dependency, only needed for this backend
+        import boto3
+
+        client = boto3.client('s3',
+                              endpoint_url=app.config.get("S3_ENDPOINT_URL"),
+                              aws_access_key_id=app.config.get("S3_ACCESS_KEY"),
+                              aws_secret_access_key=app.config.get("S3_SECRET_KEY"))
+        app.extensions['storage'] = S3Storage(client, app.config["S3_BUCKET"], app.config.get("S3_PREFIX", ''))
+    else:
+        raise ValueError("Unknown storage backend {}".format(backend))
+
+
+def get_storage():
+    """
+    :return: The storage backend of the current app.
+    :rtype: Storage
+    """
+    return current_app.extensions['storage']
@@ -0,0 +1,304 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from .layout import picture_file
+from .metrics import UPLOAD_DURATION
+from .timing import span
+
+LOG = logging.getLogger(__name__)
+
+# The maximum width and height of preview images
+PREVIEW_SIZE = 128
+
+# The preview sizes created by default, larger previews are used for high resolution screens and as large view
+DEFAULT_PREVIEW_SIZES = (PREVIEW_SIZE, 480, 1280)
+
+# The preview sizes created directly on upload. Larger previews would need a decode close to the native resolution,
+# so they are created by the viewer on first access
+DEFAULT_INGEST_PREVIEW_SIZES = (PREVIEW_SIZE, 480)
+
+
+def load_scaled(image, size, reducing_gap=2):
+    """
+    Decodes an image at roughly the requested size instead of its native resolution.
+    JPEG images are decoded with DCT scaling (draft mode), other images are reduced by an integer factor right
+    after decoding. The result stays at least reducing_gap times larger than the requested size, so that the final
+    resize has enough data for a good quality.
+
+    :param Image image: The opened, not yet loaded image.
+    :param int size: The maximum width and height of the final image.
+    :param int reducing_gap: How much larger than the requested size the result should at least be.
+    :return: The decoded image. Might be a new image object.
+    :rtype: Image
+    """
+    target = size * reducing_gap
+    if image.format == 'JPEG':
+        image.draft('RGB', (target, target))
+
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    factor = max(image.size) // target
+    if factor > 1:
+        return image.reduce(factor)
+
+    image.load()
+    return image
+
+
+def preview_file(previews_dir, name, size=PREVIEW_SIZE):
+    """
+    Returns the file of a preview image. The default sized previews are stored directly in the previews directory,
+    all other sizes in a sub directory named by the size. Both use the sharded layout, see layout.picture_file.
+
+    :param str previews_dir: The previews directory.
+    :param str name: The name of the picture.
+    :param int size: The size of the preview.
+    :return: The preview file.
+    :rtype: str
+    """
+    if size == PREVIEW_SIZE:
+        return picture_file(previews_dir, name, 'jpg')
+
+    return picture_file(os.path.join(previews_dir, str(size)), name, 'jpg')
+
+
+def create_previews(raw_image, previews_dir, name, sizes=(PREVIEW_SIZE,)):
+    """
+    Creates the preview images in all given sizes for a raw image. Runs in the worker processes.
+    The raw image is only decoded once, the previews are created from largest to smallest.
+    Previews are written to temporary files first, so that partially written previews are never visible.
+
+    :param str raw_image: The raw image file.
+    :param str previews_dir: The previews directory.
+    :param str name: The name of the picture.
+    :param list sizes: The maximum width and height of the previews to create.
+    :return: The file sizes of the created previews in bytes by preview size.
+    :rtype: dict
+    """
+    file_sizes = {}
+    with Image.open(raw_image) as image:
+        thumbnail = load_scaled(image, max(sizes))
+        if thumbnail.mode not in ('RGB', 'L'):
+            thumbnail = thumbnail.convert('RGB')
+
+        for size in sorted(sizes, reverse=True):
+            thumbnail.thumbnail((size, size), reducing_gap=None)
+
+            preview_image = preview_file(previews_dir, name, size)
+            os.makedirs(os.path.dirname(preview_image), exist_ok=True)
+            # The same preview might be created concurrently, e.g. on first access by several requests
+            fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(preview_image), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    thumbnail.save(file, "JPEG")
+                os.replace(temp_file, preview_image)
+            except BaseException:
+                os.remove(temp_file)
+                raise
+            file_sizes[size] = os.path.getsize(preview_image)
+
+    return file_sizes
+
+
+class ThumbnailService:
+    """
+    Creates the preview images of uploaded pictures in a pool of worker processes.
+
+    Jobs are queued in a bounded queue, if the queue is full, new jobs block until a job finished.
+    Failed jobs are retried, if a worker process died, the pool is replaced by a new one. The callbacks of finished
+    jobs run in a pool of threads, so that slow callbacks don't delay other jobs.
+    With zero workers, previews are created and the callbacks are called directly in the calling thread.
+    """
+
+    def __init__(self, workers=None, queue_size=64, retries=2, sizes=(PREVIEW_SIZE,), ingest_sizes=None,
+                 callback_threads=4):
+        """
+        Creates a new thumbnail service.
+
+        :param int workers: The amount of worker processes. Defaults to the amount of cpus, 0 disables the pool.
+        :param int queue_size: The maximum amount of queued and running jobs.
+        :param int retries: How often failed jobs are retried.
+        :param list sizes: The preview sizes available. The default preview size is always available.
+        :param list ingest_sizes: The preview sizes created for each upload, all other sizes are created on first
+                                  access. Defaults to all sizes. The default preview size is always created.
+        :param int callback_threads: The amount of threads that call the callbacks of finished jobs.
+        """
+        self.retries = retries
+        self.sizes = tuple(sorted(set(sizes) | {PREVIEW_SIZE}))
+        self.ingest_sizes = self.sizes if ingest_sizes is None else \
+            tuple(sorted((set(ingest_sizes) & set(self.sizes)) | {PREVIEW_SIZE}))
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._workers = workers
+        self._executor_lock = threading.Lock()
+        self._executor = None
+        self._callbacks = None
+        if workers != 0:
+            self._executor = self._create_executor()
+            self._callbacks = ThreadPoolExecutor(max_workers=callback_threads, thread_name_prefix='thumbnail-callback')
+
+        self._idle = threading.Condition()
+        self._running = 0
+
+    def submit(self, raw_image, previews_dir, name, callback):
+        """
+        Queues the creation of the preview images of a picture in the ingest sizes. Blocks if the queue is full.
+
+        :param str raw_image: The raw image file.
+        :param str previews_dir: The previews directory.
+        :param str name: The name of the picture.
+        :param function callback: Called with the preview file sizes by preview size and error (None on success)
+                                  once the job finished.
+        """
+        start = time.perf_counter()
+        self._slots.acquire()
+        with self._idle:
+            self._running += 1
+
+        def timed_callback(result, error):
+            UPLOAD_DURATION.labels('thumbnail').observe(time.perf_counter() - start)
+            callback(result, error)
+
+        try:
+            self._run((raw_image, previews_dir, name, self.ingest_sizes), timed_callback, 0)
+        except BaseException:
+            self._release()
+            raise
+
+    def _create_executor(self):
+        """
+        :return: A new pool of worker processes.
+        :rtype: ProcessPoolExecutor
+        """
+        return ProcessPoolExecutor(max_workers=self._workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _replace_broken_executor(self, executor):
+        """
+        Replaces a pool of worker processes that is broken, e.g. since a worker process was killed.
+
+        :param ProcessPoolExecutor executor: The broken pool. Not replaced if it was already replaced.
+        """
+        with self._executor_lock:
+            if self._executor is executor:
+                LOG.warning("Thumbnail worker pool is broken, starting a new one")
+                self._executor = self._create_executor()
+
+        executor.shutdown(wait=False)
+
+    def _run(self, job, callback, attempt):
+        """
+        Runs a single attempt of a job.
+
+        :param tuple job: The arguments for create_previews.
+        :param function callback: The callback of the job.
+        :param int attempt: The attempt, 0 for the first one.
+        """
+        if self._executor is None:
+            try:
+                with span('pillow'):
+                    result = create_previews(*job)
+            except Exception as error:
+                self._failed(job, callback, attempt, error)
+            else:
+                self._finished(callback, result, None)
+            return
+
+        def completed(future):
+            error = future.exception()
+            if error:
+                self._failed(job, callback, attempt, error)
+            else:
+                self._finished(callback, future.result(), None)
+
+        def done(future):
+            # Runs in the thread of the worker pool that collects all results, so the callbacks are handed over
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._replace_broken_executor(executor)
+            self._callbacks.submit(completed, future)
+
+        with self._executor_lock:
+            executor = self._executor
+
+        try:
+            future = executor.submit(create_previews, *job)
+        except BrokenProcessPool as error:
+            self._replace_broken_executor(executor)
+            self._callbacks.submit(self._failed, job, callback, attempt, error)
+            return
+
+        future.add_done_callback(done)
+
+    def _failed(self, job, callback, attempt, error):
+        """
+        Retries a failed job or finishes it with the error if there are no retries left.
+        """
+        raw_image = job[0]
+        if attempt < self.retries:
+            LOG.warning("Could not create preview for %s, retrying: %s", raw_image, error)
+            self._run(job, callback, attempt + 1)
+        else:
+            LOG.error("Could not create preview for %s: %s", raw_image, error)
+            self._finished(callback, None, error)
+
+    def _finished(self, callback, result, error):
+        """
+        Calls the callback of a finished job and frees its queue slot.
+        """
+        try:
+            callback(result, error)
+        except Exception:
+            LOG.exception("Thumbnail callback failed")
+        finally:
+            self._release()
+
+    def _release(self):
+        """
+        Frees the queue slot of a finished job.
+        """
+        self._slots.release()
+        with self._idle:
+            self._running -= 1
+            self._idle.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Waits until all queued jobs finished.
+
+        :param float timeout: The maximum time to wait in seconds.
+        :return: True if all jobs finished, False on timeout.
+        :rtype: bool
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._running == 0, timeout)
+
+    def shutdown(self):
+        """
+        Waits for all queued jobs and stops the worker processes.
+        """
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._callbacks.shutdown()
+
+
+def init_app(app):
+    """
+    Creates the thumbnail service for the given app.
+
+    :param Flask app: The flask application.
+    """
+    app.extensions['thumbnails'] = ThumbnailService(
+        app.config.get("THUMBNAIL_WORKERS"),
+        app.config.get("THUMBNAIL_QUEUE_SIZE", 64),
+        app.config.get("THUMBNAIL_RETRIES", 2),
+        app.config.get("PREVIEW_SIZES", DEFAULT_PREVIEW_SIZES),
+        app.config.get("INGEST_PREVIEW_SIZES", DEFAULT_INGEST_PREVIEW_SIZES),
+        app.config.get("THUMBNAIL_CALLBACK_THREADS", 4))
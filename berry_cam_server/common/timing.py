@@ -0,0 +1,98 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request, signals
+
+LOG = logging.getLogger(__name__)
+
+
+@contextmanager
+def span(name):
+    """
+    Measures the duration of the with block as part of the current request, see init_app.
+    Spans with the same name are summed up, spans may also be nested, e.g. config reads during authentication.
+    Outside of requests, e.g. in background threads, nothing is measured.
+
+    :param str name: The name of the span.
+    """
+    spans = g.get('timing_spans') if has_app_context() else None
+    if spans is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans[name] = spans.get(name, 0) + time.perf_counter() - start
+
+
+def _start_request():
+    """
+    Starts the measurement of a request.
+    """
+    g.timing_start = time.perf_counter()
+    g.timing_spans = {}
+
+
+def _template_started(sender, template, context, **extra):
+    """
+    Starts the measurement of a template rendering.
+    """
+    g.timing_template_start = time.perf_counter()
+
+
+def _template_rendered(sender, template, context, **extra):
+    """
+    Adds the rendering of a template to the spans of the request.
+    """
+    start = g.pop('timing_template_start', None)
+    spans = g.get('timing_spans')
+    if start is not None and spans is not None:
+        spans['template'] = spans.get('template', 0) + time.perf_counter() - start
+
+
+def _finish_request(response):
+    """
+    Adds the spans of a request as Server-Timing header and logs slow requests.
+
+    :param Response response: The response of the request.
+    :return: The response.
+    :rtype: Response
+    """
+    spans = g.pop('timing_spans', None)
+    if spans is None:
+        return response
+
+    total = time.perf_counter() - g.pop('timing_start')
+    spans['total'] = total
+    breakdown = ', '.join('{};dur={:.1f}'.format(name, duration * 1000) for name, duration in spans.items())
+    response.headers.add('Server-Timing', breakdown)
+
+    slow_request_threshold = current_app.config.get("SLOW_REQUEST_THRESHOLD", 1.0)
+    if slow_request_threshold is not None and total > slow_request_threshold:
+        LOG.warning("Slow request %s %s took %.0f ms: %s", request.method, request.path, total * 1000, breakdown)
+
+    return response
+
+
+def init_app(app):
+    """
+    Measures the spans of all requests of the given app, unless disabled by SERVER_TIMING.
+    The spans are sent as Server-Timing header, requests slower than SLOW_REQUEST_THRESHOLD seconds (default 1) are
+    logged with their spans, None disables the log. Must be called before the blueprints are registered, so that
+    the measurement includes their request hooks.
+
+    :param Flask app: The flask application.
+    """
+    if not app.config.get("SERVER_TIMING", True):
+        return
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    # Template rendering can only be measured with blinker installed
+    if signals.signals_available:
+        signals.before_render_template.connect(_template_started, app)
+        signals.template_rendered.connect(_template_rendered, app)
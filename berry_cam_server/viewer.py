@@ -1,53 +1,315 @@
+import json
+import mimetypes
 import os
+import queue
 import shutil
+import tempfile
+import time
+from contextlib import closing
 from datetime import datetime, timezone
+from http import HTTPStatus
 
-from flask import Blueprint, render_template, current_app, send_from_directory, request, redirect
+from flask import Blueprint, render_template, current_app, send_from_directory, request, redirect, url_for, abort, \
+    jsonify, Response, get_template_attribute, stream_with_context
 
 from .auth import login_required
+from .common.layout import find_picture_file
+from .common.metrics import VIEWER_RENDER_DURATION, VIEWER_SCANNED_PICTURES
+from .common.picture_index import get_picture_index, PREVIEW_DONE
+from .common.sprites import cell_position
+from .common.storage import get_storage, CHUNK_SIZE
+from .common.thumbnails import create_previews, preview_file, PREVIEW_SIZE
+from .common.timing import span
 
 bp = Blueprint('viewer', __name__)
 
+# The maximum amount of pictures shown on a single viewer page
+MAX_PAGE_SIZE = 500
+
+
+def _parse_cursor(cursor):
+    """
+    Parses a page cursor as created by _cursor.
+
+    :param str cursor: The cursor to parse. Might be None.
+    :return: The cursor as (timestamp, name) tuple or None.
+    :rtype: tuple
+    """
+    if cursor is None:
+        return None
+
+    timestamp, _, name = cursor.partition('_')
+    try:
+        return float(timestamp), name
+    except ValueError:
+        abort(HTTPStatus.BAD_REQUEST)
+
+
+def _cursor(picture):
+    """
+    Returns the page cursor pointing to the given picture.
+
+    :param dict picture: The picture from the picture index.
+    :return: The cursor.
+    :rtype: str
+    """
+    return "{!r}_{}".format(picture["timestamp"], picture["name"])
+
+
+def _preview_path(name, size):
+    """
+    Returns the path of a preview image for the previews endpoint. The path doesn't contain the shard directories,
+    these are resolved by the endpoint.
+
+    :param str name: The name of the picture.
+    :param int size: The size of the preview.
+    :return: The path to use for the previews endpoint.
+    :rtype: str
+    """
+    if size == PREVIEW_SIZE:
+        return "{}.jpg".format(name)
+
+    return "{}/{}.jpg".format(size, name)
+
+
+def _hidpi_preview_size(preview_sizes):
+    """
+    Returns the preview size shown instead of the sprite sheet cells on high resolution screens, since the cells only
+    have the default preview size. This is the smallest size with at least twice the default preview size.
+
+    :param list preview_sizes: The preview sizes available, sorted ascending.
+    :return: The preview size or None if there is no larger preview size.
+    :rtype: int
+    """
+    larger_sizes = [size for size in preview_sizes if size > PREVIEW_SIZE]
+    if not larger_sizes:
+        return None
+
+    return next((size for size in larger_sizes if size >= 2 * PREVIEW_SIZE), larger_sizes[-1])
+
+
+def _sprite(picture, sprite_versions):
+    """
+    Returns the sprite sheet position of the preview of a picture.
+
+    :param dict picture: The picture from the picture index.
+    :param dict sprite_versions: The version of each sprite sheet.
+    :return: The url of the sprite sheet and the x and y position of the preview or None if the preview is not part
+             of a sprite sheet.
+    :rtype: tuple
+    """
+    if picture["sprite"] not in sprite_versions:
+        return None
+
+    x, y = cell_position(picture["sprite_slot"])
+    return url_for('viewer.sprites', path=picture["sprite"] + '.png', v=sprite_versions[picture["sprite"]]), x, y
+
+
+def _sprite_versions(pictures):
+    """
+    Returns the version of each sprite sheet shown for the given pictures. Sprite sheets only grow and each write
+    contains the cells of all previous writes, so the highest version shown allows browsers to cache the sheets.
+
+    :param list pictures: The pictures from the picture index.
+    :return: The version of each sprite sheet.
+    :rtype: dict
+    """
+    sprite_versions = {}
+    for picture in pictures:
+        if picture["sprite"] is not None and picture["preview_status"] == PREVIEW_DONE:
+            # Pictures added before the versions existed use their slot
+            version = picture["sprite_slot"] if picture["sprite_version"] is None else picture["sprite_version"]
+            sprite_versions[picture["sprite"]] = max(sprite_versions.get(picture["sprite"], 0), version)
+
+    return sprite_versions
+
+
+def _image_info(picture, sprite_versions):
+    """
+    Returns the information of a picture needed to show it in the viewer, see the image_link template.
+
+    :param dict picture: The picture from the picture index.
+    :param dict sprite_versions: The version of each sprite sheet, see _sprite_versions.
+    :return: The image information.
+    :rtype: dict
+    """
+    preview_sizes = current_app.extensions['thumbnails'].sizes
+    hidpi_size = _hidpi_preview_size(preview_sizes)
+
+    # Pictures with identical content share the files
+    blob_name = picture["blob_name"] or picture["name"]
+    return {
+        "name": picture["name"],
+        "preview": blob_name + ".jpg" if picture["preview_status"] == PREVIEW_DONE else None,
+        "preview_status": picture["preview_status"],
+        "preview_variants": [(_preview_path(blob_name, size), size) for size in preview_sizes],
+        "large_preview": _preview_path(blob_name, preview_sizes[-1]),
+        "rawfile": blob_name + "." + picture["raw_extension"],
+        "camera": picture["camera"],
+        "near_duplicate": picture["near_duplicate_of"] is not None,
+        "sprite": _sprite(picture, sprite_versions),
+        "hidpi_preview": _preview_path(blob_name, hidpi_size) if hidpi_size else None,
+        "timestamp": datetime.fromtimestamp(picture["timestamp"], timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    }
+
 
 @bp.route('/')
 @login_required
 def index():
     """
     If the user is logged in, it will show the most recent and older files that where uploaded to the viewer.
+    The pictures are split into pages, use the query parameters before or after with a page cursor to get
+    the pictures older or newer than a picture. The page size can be set with the limit parameter.
+    With the camera parameter, only the pictures of the given camera are shown.
+    With cleanup=true, all pictures are deleted in the background.
 
     :return: Rendered template
     :rtype: str
     """
     if request.args.get('cleanup') == 'true':
-        shutil.rmtree(os.path.join(current_app.config["UPLOAD_DIR"], 'raw'))
-        os.mkdir(os.path.join(current_app.config["UPLOAD_DIR"], 'raw'))
-        shutil.rmtree(os.path.join(current_app.config["UPLOAD_DIR"], 'previews'))
-        os.mkdir(os.path.join(current_app.config["UPLOAD_DIR"], 'previews'))
+        # Deleting the whole archive takes too long for a request
+        current_app.extensions['retention'].start_cleanup()
         return redirect('./')
 
-    most_recent = []
-    older = []
-    for preview in sorted(os.listdir(os.path.join(current_app.config["UPLOAD_DIR"], "previews")), reverse=True):
-        timestamp = str(preview.rsplit('.')[0])
+    start = time.perf_counter()
+    limit = min(max(request.args.get('limit', current_app.config.get("VIEWER_PAGE_SIZE", 50), type=int), 1),
+                MAX_PAGE_SIZE)
+    before = _parse_cursor(request.args.get('before'))
+    after = _parse_cursor(request.args.get('after'))
+    camera = request.args.get('camera')
 
-        raw_file_without_ext = os.path.join(current_app.config["UPLOAD_DIR"], "raw", timestamp)
-        if os.path.exists(raw_file_without_ext + ".jpg"):
-            raw_file = timestamp + ".jpg"
-        else:
-            raw_file = timestamp + ".png"
+    pictures, more = get_picture_index().page(before=before, after=after, limit=limit, camera=camera)
+    VIEWER_SCANNED_PICTURES.inc(len(pictures))
+
+    # The first page is the one without newer pictures
+    first_page = (before is None and after is None) or (after is not None and not more)
 
-        image_info = {
-            "preview": preview,
-            "rawfile": raw_file,
-            "timestamp": datetime.fromtimestamp(float(timestamp) / 100, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-        }
+    newer_page = None
+    older_page = None
+    if pictures:
+        if not first_page:
+            newer_page = url_for('viewer.index', after=_cursor(pictures[0]), limit=limit, camera=camera)
+        if after is not None or more:
+            older_page = url_for('viewer.index', before=_cursor(pictures[-1]), limit=limit, camera=camera)
 
-        if len(most_recent) < 5:
+    sprite_versions = _sprite_versions(pictures)
+    most_recent = []
+    older = []
+    for picture in pictures:
+        image_info = _image_info(picture, sprite_versions)
+        if first_page and len(most_recent) < 5:
             most_recent.append(image_info)
         else:
             older.append(image_info)
 
-    return render_template('viewer.html', most_recent_pictures=most_recent, older_pictures=older)
+    page = render_template('viewer.html', most_recent_pictures=most_recent, older_pictures=older,
+                           first_page=first_page, newer_page=newer_page, older_page=older_page,
+                           cameras=get_picture_index().cameras(), camera=camera)
+    VIEWER_RENDER_DURATION.observe(time.perf_counter() - start)
+    return page
+
+
+@bp.route('/events')
+@login_required
+def events():
+    """
+    Streams new pictures as server-sent events, so the viewer can show them without reloading. Checks for login.
+    Each event contains the name of the picture and the rendered image link. With the camera parameter, only the
+    pictures of the given camera are sent. Pictures uploaded to other server processes are sent with a short delay,
+    see PictureEvents.
+
+    :return: The event stream.
+    :rtype: Response
+    """
+    camera = request.args.get('camera')
+    keepalive = current_app.config.get("PICTURE_EVENTS_KEEPALIVE", 15)
+    picture_events = current_app.extensions['picture_events']
+    image_link = get_template_attribute('viewer/image_link.html', 'image_link')
+
+    def stream():
+        with picture_events.subscribe() as subscriber:
+            # Tells the browser how long to wait before reconnecting and that the subscription is active
+            yield "retry: {}\n\n".format(keepalive * 1000)
+
+            while True:
+                try:
+                    event = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    # Comments keep the connection open and detect closed connections
+                    yield ": keepalive\n\n"
+                    continue
+
+                picture = get_picture_index().get(event["name"])
+                if picture is None or (camera and picture["camera"] != camera):
+                    continue
+
+                data = {"name": picture["name"],
+                        "html": str(image_link(_image_info(picture, _sprite_versions([picture]))))}
+                yield "event: picture\nid: {}\ndata: {}\n\n".format(picture["name"], json.dumps(data))
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    # Disables buffering of reverse proxies like nginx
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@bp.route('/retention')
+@login_required
+def retention():
+    """
+    Returns the retention policies and the amount of pictures and bytes they reclaimed. Checks for login.
+
+    :return: The retention statistics as json.
+    :rtype: Response
+    """
+    return jsonify(current_app.extensions['retention'].stats())
+
+
+@bp.route('/recompression')
+@login_required
+def recompression():
+    """
+    Returns the recompression settings and the amount of bytes saved by recompressing raw images. Checks for login.
+
+    :return: The recompression statistics as json.
+    :rtype: Response
+    """
+    return jsonify(current_app.extensions['recompression'].stats())
+
+
+def _send_image(directory, path):
+    """
+    Sends an image file. Images never change once they are written, so they can be cached by the browsers as long
+    as possible. Conditional requests (ETag and Last-Modified) and range requests are handled as well for images
+    stored on the local file system, images of other storages are streamed with conditional requests on their key.
+
+    :param str directory: The storage directory to send the image from.
+    :param str path: The image to send, relative to the directory.
+    :return: The response.
+    :rtype: Response
+    """
+    storage = get_storage()
+    local_dir = storage.local_path(directory)
+    if local_dir is not None:
+        response = send_from_directory(local_dir, path)
+    else:
+        key = directory + '/' + path
+        if request.if_none_match.contains(key):
+            response = Response(status=HTTPStatus.NOT_MODIFIED)
+        else:
+            try:
+                response = Response(storage.stream(key), mimetype=mimetypes.guess_type(path)[0])
+            except FileNotFoundError:
+                abort(HTTPStatus.NOT_FOUND)
+        response.set_etag(key)
+
+    # Images are only available for logged in users, so they must not be stored in shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config.get("IMAGE_CACHE_MAX_AGE", 365 * 24 * 60 * 60)
+    response.cache_control.immutable = True
+    return response
 
 
 @bp.route('/large/<path:path>')
@@ -55,12 +317,17 @@ def index():
 def large(path):
     """
     Will return raw images from raw directory. Checks for login.
+    The images may be cached by the browser forever, see _send_image.
+    Images are looked up in the sharded layout first and in the former flat layout afterwards.
 
     :param path: The image to load.
     :return: The file.
     :rtype: Any
     """
-    return send_from_directory(os.path.join(current_app.config["UPLOAD_DIR"], 'raw'), path)
+    if '/' not in path:
+        path = find_picture_file('raw', path, get_storage().exists)
+
+    return _send_image('raw', path)
 
 
 @bp.route('/previews/<path:path>')
@@ -68,9 +335,75 @@ def large(path):
 def previews(path):
     """
     Will return preview images from previews directory. Checks for login.
+    The images may be cached by the browser forever, see _send_image.
+    Previews of other sizes than the default one are created on first access if they don't exist.
+    Images are looked up in the sharded layout first and in the former flat layout afterwards.
 
     :param path: The image to load.
     :return: The file.
     :rtype: Any
     """
-    return send_from_directory(os.path.join(current_app.config["UPLOAD_DIR"], 'previews'), path)
+    storage = get_storage()
+
+    size, _, preview = path.partition('/')
+    if not preview:
+        return _send_image('previews', find_picture_file('previews', path, storage.exists))
+
+    if not size.isdigit() or int(size) not in current_app.extensions['thumbnails'].sizes or '/' in preview:
+        return _send_image('previews', path)
+
+    size_dir = 'previews/' + size
+    preview_path = find_picture_file(size_dir, preview, storage.exists)
+    if not storage.exists(size_dir + '/' + preview_path):
+        blob_name = os.path.splitext(preview)[0]
+        picture = get_picture_index().find_blob(blob_name)
+        if picture:
+            _create_preview(blob_name, picture["raw_extension"], int(size))
+
+    return _send_image(size_dir, preview_path)
+
+
+@bp.route('/sprites/<path:path>')
+@login_required
+def sprites(path):
+    """
+    Will return sprite sheets of previews. Checks for login.
+    Sprite sheets get new previews, but the existing previews never change. The viewer requests the sprite sheets
+    with a version parameter, so that they may be cached by the browser forever as well, see _send_image.
+
+    :param path: The sprite sheet to load.
+    :return: The file.
+    :rtype: Any
+    """
+    return _send_image('sprites', path)
+
+
+def _create_preview(name, raw_extension, size):
+    """
+    Creates a missing preview of a picture blob. Aborts the request if the raw image can't be read.
+    For storages without local files, the raw image is downloaded to a temporary directory first.
+
+    :param str name: The name of the blob.
+    :param str raw_extension: The extension of the raw image.
+    :param int size: The size of the preview.
+    """
+    storage = get_storage()
+    raw_key = 'raw/' + find_picture_file('raw', name + "." + raw_extension, storage.exists)
+
+    try:
+        previews_dir = storage.local_path('previews')
+        if previews_dir is not None:
+            with span('pillow'):
+                create_previews(storage.local_path(raw_key), previews_dir, name, (size,))
+            return
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            raw_image = os.path.join(work_dir, 'raw')
+            with closing(storage.open(raw_key)) as stream, open(raw_image, 'wb') as raw_file:
+                shutil.copyfileobj(stream, raw_file, CHUNK_SIZE)
+
+            with span('pillow'):
+                create_previews(raw_image, work_dir, name, (size,))
+            storage.put_file(preview_file('previews', name, size), preview_file(work_dir, name, size))
+    except IOError:
+        abort(HTTPStatus.NOT_FOUND)
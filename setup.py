@@ -8,5 +8,5 @@ setup(
     author='Felix Wohlfrom',
     author_email='TODO',
     packages=['berry_cam_server'],
-    install_requires=['flask', 'flask-restx', 'PyYAML', 'Pillow', 'pytest', 'coverage']
+    install_requires=['flask', 'flask-restx', 'PyYAML', 'Pillow', 'numpy', 'pytest', 'coverage']
 )
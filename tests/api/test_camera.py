@@ -1,3 +1,5 @@
+import threading
+import time
 from http import HTTPStatus
 
 import pytest
@@ -208,4 +210,39 @@ def test_post_two_camera_names(client):
 
         assert response.status_code == HTTPStatus.OK
 
-        assert len(Config.get_connected_cameras()) == 2
\ No newline at end of file
+        assert len(Config.get_connected_cameras()) == 2
+
+def test_long_poll_camera_settings(client):
+    """
+    Verifies that the camera settings can be polled with their version and that waiting requests are answered
+    as soon as the settings change.
+
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    api_key = Config.get_user_config('test')['api_key']
+    camera_name = 'Test-Camera'
+
+    with client:
+        client.post('/api/camera/', data={'api_key': api_key, 'name': camera_name, 'enabled': False})
+
+        response = client.get('/api/camera/', data={'api_key': api_key, 'name': camera_name})
+        assert response.status_code == HTTPStatus.OK
+        version = response.json['version']
+        assert response.headers['ETag'] == '"{}"'.format(version)
+
+        response = client.get('/api/camera/', data={'api_key': api_key, 'name': camera_name},
+                              headers={'If-None-Match': '"{}"'.format(version)})
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+        start = time.monotonic()
+        response = client.get('/api/camera/', data={'api_key': api_key, 'name': camera_name,
+                                                    'version': version, 'wait': 0.3})
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+        assert time.monotonic() - start >= 0.3
+
+        threading.Timer(0.1, Config.enable_camera, (camera_name, True)).start()
+        response = client.get('/api/camera/', data={'api_key': api_key, 'name': camera_name,
+                                                    'version': version, 'wait': 30})
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['enabled']
+        assert response.json['version'] != version
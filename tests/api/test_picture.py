@@ -4,8 +4,13 @@ from http import HTTPStatus
 from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+from PIL import Image
 
 from berry_cam_server import Config
+from berry_cam_server.common.layout import picture_file
+from berry_cam_server.common.storage import S3Storage
+from ..utils.fake_s3 import FakeS3Client
+from ..utils.image_generator import generate_camera_image
 
 
 def test_upload_missing_api_key(client):
@@ -68,10 +73,10 @@ def test_upload_invalid_file(client):
         assert b'invalid file type' in response.data.lower() and b'file' in response.data
 
 
-def test_upload_thumbnail_creation_failure(client):
+def test_upload_invalid_image(client):
     """
-    Test thumbnail creation with an invalid byte stream that is not a valid picture.
-    The creation should fail.
+    Test uploading an invalid byte stream that is not a valid picture.
+    The upload should fail.
 
     :param FlaskClient client: The flask client to use for the test.
     """
@@ -81,8 +86,34 @@ def test_upload_thumbnail_creation_failure(client):
             'file': (io.BytesIO(b"test"), 'test.jpg')
         })
 
-        assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
-        assert b'thumbnail' in response.data.lower()
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+        assert b'invalid image' in response.data.lower()
+
+
+def test_upload_thumbnail_creation_failure(app, client):
+    """
+    Test thumbnail creation with a truncated image. The upload should succeed, the raw image be kept and the
+    preview marked as failed.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.jpg')
+    with open(test_file, 'rb') as image:
+        truncated_image = image.read()[:2000]
+
+    with client:
+        response = client.post('/api/picture/', data={
+            'api_key': Config.get_user_config('test')['api_key'],
+            'file': (io.BytesIO(truncated_image), 'test.jpg')
+        })
+
+        assert response.status_code == HTTPStatus.OK
+
+        picture = app.extensions['picture_index'].latest()[0]
+        assert picture['preview_status'] == 'failed'
+        assert os.path.exists(picture_file(os.path.join(app.config['UPLOAD_DIR'], 'raw'), picture['name'], 'jpg'))
+        assert not os.listdir(os.path.join(app.config['UPLOAD_DIR'], 'previews'))
 
 
 @pytest.mark.parametrize('file_type', (
@@ -107,32 +138,67 @@ def test_upload_valid_file(client, file_type):
         assert response.data.decode('utf-8').strip() == '"Success"'
 
 
-def run_upload_test(client):
+def test_upload_indexed(app, client):
+    """
+    Verifies that uploaded pictures are added to the picture index together with camera and user.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    with client:
+        test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.png')
+        response = client.post('/api/picture/', data={
+            'api_key': Config.get_user_config('test')['api_key'],
+            'camera': 'Test-Camera',
+            'file': (open(test_file, 'rb'), 'test.png')
+        })
+
+        assert response.status_code == HTTPStatus.OK
+
+        pictures = app.extensions['picture_index'].latest()
+        assert len(pictures) == 1
+        assert pictures[0]['raw_extension'] == 'png'
+        assert pictures[0]['camera'] == 'Test-Camera'
+        assert pictures[0]['user'] == 'test'
+        assert pictures[0]['raw_size'] == os.path.getsize(test_file)
+        assert pictures[0]['width'] and pictures[0]['height']
+        assert pictures[0]['preview_status'] == 'done'
+        assert pictures[0]['preview_size'] == os.path.getsize(
+            picture_file(os.path.join(app.config['UPLOAD_DIR'], 'previews'), pictures[0]['name'], 'jpg'))
+
+        # Medium previews are created as well, large ones only on first access
+        for size, created in ((480, True), (1280, False)):
+            assert os.path.exists(picture_file(os.path.join(app.config['UPLOAD_DIR'], 'previews', str(size)),
+                                               pictures[0]['name'], 'jpg')) == created
+
+
+def run_upload_test(client, camera):
     """
     Will execute the uploading of a single file and return the response.
-    Used in test_upload_verify_fast.
+    Used in test_upload_very_fast.
 
     :param FlaskClient client: The flask client to use for the test.
+    :param str camera: The camera to upload the picture for.
     :returns: The upload response.
     """
     test_file = os.path.join(os.path.dirname(__file__),
                              'test_data', 'test.jpg')
 
     with open(test_file, 'rb') as bin_data:
-        # First request should succeed
         response = client.post('/api/picture/', data={
             'api_key': Config.get_user_config('test')['api_key'],
+            'camera': camera,
             'file': (bin_data, 'test.jpg')
         })
         return response
 
 
-def test_upload_very_fast(client):
+def test_upload_very_fast(app, client):
     """
-    This test tries to provoke a TOO_MANY_REQUEST response by firing a lot of
-    parallel requests to the server. At least one of them should return a
-    TOO_MANY_REQUESTS response.
+    This test fires a lot of parallel requests from multiple cameras to the server.
+    All of them should succeed and get a unique picture name, also if they are uploaded at the same time.
 
+    :param Flask app: The flask application to test.
     :param FlaskClient client: The flask client to use for the test.
     """
     with client:
@@ -141,14 +207,369 @@ def test_upload_very_fast(client):
             response = [None] * parallel_executions
             # Fire up a bunch of requests in parallel as fast as possible
             for i in range(parallel_executions):
-                response[i] = pool.submit(run_upload_test, client)
+                response[i] = pool.submit(run_upload_test, client, 'Camera{}'.format(i % 3))
 
             # Afterwards wait for the results and check them
-            too_many_requests_found = False
             for i in range(parallel_executions):
-                if response[i].result().status_code == HTTPStatus.TOO_MANY_REQUESTS:
-                    too_many_requests_found = True
-                else:
-                    assert response[i].result().status_code == HTTPStatus.OK
+                assert response[i].result().status_code == HTTPStatus.OK
+
+        pictures = app.extensions['picture_index'].latest()
+        assert len(pictures) == parallel_executions
+        for picture in pictures:
+            assert picture['camera'] in picture['name']
+
+
+def test_resumable_upload(app, client):
+    """
+    Verifies uploading a picture in chunks, including resuming after an interruption.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    api_key = Config.get_user_config('test')['api_key']
+    test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.jpg')
+    with open(test_file, 'rb') as image:
+        data = image.read()
+
+    with client:
+        response = client.post('/api/picture/uploads/', data={
+            'api_key': api_key, 'content_type': 'image/jpeg', 'camera': 'Test-Camera'})
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['offset'] == 0
+        upload_url = '/api/picture/uploads/{}'.format(response.json['upload_id'])
 
-            assert too_many_requests_found
+        response = client.put(upload_url + '?api_key={}&offset=0'.format(api_key), data=data[:1000])
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['offset'] == 1000
+
+        # A retried chunk is rejected, the client can continue from the current offset
+        response = client.put(upload_url + '?api_key={}&offset=0'.format(api_key), data=data[:1000])
+        assert response.status_code == HTTPStatus.CONFLICT
+        assert response.json['offset'] == 1000
+
+        response = client.get(upload_url + '?api_key={}'.format(api_key))
+        assert response.json['offset'] == 1000
+
+        response = client.put(upload_url + '?api_key={}&offset=1000'.format(api_key), data=data[1000:])
+        assert response.json['offset'] == len(data)
+
+        response = client.post(upload_url + '/commit?api_key={}'.format(api_key))
+        assert response.status_code == HTTPStatus.OK
+
+        pictures = app.extensions['picture_index'].latest()
+        assert len(pictures) == 1
+        assert pictures[0]['camera'] == 'Test-Camera'
+        assert pictures[0]['preview_status'] == 'done'
+        raw_file = picture_file(os.path.join(app.config['UPLOAD_DIR'], 'raw'), pictures[0]['name'], 'jpg')
+        with open(raw_file, 'rb') as raw_image:
+            assert raw_image.read() == data
+
+        # The upload session is removed after commit
+        assert not os.listdir(os.path.join(app.config['UPLOAD_DIR'], 'staging'))
+        response = client.get(upload_url + '?api_key={}'.format(api_key))
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_raw_image_stored_before_previews(app, client, monkeypatch):
+    """
+    Verifies that the raw image is stored before the upload is answered, also if the storage doesn't store files
+    locally, and that only expired upload sessions are removed from the staging directory.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    :param monkeypatch: Used to keep the previews from being created.
+    """
+    s3_client = FakeS3Client()
+    app.extensions['storage'] = S3Storage(s3_client, 'pictures')
+    monkeypatch.setattr(app.extensions['thumbnails'], 'submit', lambda *args: None)
+    app.config['UPLOAD_SESSION_TIMEOUT'] = 0
+    api_key = Config.get_user_config('test')['api_key']
+    test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.jpg')
+    staging_dir = os.path.join(app.config['UPLOAD_DIR'], 'staging')
+
+    with client:
+        response = client.post('/api/picture/', data={'api_key': api_key, 'file': (open(test_file, 'rb'), 'test.jpg')})
+        assert response.status_code == HTTPStatus.OK
+
+        name = app.extensions['picture_index'].latest()[0]['name']
+        with open(test_file, 'rb') as raw_image:
+            assert s3_client.objects[('pictures', picture_file('raw', name, 'jpg'))] == raw_image.read()
+
+        # The local copy for the pending previews is kept, expired upload sessions are removed
+        work_dirs = os.listdir(staging_dir)
+        for file_name in ('expired.json', 'expired.part', 'expired.part.lock'):
+            open(os.path.join(staging_dir, file_name), 'w').close()
+
+        response = client.post('/api/picture/uploads/', data={'api_key': api_key, 'content_type': 'image/jpeg'})
+        assert response.status_code == HTTPStatus.OK
+        assert sorted(os.listdir(staging_dir)) == sorted(work_dirs + ['{}.json'.format(response.json['upload_id']),
+                                                                      '{}.part'.format(response.json['upload_id'])])
+
+
+def test_failed_store_not_deduplicated(app, client, monkeypatch):
+    """
+    Verifies that pictures whose raw image couldn't be stored are removed from the index, so that uploading the same
+    content again stores it instead of referencing the missing blob.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    :param monkeypatch: Used to let the first store fail.
+    """
+    s3_client = FakeS3Client()
+    app.extensions['storage'] = S3Storage(s3_client, 'pictures')
+    monkeypatch.setattr(app.extensions['thumbnails'], 'submit', lambda *args: None)
+    api_key = Config.get_user_config('test')['api_key']
+    test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.jpg')
+
+    put_object = s3_client.put_object
+
+    def failing_put_object(**kwargs):
+        monkeypatch.setattr(s3_client, 'put_object', put_object)
+        raise IOError("Object store not available")
+
+    monkeypatch.setattr(s3_client, 'put_object', failing_put_object)
+
+    with client:
+        try:
+            response = client.post('/api/picture/',
+                                   data={'api_key': api_key, 'file': (open(test_file, 'rb'), 'test.jpg')})
+            assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+        except IOError:
+            pass
+        assert app.extensions['picture_index'].count() == 0
+        assert os.listdir(os.path.join(app.config['UPLOAD_DIR'], 'staging')) == []
+
+        response = client.post('/api/picture/', data={'api_key': api_key, 'file': (open(test_file, 'rb'), 'test.jpg')})
+        assert response.status_code == HTTPStatus.OK
+
+    pictures = app.extensions['picture_index'].latest()
+    assert len(pictures) == 1
+    assert pictures[0]['preview_status'] == 'pending'
+    assert ('pictures', picture_file('raw', pictures[0]['name'], 'jpg')) in s3_client.objects
+
+
+def test_pending_previews_queued(app, client, monkeypatch):
+    """
+    Verifies that previews that were still pending when the server stopped are queued again.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    :param monkeypatch: Used to keep the previews from being created during the upload.
+    """
+    from berry_cam_server.api.picture import queue_pending_previews
+
+    api_key = Config.get_user_config('test')['api_key']
+    test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.jpg')
+    thumbnails = app.extensions['thumbnails']
+
+    with monkeypatch.context() as patch:
+        patch.setattr(thumbnails, 'submit', lambda *args: None)
+        for _ in range(2):
+            response = client.post('/api/picture/',
+                                   data={'api_key': api_key, 'file': (open(test_file, 'rb'), 'test.jpg')})
+            assert response.status_code == HTTPStatus.OK
+
+    index = app.extensions['picture_index']
+    pictures = index.latest()
+    assert [picture['preview_status'] for picture in pictures] == ['pending', 'pending']
+    # The second upload is a duplicate of the first one, so the previews are only created once
+    assert [picture['name'] for picture in index.pending_previews()] == [pictures[1]['name']]
+
+    with app.app_context():
+        queue_pending_previews()
+
+    assert [picture['preview_status'] for picture in index.latest()] == ['done', 'done']
+    assert index.pending_previews() == []
+    assert os.path.exists(os.path.join(app.config['UPLOAD_DIR'], picture_file('previews', pictures[1]['name'], 'jpg')))
+
+
+def test_resumable_upload_invalid(client):
+    """
+    Verifies that resumable uploads with invalid content type or unknown upload ids are rejected.
+
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    api_key = Config.get_user_config('test')['api_key']
+
+    with client:
+        response = client.post('/api/picture/uploads/', data={'api_key': api_key, 'content_type': 'text/plain'})
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+        response = client.put('/api/picture/uploads/unknown?api_key={}&offset=0'.format(api_key), data=b'test')
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+        response = client.post('/api/picture/uploads/unknown/commit?api_key={}'.format(api_key))
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_batch_upload(app, client):
+    """
+    Verifies uploading multiple pictures at once, with a result for each of them.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    test_data = os.path.join(os.path.dirname(__file__), 'test_data')
+
+    with client:
+        response = client.post('/api/picture/batch', data={
+            'api_key': Config.get_user_config('test')['api_key'],
+            'camera': 'Test-Camera',
+            'file': [(open(os.path.join(test_data, 'test.jpg'), 'rb'), 'test.jpg'),
+                     (io.BytesIO(b"test"), 'test.txt'),
+                     (open(os.path.join(test_data, 'test.png'), 'rb'), 'test.png'),
+                     (open(os.path.join(test_data, 'test.jpg'), 'rb'), 'test.jpg')]
+        })
+
+        assert response.status_code == HTTPStatus.OK
+        results = response.json['results']
+        assert [result['status'] for result in results] == [200, 400, 200, 200]
+        assert 'invalid file type' in results[1]['message'].lower()
+
+        pictures = app.extensions['picture_index'].latest()
+        assert sorted(picture['name'] for picture in pictures) == sorted(
+            result['name'] for result in results if result['status'] == 200)
+        assert all(picture['camera'] == 'Test-Camera' for picture in pictures)
+        assert all(picture['preview_status'] == 'done' for picture in pictures)
+
+
+def test_upload_deduplicated(app, client):
+    """
+    Verifies that pictures with identical content are only stored once.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.jpg')
+    api_key = Config.get_user_config('test')['api_key']
+
+    with client:
+        response = client.post('/api/picture/', data={'api_key': api_key, 'file': (open(test_file, 'rb'), 'test.jpg')})
+        assert response.status_code == HTTPStatus.OK
+
+        response = client.post('/api/picture/batch', data={'api_key': api_key, 'file': [
+            (open(test_file, 'rb'), 'test.jpg'),
+            (io.BytesIO(b'GIF89a'), 'test.gif', 'image/gif')
+        ]})
+        assert response.status_code == HTTPStatus.OK
+
+        pictures = app.extensions['picture_index'].latest()
+        assert len(pictures) == 2
+        assert pictures[0]['blob_name'] == pictures[1]['name']
+        assert pictures[0]['content_hash'] == pictures[1]['content_hash']
+        assert pictures[0]['preview_status'] == 'done'
+
+        raw_files = [file for _, _, files in os.walk(os.path.join(app.config['UPLOAD_DIR'], 'raw')) for file in files]
+        assert raw_files == [pictures[1]['name'] + '.jpg']
+        assert not os.listdir(os.path.join(app.config['UPLOAD_DIR'], 'staging'))
+
+
+def test_upload_published(app, client):
+    """
+    Verifies that uploaded pictures are published to the live feeds of the viewer, also if they are duplicates.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.jpg')
+
+    with client, app.extensions['picture_events'].subscribe() as subscriber:
+        for _ in range(2):
+            response = client.post('/api/picture/', data={'api_key': Config.get_user_config('test')['api_key'],
+                                                          'file': (open(test_file, 'rb'), 'test.jpg')})
+            assert response.status_code == HTTPStatus.OK
+
+        newest, oldest = app.extensions['picture_index'].latest()
+        assert subscriber.get_nowait() == {'name': oldest['name']}
+        assert subscriber.get_nowait() == {'name': newest['name']}
+
+
+def test_upload_near_duplicates(app, client, tmp_path):
+    """
+    Verifies that frames which look like the previous frame of the camera are marked as near duplicates.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    :param Path tmp_path: Temporary directory for the test images.
+    """
+    app.extensions['near_duplicates'].threshold = 10
+    for index in range(2):
+        generate_camera_image(str(tmp_path / '{}.jpg'.format(index)), 640, 480)
+    Image.linear_gradient('L').rotate(90).resize((640, 480)).save(str(tmp_path / '2.jpg'))
+
+    with client:
+        for index in range(3):
+            response = client.post('/api/picture/', data={
+                'api_key': Config.get_user_config('test')['api_key'],
+                'camera': 'Test-Camera',
+                'file': (open(str(tmp_path / '{}.jpg'.format(index)), 'rb'), 'test.jpg')
+            })
+            assert response.status_code == HTTPStatus.OK
+
+        first, second, third = reversed(app.extensions['picture_index'].latest())
+        assert first['near_duplicate_of'] is None
+        assert second['near_duplicate_of'] == first['name']
+        assert third['near_duplicate_of'] is None
+
+
+def test_upload_near_duplicates_dropped(app, client, tmp_path):
+    """
+    Verifies that dropped near duplicates don't get a cell of a sprite sheet.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    :param Path tmp_path: Temporary directory for the test images.
+    """
+    app.extensions['near_duplicates'].threshold = 10
+    app.extensions['near_duplicates'].action = 'drop'
+    for index in range(2):
+        generate_camera_image(str(tmp_path / '{}.jpg'.format(index)), 640, 480)
+    Image.linear_gradient('L').rotate(90).resize((640, 480)).save(str(tmp_path / '2.jpg'))
+
+    with client:
+        for index in range(3):
+            response = client.post('/api/picture/', data={
+                'api_key': Config.get_user_config('test')['api_key'],
+                'camera': 'Test-Camera',
+                'file': (open(str(tmp_path / '{}.jpg'.format(index)), 'rb'), 'test.jpg')
+            })
+            assert response.status_code == HTTPStatus.OK
+
+        third, first = app.extensions['picture_index'].latest()
+        assert (first['sprite'], first['sprite_slot']) == (third['sprite'], 0)
+        assert third['sprite_slot'] == 1
+
+
+def test_upload_sprite_sheets(app, client, auth):
+    """
+    Verifies that the previews of uploaded pictures are added to sprite sheets, which are used by the viewer.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    with client:
+        for extension in ('png', 'jpg'):
+            test_file = os.path.join(os.path.dirname(__file__), 'test_data', 'test.' + extension)
+            response = client.post('/api/picture/', data={
+                'api_key': Config.get_user_config('test')['api_key'],
+                'file': (open(test_file, 'rb'), 'test.' + extension)
+            })
+            assert response.status_code == HTTPStatus.OK
+
+        newest, oldest = app.extensions['picture_index'].latest()
+        assert newest['sprite'] == oldest['sprite']
+        assert (oldest['sprite_slot'], newest['sprite_slot']) == (0, 1)
+
+        auth.login()
+        response = client.get('/')
+        # The version of the second write of the sprite sheet
+        sprite_url = '/sprites/{}.png?v=2'.format(newest['sprite'])
+        assert sprite_url.encode() in response.data
+        assert b'--sprite-position: -128px -0px' in response.data
+        # High resolution screens use the larger preview instead
+        assert "--hidpi-preview: url('/previews/480/{}.jpg')".format(newest['name']).encode() in response.data
+
+        response = client.get(sprite_url)
+        assert response.status_code == HTTPStatus.OK
+        assert response.mimetype == 'image/png'
@@ -0,0 +1 @@
+# Contains benchmarks. Not collected by pytest, run them as modules, e.g. python -m tests.benchmarks.bench_thumbnails
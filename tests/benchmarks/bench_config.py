@@ -0,0 +1,97 @@
+"""
+Measures the cost of the config operations done for each request: reading the api keys (Config.get_api_keys and
+Config.get_api_key_user), storing camera heartbeats (Config.set_camera_info) and writing the config file.
+
+Config reads are measured with the parsed config file cached and with parsing the config file for each call.
+Results are printed as json.
+"""
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import yaml
+
+from berry_cam_server import Config
+from .common import durations, report
+
+
+def write_config(config_file, users):
+    """
+    Writes a config file with the given amount of users. The modification time is set to the past, so that the
+    config file is cached directly, see Config.RACY_WINDOW.
+
+    :param str config_file: The config file to write.
+    :param int users: The amount of users.
+    """
+    with open(config_file, 'w') as config:
+        yaml.safe_dump({
+            'server': {'secret_key': 'dev'},
+            'user': {'user{}'.format(number): {'api_key': 'api_key_{}'.format(number), 'password': 'password'}
+                     for number in range(users)}
+        }, config)
+
+    modification_time = time.time() - 60
+    os.utime(config_file, (modification_time, modification_time))
+
+
+def uncached(func):
+    """
+    :param function func: The config operation.
+    :return: The config operation, parsing the config file for each call.
+    :rtype: function
+    """
+    def call():
+        Config.invalidate_cache()
+        func()
+
+    return call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 100, 1000],
+                        help="The amounts of users in the config file")
+    parser.add_argument('--cameras', type=int, default=10, help="The amount of cameras sending heartbeats")
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--output', help="The file to write the results to")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        Config.config_file = os.path.join(temp_dir, 'conf.yaml')
+
+        for users in args.users:
+            write_config(Config.config_file, users)
+            Config.invalidate_cache()
+            Config.open_camera_states(os.path.join(temp_dir, 'camera_state_{}.sqlite'.format(users)))
+
+            cameras = itertools.cycle(['Camera{}'.format(number) for number in range(args.cameras)])
+            last_key = 'api_key_{}'.format(users - 1)
+            operations = {
+                'get_api_keys': Config.get_api_keys,
+                'get_api_keys_uncached': uncached(Config.get_api_keys),
+                'get_api_key_user': lambda: Config.get_api_key_user(last_key),
+                'get_api_key_user_uncached': uncached(lambda: Config.get_api_key_user(last_key)),
+                'set_camera_info': lambda: Config.set_camera_info(next(cameras), True),
+                'set_camera_info_flushed': lambda: (Config.set_camera_info(next(cameras), True),
+                                                    Config.camera_states.flush()),
+                # Writes are much slower, so they are measured less often
+                'update_api_key': (lambda: Config.update_api_key('user0'), max(args.iterations // 10, 1))
+            }
+
+            for operation, func in operations.items():
+                func, iterations = func if isinstance(func, tuple) else (func, args.iterations)
+                result = durations(func, iterations)
+                result.update(operation=operation, users=users)
+                results.append(result)
+
+            Config.camera_states.close()
+            Config.camera_states = None
+
+    report('config', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Measures the throughput of single picture uploads (Pictures.post), including the creation of the previews.
+
+Previews are either created synchronously in the request or by the worker processes of the thumbnail service, in
+this case the time until all previews are created is included. Every upload has different content, so that no
+upload is deduplicated. Results are printed as json.
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+
+from .common import API_KEY, benchmark_app, report
+from ..utils.image_generator import generate_camera_image
+
+
+def measure(uploads, content_type, workers):
+    """
+    Uploads all given pictures with a new app. The first upload warms up the app and the worker processes and is
+    not measured.
+
+    :param list uploads: The content of the pictures to upload.
+    :param str content_type: The content type of the pictures.
+    :param int workers: The amount of thumbnail worker processes, 0 to create the previews in the request.
+    :return: The measured throughput.
+    :rtype: dict
+    """
+    with benchmark_app(THUMBNAIL_WORKERS=workers) as app:
+        client = app.test_client()
+        extension = content_type.split('/')[1]
+
+        def upload(content):
+            response = client.post('/api/picture/', data={
+                'api_key': API_KEY,
+                'camera': 'Benchmark',
+                'file': (io.BytesIO(content), 'picture.' + extension, content_type)
+            })
+            if response.status_code != 200:
+                raise RuntimeError("Upload failed: {}".format(response.data))
+
+        upload(uploads[0])
+        app.extensions['thumbnails'].wait()
+        uploads = uploads[1:]
+
+        request_times = []
+        start = time.perf_counter()
+        for content in uploads:
+            request_start = time.perf_counter()
+            upload(content)
+            request_times.append(time.perf_counter() - request_start)
+
+        app.extensions['thumbnails'].wait()
+        duration = time.perf_counter() - start
+
+    request_times.sort()
+    return {
+        'pictures_per_second': len(uploads) / duration,
+        'mb_per_second': sum(len(content) for content in uploads) / duration / 1e6,
+        'request_median_ms': request_times[len(request_times) // 2] * 1000,
+        'request_max_ms': request_times[-1] * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--count', type=int, default=20, help="The amount of uploads per format")
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2],
+                        help="The amounts of thumbnail worker processes to measure")
+    parser.add_argument('--output', help="The file to write the results to")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for image_format, content_type in (('JPEG', 'image/jpeg'), ('PNG', 'image/png')):
+            # The generated images contain random noise, so each upload has different content
+            uploads = []
+            for number in range(args.count + 1):
+                image = os.path.join(temp_dir, str(number))
+                generate_camera_image(image, args.width, args.height, image_format)
+                with open(image, 'rb') as image_file:
+                    uploads.append(image_file.read())
+
+            for workers in args.workers:
+                result = measure(uploads, content_type, workers)
+                result.update(format=image_format, workers=workers, uploads=args.count,
+                              megapixels=args.width * args.height / 1e6,
+                              mean_size=sum(len(content) for content in uploads[1:]) / args.count)
+                results.append(result)
+
+    report('ingest', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Measures cpu time (per upload and per megapixel of the raw image) and peak memory of the preview creation.
+
+Each engine runs in its own process, so that the peak memory of one engine doesn't hide the one of another.
+Results are printed as json.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from PIL import Image
+
+from berry_cam_server.common import thumbnails
+from .common import report
+from ..utils.image_generator import generate_camera_image
+
+
+def full_decode(raw_image, preview_image):
+    """
+    Decodes the image at native resolution before downscaling.
+    """
+    with Image.open(raw_image) as image:
+        image.load()
+        image.thumbnail((thumbnails.PREVIEW_SIZE, thumbnails.PREVIEW_SIZE), reducing_gap=None)
+        image.convert('RGB').save(preview_image, "JPEG")
+
+
+def pillow_thumbnail(raw_image, preview_image):
+    """
+    Plain Image.thumbnail, as used before the fast thumbnail engine.
+    """
+    with Image.open(raw_image) as image:
+        image.thumbnail((thumbnails.PREVIEW_SIZE, thumbnails.PREVIEW_SIZE))
+        image.convert('RGB').save(preview_image, "JPEG")
+
+
+def fast(raw_image, preview_image):
+    """
+    The fast thumbnail engine of the server, see thumbnails.load_scaled.
+    """
+    thumbnails.create_previews(raw_image, os.path.dirname(preview_image), 'preview')
+
+
+def fast_all_sizes(raw_image, preview_image):
+    """
+    The fast thumbnail engine of the server creating all default preview sizes.
+    """
+    thumbnails.create_previews(raw_image, os.path.dirname(preview_image), 'preview', thumbnails.DEFAULT_PREVIEW_SIZES)
+
+
+def fast_ingest_sizes(raw_image, preview_image):
+    """
+    The fast thumbnail engine of the server creating the preview sizes created on upload.
+    """
+    thumbnails.create_previews(raw_image, os.path.dirname(preview_image), 'preview',
+                               thumbnails.DEFAULT_INGEST_PREVIEW_SIZES)
+
+
+ENGINES = {
+    'full_decode': full_decode,
+    'pillow_thumbnail': pillow_thumbnail,
+    'fast': fast,
+    'fast_all_sizes': fast_all_sizes,
+    'fast_ingest_sizes': fast_ingest_sizes
+}
+
+
+def peak_memory_kb():
+    """
+    Returns the peak resident memory of the current process in kilobytes.
+    Uses the resettable peak from /proc on linux, since ru_maxrss is inherited from the parent process.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_memory():
+    """
+    Resets the peak resident memory of the current process to the current memory usage, if supported.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def measure(engine, raw_image, iterations, results):
+    """
+    Runs an engine several times and reports cpu time and peak memory. Runs in a separate process.
+    """
+    preview_image = raw_image + '.preview.jpg'
+    reset_peak_memory()
+    memory_before = peak_memory_kb()
+    cpu_before = time.process_time()
+
+    for _ in range(iterations):
+        ENGINES[engine](raw_image, preview_image)
+
+    results.put({
+        'cpu_ms_per_upload': (time.process_time() - cpu_before) * 1000 / iterations,
+        'peak_memory_kb': peak_memory_kb() - memory_before
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--width', type=int, default=3264)
+    parser.add_argument('--height', type=int, default=2448)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--output', help="The file to write the results to")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    measurements = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for image_format, extension in (('JPEG', 'jpg'), ('PNG', 'png')):
+            raw_image = os.path.join(temp_dir, 'raw.' + extension)
+            generate_camera_image(raw_image, args.width, args.height, image_format)
+
+            for engine in ENGINES:
+                results = context.Queue()
+                process = context.Process(target=measure, args=(engine, raw_image, args.iterations, results))
+                process.start()
+                result = results.get()
+                process.join()
+
+                megapixels = args.width * args.height / 1e6
+                result.update(engine=engine, format=image_format, megapixels=megapixels,
+                              cpu_ms_per_megapixel=result['cpu_ms_per_upload'] / megapixels,
+                              raw_size=os.path.getsize(raw_image))
+                measurements.append(result)
+
+    report('thumbnails', measurements, args.output)
+
+
+if __name__ == '__main__':
+    main()
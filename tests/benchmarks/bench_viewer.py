@@ -0,0 +1,59 @@
+"""
+Measures the latency of the viewer (viewer.index) depending on the size of the picture archive.
+
+For each archive size, the first page, a page in the middle of the archive and the first page of a single camera
+are requested. Results are printed as json.
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+from datetime import timezone
+
+from .common import benchmark_app, durations, report
+from ..utils.image_generator import generate_archive
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help="The amounts of pictures in the archive")
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', help="The file to write the results to")
+    args = parser.parse_args()
+
+    start_date = datetime.datetime(year=2020, month=1, day=1, tzinfo=timezone.utc)
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as upload_dir:
+            generation_start = time.perf_counter()
+            generate_archive(upload_dir, size, start_date)
+            generation_time = time.perf_counter() - generation_start
+
+            with benchmark_app(UPLOAD_DIR=upload_dir) as app:
+                client = app.test_client()
+                client.post('/auth/login', data={'username': 'test', 'password': 'test'})
+
+                # The cursor of the picture in the middle of the archive, see viewer._cursor
+                middle = start_date.timestamp() + size // 2
+                pages = {
+                    'first_page': '/',
+                    'middle_page': '/?before={!r}_{}-Camera1-000'.format(middle, int(middle * 100)),
+                    'camera_page': '/?camera=Camera2'
+                }
+
+                for page, url in pages.items():
+                    if client.get(url).status_code != 200:
+                        raise RuntimeError("Could not load {}".format(url))
+
+                    result = durations(lambda: client.get(url), args.iterations)
+                    result.update(archive_size=size, page=page, generation_s=generation_time,
+                                  index_mb=os.path.getsize(os.path.join(upload_dir, 'pictures.sqlite')) / 1e6)
+                    results.append(result)
+
+    report('viewer', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
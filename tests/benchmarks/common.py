@@ -0,0 +1,113 @@
+"""
+Helpers shared by the benchmarks.
+"""
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+from berry_cam_server import create_app, Config
+
+# The api key of the test user in the test config
+API_KEY = 'test_api_key'
+
+
+@contextmanager
+def benchmark_app(**config):
+    """
+    Creates an app with a copy of the test config and a temporary upload directory, like the app fixture of the tests.
+
+    :param config: Further app configuration, e.g. to use an existing upload directory.
+    :return: The app.
+    :rtype: Flask
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        Config.config_file = os.path.join(temp_dir, 'conf.yaml')
+        shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'conf.yaml'),
+                    Config.config_file)
+        Config.invalidate_cache()
+
+        upload_dir = os.path.join(temp_dir, 'uploads')
+        app = create_app(dict({
+            'TESTING': True,
+            'SECRET_KEY': 'dev',
+            'UPLOAD_DIR': upload_dir,
+            'SERVER_TIMING': False
+        }, **config))
+
+        try:
+            yield app
+        finally:
+            app.extensions['thumbnails'].shutdown()
+            if app.extensions['sprites'] is not None:
+                app.extensions['sprites'].flush()
+            app.extensions['picture_index'].close()
+            Config.camera_states.close()
+
+
+def durations(func, iterations):
+    """
+    Calls a function several times and measures each call.
+
+    :param function func: The function to measure.
+    :param int iterations: How often the function is called.
+    :return: The median, 95th percentile and mean duration in milliseconds and the calls per second.
+    :rtype: dict
+    """
+    measured = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        measured.append(time.perf_counter() - start)
+
+    measured.sort()
+    return {
+        'iterations': iterations,
+        'median_ms': statistics.median(measured) * 1000,
+        'p95_ms': measured[min(int(len(measured) * 0.95), len(measured) - 1)] * 1000,
+        'mean_ms': statistics.mean(measured) * 1000,
+        'per_second': iterations / sum(measured)
+    }
+
+
+def git_commit():
+    """
+    :return: The current git commit of the repository or None if not available.
+    :rtype: str
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(benchmark, results, output=None):
+    """
+    Writes the results of a benchmark as json, together with the commit and platform, so that results of different
+    commits can be compared.
+
+    :param str benchmark: The name of the benchmark.
+    :param list results: The results of the benchmark.
+    :param str output: The file to write the report to. Printed if not given.
+    """
+    content = json.dumps({
+        'benchmark': benchmark,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results
+    }, indent=2)
+
+    if output:
+        with open(output, 'w') as output_file:
+            output_file.write(content + '\n')
+    else:
+        print(content)
@@ -0,0 +1,20 @@
+import pytest
+
+from berry_cam_server.common.storage import FileSystemStorage, S3Storage
+from ..utils.fake_s3 import FakeS3Client
+
+
+@pytest.fixture(params=['filesystem', 's3'])
+def backend(request, tmp_path):
+    """
+    The storage backends to test. The s3 backend uses an in memory stand-in for the object store.
+
+    :param request: The pytest request, to get the backend name.
+    :param Path tmp_path: Temporary directory, the file system backend uses its storage subdirectory.
+    :return: The storage backend.
+    :rtype: Storage
+    """
+    if request.param == 'filesystem':
+        return FileSystemStorage(str(tmp_path / 'storage'))
+
+    return S3Storage(FakeS3Client(), 'pictures', 'berry_cam')
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+import yaml
+
+from berry_cam_server import Config
+from berry_cam_server.common.camera_state import CameraStates, settings_version
+
+
+def test_heartbeat_persisted_on_flush(tmp_path):
+    """
+    Verifies that heartbeats are kept in memory and only written to the database on flush.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    db_file = str(tmp_path / 'camera_state.sqlite')
+    states = CameraStates(db_file, flush_interval=60)
+    other_process = CameraStates(db_file, flush_interval=60)
+
+    states.heartbeat('Camera', True, 1000)
+    assert states.get('Camera') == {'last_connection': 1000, 'camera_enabled': True, 'enabled': False}
+    assert other_process.get('Camera') is None
+
+    states.flush()
+    assert other_process.get('Camera') == {'last_connection': 1000, 'camera_enabled': True, 'enabled': False}
+
+    states.close()
+    other_process.close()
+
+
+def test_user_changes_written_directly(tmp_path):
+    """
+    Verifies that enabling and removal of cameras is directly visible for other processes.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    db_file = str(tmp_path / 'camera_state.sqlite')
+    states = CameraStates(db_file, flush_interval=60)
+    other_process = CameraStates(db_file, flush_interval=60)
+
+    states.heartbeat('Camera', False, 1000)
+    states.set_enabled('Camera', True)
+    assert other_process.get('Camera')['enabled']
+    assert states.get('Camera')['enabled']
+
+    # Pending heartbeats of the other process are kept on refresh
+    other_process.heartbeat('Camera', True, 2000)
+    states.set_enabled('Camera', False)
+    assert other_process.get('Camera') == {'last_connection': 2000, 'camera_enabled': True, 'enabled': False}
+
+    states.remove('Camera')
+    assert 'Camera' not in states.get_all()
+
+    # Cameras only known to the other process are enabled once the other process writes their heartbeats
+    other_process.heartbeat('New camera', True, 3000)
+    states.set_enabled('New camera', True)
+    assert states.get('New camera')['enabled']
+    other_process.flush()
+    assert other_process.get('New camera') == {'last_connection': 3000, 'camera_enabled': True, 'enabled': True}
+    assert states.get('New camera') == {'last_connection': 3000, 'camera_enabled': True, 'enabled': True}
+
+    states.close()
+    other_process.close()
+
+
+def test_wait_for_change(tmp_path):
+    """
+    Verifies that waiting for a settings change returns directly on own changes and changes of other processes,
+    but not on heartbeats.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    db_file = str(tmp_path / 'camera_state.sqlite')
+    states = CameraStates(db_file, flush_interval=60)
+    other_process = CameraStates(db_file, flush_interval=60)
+
+    states.heartbeat('Camera', False, 1000)
+    states.flush()
+    version = settings_version(states.get('Camera'))
+
+    # Outdated versions are answered directly
+    assert states.wait_for_change('Camera', 'outdated', 10)['last_connection'] == 1000
+
+    # Heartbeats don't change the settings
+    threading.Timer(0.1, states.heartbeat, ('Camera', True, 2000)).start()
+    start = time.monotonic()
+    assert not states.wait_for_change('Camera', version, 0.5)['enabled']
+    assert time.monotonic() - start >= 0.5
+
+    threading.Timer(0.1, states.set_enabled, ('Camera', True)).start()
+    start = time.monotonic()
+    camera = states.wait_for_change('Camera', version, 10)
+    assert camera['enabled']
+    assert time.monotonic() - start < 5
+    version = settings_version(camera)
+
+    threading.Timer(0.1, other_process.set_enabled, ('Camera', False)).start()
+    start = time.monotonic()
+    assert not states.wait_for_change('Camera', version, 10, poll_interval=0.1)['enabled']
+    assert time.monotonic() - start < 5
+
+    states.close()
+    other_process.close()
+
+
+def test_migration_from_config(app, tmp_path):
+    """
+    Verifies that cameras stored in the config file are moved to the camera state store.
+
+    :param Flask app: The flask application, used to setup the temporary config file.
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    with open(Config.config_file, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+
+    config['cameras'] = {'Camera': {'last_connection': 1000, 'camera_enabled': True, 'enabled': True}}
+    with open(Config.config_file, 'w') as config_file:
+        yaml.safe_dump(config, config_file)
+
+    Config.open_camera_states(str(tmp_path / 'camera_state.sqlite'))
+
+    assert Config.get_connected_cameras() == {
+        'Camera': {'last_connection': 1000, 'camera_enabled': True, 'enabled': True}
+    }
+    with open(Config.config_file, 'r') as config_file:
+        assert 'cameras' not in yaml.safe_load(config_file)
+    assert os.path.exists(str(tmp_path / 'camera_state.sqlite'))
@@ -0,0 +1,105 @@
+import os
+import time
+
+import pytest
+import yaml
+
+from berry_cam_server import Config
+
+
+@pytest.fixture
+def parse_counter(app, monkeypatch):
+    """
+    Counts the parsing runs of the config file. Also moves the config file modification time into the past,
+    so that the config cache trusts the parsed content.
+
+    :param Flask app: The flask application, used to setup the temporary config file.
+    :param monkeypatch: The pytest monkeypatch fixture.
+    :return: A list that gets one entry appended per config file parse.
+    :rtype: list
+    """
+    past = time.time() - 60
+    os.utime(Config.config_file, (past, past))
+    Config.invalidate_cache()
+
+    parse_runs = []
+    safe_load = yaml.safe_load
+
+    def counting_safe_load(stream):
+        parse_runs.append(stream)
+        return safe_load(stream)
+
+    monkeypatch.setattr(yaml, 'safe_load', counting_safe_load)
+    return parse_runs
+
+
+def test_config_cache_reused(parse_counter):
+    """
+    Verifies that the config file is only parsed once as long as it does not change.
+
+    :param list parse_counter: The list of config file parse runs.
+    """
+    for _ in range(10):
+        assert Config.get_user_config('test')['api_key'] == 'test_api_key'
+        assert 'test_api_key' in Config.get_api_keys()
+
+    assert len(parse_counter) == 1
+
+
+def test_config_cache_returns_copies(parse_counter):
+    """
+    Verifies that modifications on returned configurations do not modify the cached configuration.
+
+    :param list parse_counter: The list of config file parse runs.
+    """
+    Config.get_user_config('test')['api_key'] = 'modified'
+
+    assert Config.get_user_config('test')['api_key'] == 'test_api_key'
+
+
+def test_config_cache_invalidated_on_write(parse_counter):
+    """
+    Verifies that the cache is invalidated if the config gets updated.
+
+    :param list parse_counter: The list of config file parse runs.
+    """
+    assert Config.get_user_config('test')['api_key'] == 'test_api_key'
+
+    new_key = Config.update_api_key('test')
+
+    assert Config.get_user_config('test')['api_key'] == new_key
+
+
+def test_config_cache_external_modification(parse_counter):
+    """
+    Verifies that the config file is parsed again if it was modified by someone else.
+
+    :param list parse_counter: The list of config file parse runs.
+    """
+    assert Config.get_user_config('test')['api_key'] == 'test_api_key'
+
+    with open(Config.config_file, 'r') as config_file:
+        config = yaml.load(config_file, Loader=yaml.SafeLoader)
+
+    config['user']['test']['api_key'] = 'external_key'
+    with open(Config.config_file, 'w') as config_file:
+        yaml.safe_dump(config, config_file)
+
+    assert Config.get_user_config('test')['api_key'] == 'external_key'
+    assert len(parse_counter) == 2
+
+
+def test_api_key_user(parse_counter):
+    """
+    Verifies that api keys are resolved to their users and that regenerated keys are used directly.
+
+    :param list parse_counter: The list of config file parse runs.
+    """
+    assert Config.get_api_key_user('test_api_key') == 'test'
+    assert Config.get_api_key_user('test_api_ke') is None
+    assert Config.get_api_key_user('') is None
+
+    new_key = Config.update_api_key('test')
+
+    assert Config.get_api_key_user('test_api_key') is None
+    assert Config.get_api_key_user(new_key) == 'test'
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+import pytest
+
+from berry_cam_server import Config
+from berry_cam_server.common.config_writer import ConfigWriter, ProcessLock
+
+
+def test_write_atomic(app):
+    """
+    Verifies that modifications are written and no temporary files are left behind.
+
+    :param Flask app: The flask application, used to setup the temporary config file.
+    """
+    new_key = Config.update_api_key('test')
+
+    assert Config.get_user_config('test')['api_key'] == new_key
+    assert sorted(os.listdir(os.path.dirname(Config.config_file))) == ['conf.yaml', 'conf.yaml.lock']
+
+
+def test_failing_modification(app):
+    """
+    Verifies that a failing modification raises its error and doesn't modify the config file.
+
+    :param Flask app: The flask application, used to setup the temporary config file.
+    """
+    writer = ConfigWriter()
+
+    def modification(config):
+        config["user"]["test"]["api_key"] = "modified"
+        raise KeyError("unknown")
+
+    with pytest.raises(KeyError):
+        writer.submit(Config.config_file, modification)
+
+    assert writer.writes == 0
+    assert Config.get_user_config('test')['api_key'] == 'test_api_key'
+
+
+def test_concurrent_modifications_coalesced(app):
+    """
+    Verifies that modifications queued during a running write are written together in a single write.
+
+    :param Flask app: The flask application, used to setup the temporary config file.
+    """
+    writer = ConfigWriter()
+    first_write_started = threading.Event()
+    release_first_write = threading.Event()
+
+    def blocking_modification(config):
+        first_write_started.set()
+        release_first_write.wait()
+        config["server"]["first"] = True
+
+    def indexed_modification(index):
+        def modification(config):
+            config["server"]["setting_{}".format(index)] = index
+            return index
+
+        return modification
+
+    results = []
+    threads = [threading.Thread(target=writer.submit, args=(Config.config_file, blocking_modification))]
+    threads[0].start()
+    first_write_started.wait()
+
+    for index in range(10):
+        thread = threading.Thread(
+            target=lambda i: results.append(writer.submit(Config.config_file, indexed_modification(i))), args=(index,))
+        thread.start()
+        threads.append(thread)
+
+    # Wait until all modifications are queued
+    while len(writer._pending) < 10:
+        time.sleep(0.01)
+
+    release_first_write.set()
+    for thread in threads:
+        thread.join()
+
+    Config.invalidate_cache()
+    assert writer.writes == 2
+    assert sorted(results) == list(range(10))
+    server_config = Config.get_server_config()
+    assert server_config["FIRST"]
+    assert [server_config["SETTING_{}".format(index)] for index in range(10)] == list(range(10))
+
+
+def test_process_lock(tmp_path):
+    """
+    Verifies that a process lock is only held by one holder at a time and can be taken over once released.
+
+    :param Path tmp_path: Temporary directory for the lock file.
+    """
+    first = ProcessLock(str(tmp_path / 'test.lock'))
+    second = ProcessLock(str(tmp_path / 'test.lock'))
+
+    assert first.acquire()
+    assert first.acquire()
+    assert not second.acquire()
+
+    first.release()
+    assert second.acquire()
+    assert not first.acquire()
+    second.release()
@@ -0,0 +1,71 @@
+import queue
+import time
+
+import pytest
+
+from berry_cam_server.common.events import PictureEvents
+from berry_cam_server.common.picture_index import PictureIndex
+
+
+def test_publish_to_all_subscribers():
+    """
+    Verifies that events are sent to all current subscribers and that full queues don't block the publisher.
+    """
+    events = PictureEvents(queue_size=1)
+
+    with events.subscribe() as first, events.subscribe() as second:
+        assert events.subscribers == 2
+
+        events.publish({'name': '1'})
+        events.publish({'name': '2'})
+
+        assert first.get_nowait() == {'name': '1'}
+        assert second.get_nowait() == {'name': '1'}
+        assert first.empty()
+
+    assert events.subscribers == 0
+
+    # Without subscribers, events are dropped
+    events.publish({'name': '3'})
+    with events.subscribe() as subscriber, pytest.raises(queue.Empty):
+        subscriber.get_nowait()
+
+
+def test_pictures_of_other_processes(tmp_path):
+    """
+    Verifies that pictures added to the picture index by other server processes are published once their previews
+    are created, and that pictures are only published once.
+
+    :param Path tmp_path: Temporary directory for the picture index.
+    """
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    other_process = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    now = time.time()
+    index.add('100', now - 3, 'jpg')
+    events = PictureEvents(index=index, poll_interval=60)
+
+    with events.subscribe() as subscriber:
+        # Pictures added before are not published
+        events.poll_once()
+        assert subscriber.empty()
+
+        other_process.add('200', now - 2, 'jpg', preview_status='pending')
+        other_process.add('300', now - 1, 'jpg')
+        events.poll_once()
+        assert subscriber.get_nowait() == {'name': '300'}
+        assert subscriber.empty()
+
+        other_process.update('200', preview_status='done')
+        events.poll_once()
+        assert subscriber.get_nowait() == {'name': '200'}
+
+        # Already published by this process
+        events.publish({'name': '400'})
+        other_process.add('400', now, 'jpg')
+        events.poll_once()
+        assert subscriber.get_nowait() == {'name': '400'}
+        assert subscriber.empty()
+
+    events.stop()
+    index.close()
+    other_process.close()
@@ -0,0 +1,58 @@
+import os
+
+from berry_cam_server.common import layout
+
+
+def test_shard_dir():
+    """
+    Verifies that pictures are sharded by the upload date in the name.
+    """
+    assert layout.shard_dir('157864380512-front-000') == '2020/01/10'
+    assert layout.shard_dir('157864380512') == '2020/01/10'
+    assert layout.shard_dir('test') is None
+    assert layout.picture_file('raw', '157864380512-front-000', 'jpg') == \
+        os.path.join('raw', '2020', '01', '10', '157864380512-front-000.jpg')
+    assert layout.picture_file('raw', 'test', 'jpg') == os.path.join('raw', 'test.jpg')
+
+
+def test_find_picture_file(tmp_path):
+    """
+    Verifies that pictures are found in the sharded layout and in the former flat layout.
+
+    :param Path tmp_path: Temporary directory for the pictures.
+    """
+    (tmp_path / '157864380512.jpg').touch()
+    assert layout.find_picture_file(str(tmp_path), '157864380512.jpg') == '157864380512.jpg'
+
+    (tmp_path / '2020' / '01' / '10').mkdir(parents=True)
+    (tmp_path / '2020' / '01' / '10' / '157864380512.jpg').touch()
+    assert layout.find_picture_file(str(tmp_path), '157864380512.jpg') == \
+        os.path.join('2020', '01', '10', '157864380512.jpg')
+
+    # Missing pictures resolve to the sharded layout
+    assert layout.find_picture_file(str(tmp_path), '157864380513.jpg') == \
+        os.path.join('2020', '01', '10', '157864380513.jpg')
+
+
+def test_migrate_flat_layout(tmp_path):
+    """
+    Verifies that flat directories are migrated to the sharded layout.
+
+    :param Path tmp_path: Temporary upload directory.
+    """
+    for directory in ('raw', 'previews', os.path.join('previews', '480')):
+        (tmp_path / directory).mkdir()
+
+    (tmp_path / 'raw' / '157864380512.png').touch()
+    (tmp_path / 'previews' / '157864380512.jpg').touch()
+    (tmp_path / 'previews' / '480' / '157864380512.jpg').touch()
+    (tmp_path / 'raw' / 'README').touch()
+
+    assert layout.migrate_flat_layout(str(tmp_path), (480,)) == 3
+    assert (tmp_path / 'raw' / '2020' / '01' / '10' / '157864380512.png').exists()
+    assert (tmp_path / 'previews' / '2020' / '01' / '10' / '157864380512.jpg').exists()
+    assert (tmp_path / 'previews' / '480' / '2020' / '01' / '10' / '157864380512.jpg').exists()
+    assert (tmp_path / 'raw' / 'README').exists()
+
+    # Running the migration again doesn't move anything
+    assert layout.migrate_flat_layout(str(tmp_path), (480,)) == 0
@@ -0,0 +1,132 @@
+import os
+from http import HTTPStatus
+
+import pytest
+
+from berry_cam_server import Config
+from berry_cam_server.common.metrics import Counter, Histogram, Metric, Registry
+
+
+def test_exposition_format():
+    """
+    Verifies that counters and histograms are rendered in the prometheus text format.
+    """
+    registry = Registry()
+    counter = Counter('test_bytes', 'Test bytes.', ['camera'], registry=registry)
+    histogram = Histogram('test_seconds', 'Test durations.', registry=registry, buckets=(1, 0.1))
+
+    counter.labels('Camera "1"').inc(10)
+    counter.labels('Camera "1"').inc(5)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.exposition().splitlines() == [
+        '# HELP test_bytes Test bytes.',
+        '# TYPE test_bytes counter',
+        'test_bytes_total{camera="Camera \\"1\\""} 15.0',
+        '# HELP test_seconds Test durations.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1.0',
+        'test_seconds_bucket{le="1.0"} 2.0',
+        'test_seconds_bucket{le="+Inf"} 3.0',
+        'test_seconds_count 3.0',
+        'test_seconds_sum 5.55',
+    ]
+
+    with pytest.raises(AttributeError):
+        counter.inc(1)
+    with pytest.raises(ValueError):
+        counter.labels()
+    with pytest.raises(ValueError):
+        counter.labels('Camera').inc(-1)
+    # Only the metric types can be created
+    with pytest.raises(TypeError):
+        Metric('test_metric', 'Test metric.', registry=registry)
+
+
+def test_shared_samples(tmpdir):
+    """
+    Verifies that the samples of all processes sharing a directory are summed up.
+
+    :param LocalPath tmpdir: The directory shared by the processes.
+    """
+    registries = [Registry(), Registry()]
+    for registry in registries:
+        counter = Counter('test_bytes', 'Test bytes.', ['camera'], registry=registry)
+        counter.labels('Camera').inc(10)
+        registry.share_samples(str(tmpdir), interval=60)
+    Counter('other_bytes', 'Other bytes.', registry=registries[1]).inc(5)
+
+    # Samples of other processes are only visible once written
+    assert registries[0].exposition().splitlines()[2] == 'test_bytes_total{camera="Camera"} 10.0'
+    registries[1].write_samples()
+
+    assert registries[0].exposition().splitlines() == [
+        '# HELP test_bytes Test bytes.',
+        '# TYPE test_bytes counter',
+        'test_bytes_total{camera="Camera"} 20.0',
+    ]
+    assert registries[1].exposition().splitlines() == [
+        '# HELP test_bytes Test bytes.',
+        '# TYPE test_bytes counter',
+        'test_bytes_total{camera="Camera"} 20.0',
+        '# HELP other_bytes Other bytes.',
+        '# TYPE other_bytes counter',
+        'other_bytes_total 5.0',
+    ]
+
+
+def test_metrics_endpoint(client, auth):
+    """
+    Verifies that uploads, config file reads and viewer pages are measured and shown by the metrics endpoint.
+
+    :param FlaskClient client: The flask client to use for the test.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    test_file = os.path.join(os.path.dirname(__file__), '..', 'api', 'test_data', 'test.jpg')
+
+    Config.set_camera_info('Metrics-Camera', True)
+
+    with client:
+        for camera in ('Metrics-Camera', 'Unknown-Camera'):
+            response = client.post('/api/picture/', data={'api_key': Config.get_user_config('test')['api_key'],
+                                                          'camera': camera,
+                                                          'file': (open(test_file, 'rb'), 'test.jpg')})
+            assert response.status_code == HTTPStatus.OK
+
+        assert client.get('/metrics').status_code == HTTPStatus.UNAUTHORIZED
+
+        auth.login()
+        client.get('/')
+
+        response = client.get('/metrics')
+        assert response.status_code == HTTPStatus.OK
+        assert response.mimetype == 'text/plain'
+
+        metrics = response.data.decode()
+        assert 'berrycam_ingested_bytes_total{{camera="Metrics-Camera"}} {!r}'.format(
+            float(os.path.getsize(test_file))) in metrics
+        # Cameras that never connected are not added as label
+        assert 'Unknown-Camera' not in metrics
+        assert 'berrycam_ingested_bytes_total{camera="other"}' in metrics
+        for phase in ('total', 'save', 'thumbnail'):
+            assert 'berrycam_upload_duration_seconds_count{{phase="{}"}}'.format(phase) in metrics
+        assert 'berrycam_config_io_duration_seconds_count{operation="read"}' in metrics
+        assert 'berrycam_viewer_render_duration_seconds_count ' in metrics
+        assert 'berrycam_viewer_scanned_pictures_total ' in metrics
+        assert 'berrycam_upload_collisions_total ' in metrics
+
+
+def test_metrics_token(app, client):
+    """
+    Verifies that the metrics can be read with the metrics token instead of a logged in user.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    app.config['METRICS_TOKEN'] = 'metrics_token'
+
+    assert client.get('/metrics').status_code == HTTPStatus.UNAUTHORIZED
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == HTTPStatus.UNAUTHORIZED
+    assert client.get('/metrics', headers={'Authorization': 'Bearer metrics_token'}).status_code == HTTPStatus.OK
@@ -0,0 +1,52 @@
+from PIL import Image
+
+from berry_cam_server.common import near_duplicates
+from berry_cam_server.common.near_duplicates import NearDuplicateFilter, difference_hash, hamming_distance
+from berry_cam_server.common.picture_index import PictureIndex
+from berry_cam_server.common.storage import FileSystemStorage
+from ..utils.image_generator import generate_camera_image
+
+
+def test_difference_hash(tmp_path):
+    """
+    Verifies that similar images have similar hashes and different images don't.
+
+    :param Path tmp_path: Temporary directory for the images.
+    """
+    for index in range(2):
+        generate_camera_image(str(tmp_path / '{}.jpg'.format(index)), 320, 240)
+
+    with Image.open(str(tmp_path / '0.jpg')) as first, Image.open(str(tmp_path / '1.jpg')) as second:
+        first_hash = difference_hash(first)
+        assert len(first_hash) == 16
+        assert hamming_distance(first_hash, difference_hash(second)) < 5
+        other_scene = Image.linear_gradient('L').rotate(90).resize(first.size)
+        assert hamming_distance(first_hash, difference_hash(other_scene)) > 20
+
+    assert hamming_distance('00ff', '0f0f') == 8
+
+
+def test_check(tmp_path):
+    """
+    Verifies that near duplicates are compared with the last accepted frame of the same camera.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    for name in ('100', '200', '300', '400'):
+        index.add(name, float(name), 'jpg', camera='front')
+    index.add('250', 2.5, 'jpg', camera='back', frame_hash='0000000000000000')
+
+    duplicate_filter = NearDuplicateFilter(FileSystemStorage(str(tmp_path)), index, threshold=3)
+    assert not duplicate_filter.check('100', '0000000000000000')
+    assert duplicate_filter.check('200', '0000000000000003')
+    assert index.get('200')['near_duplicate_of'] == '100'
+
+    # Compared with the last accepted frame, not with the last near duplicate
+    assert not duplicate_filter.check('300', '0000000000000007')
+    assert index.get('300')['near_duplicate_of'] is None
+
+    duplicate_filter.action = near_duplicates.DROP
+    assert duplicate_filter.check('400', '0000000000000006')
+    assert index.get('400') is None
+    assert duplicate_filter.stats() == {'marked': 1, 'dropped': 1}
@@ -0,0 +1,180 @@
+import datetime
+import multiprocessing
+import os
+
+from berry_cam_server.common.picture_index import PictureIndex
+from ..utils.image_generator import generate_test_images
+
+
+def test_latest_ordering(tmp_path):
+    """
+    Verifies that the latest pictures are returned newest first.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    index.add('200', 2.0, 'jpg', camera='Camera', user='test')
+    index.add('100', 1.0, 'png')
+    index.add('300', 3.0, 'jpg')
+
+    assert [picture['name'] for picture in index.latest()] == ['300', '200', '100']
+    assert [picture['name'] for picture in index.latest(2)] == ['300', '200']
+    assert index.latest()[1]['camera'] == 'Camera'
+    assert index.count() == 3
+
+    index.clear()
+    assert index.count() == 0
+
+
+def test_oldest_and_remove(tmp_path):
+    """
+    Verifies that the oldest pictures can be selected and removed, e.g. for the retention policies.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    index.add('100', 1.0, 'jpg', camera='Front', raw_size=10, preview_size=1)
+    index.add('200', 2.0, 'jpg', camera='Back', raw_size=20)
+    index.add('300', 3.0, 'jpg', camera='Front', raw_size=30, preview_size=3)
+    index.add('400', 4.0, 'jpg')
+
+    assert [picture['name'] for picture in index.oldest(2)] == ['100', '200']
+    assert [picture['name'] for picture in index.oldest(10, before=3.0)] == ['100', '200']
+    assert [picture['name'] for picture in index.oldest(10, camera='Front')] == ['100', '300']
+    assert index.camera_counts() == {'Front': 2, 'Back': 1, None: 1}
+    assert index.cameras() == ['Back', 'Front']
+    assert index.total_size() == 64
+
+    index.remove(['100'])
+    assert index.cameras() == ['Back', 'Front']
+    index.remove(['300'])
+    assert [picture['name'] for picture in index.latest()] == ['400', '200']
+    assert index.cameras() == ['Back']
+
+
+def test_cameras_of_existing_index(tmp_path):
+    """
+    Verifies that the cameras are taken from the pictures of indexes created before cameras were stored separately.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    db_file = str(tmp_path / PictureIndex.FILE_NAME)
+    index = PictureIndex(db_file)
+    index.add('100', 1.0, 'jpg', camera='Front')
+    index.add('200', 2.0, 'jpg')
+    index._db.execute('DROP TABLE cameras')
+    index.close()
+
+    index = PictureIndex(db_file)
+    assert index.cameras() == ['Front']
+    index.close()
+
+
+def test_last_accepted_frame(tmp_path):
+    """
+    Verifies that the last accepted frame of a camera skips near duplicates and pictures without frame hash.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    index.add('100', 1.0, 'jpg', camera='Front', frame_hash='a')
+    index.add('200', 2.0, 'jpg', camera='Back', frame_hash='b')
+    index.add('300', 3.0, 'jpg', camera='Front', frame_hash='c', near_duplicate_of='100')
+    index.add('400', 4.0, 'jpg', camera='Front')
+    index.add('500', 5.0, 'jpg', camera='Front')
+
+    assert index.last_accepted_frame(index.get('500'))['name'] == '100'
+    assert index.last_accepted_frame(index.get('100')) is None
+    assert index.last_accepted_frame(index.get('200')) is None
+
+
+def add_deduplicated_pictures(db_file, process, count):
+    """
+    Adds pictures with partly identical content to the picture index, see test_concurrent_processes.
+
+    :param str db_file: The database file of the picture index.
+    :param int process: The number of the process.
+    :param int count: The amount of pictures to add.
+    """
+    index = PictureIndex(db_file)
+    for number in range(count):
+        index.add_deduplicated([{'name': '{}-{}'.format(process, number), 'timestamp': float(number),
+                                 'raw_extension': 'jpg', 'content_hash': str(number % 10)}])
+    index.close()
+
+
+def test_concurrent_processes(tmp_path):
+    """
+    Verifies that multiple server processes can add pictures at the same time, without database is locked errors.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    db_file = str(tmp_path / PictureIndex.FILE_NAME)
+    PictureIndex(db_file).close()
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=add_deduplicated_pictures, args=(db_file, process, 100))
+                 for process in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+
+    assert [process.exitcode for process in processes] == [0, 0, 0, 0]
+    index = PictureIndex(db_file)
+    assert index.count() == 400
+    index.close()
+
+
+def test_add_deduplicated(tmp_path):
+    """
+    Verifies that pictures with known content reference the blob of the first picture with that content.
+
+    :param Path tmp_path: Temporary directory for the database.
+    """
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    new_pictures = index.add_deduplicated([
+        {'name': '100', 'timestamp': 1.0, 'raw_extension': 'jpg', 'content_hash': 'a', 'preview_status': 'pending'},
+        {'name': '200', 'timestamp': 2.0, 'raw_extension': 'png', 'content_hash': 'a', 'preview_status': 'pending'},
+        {'name': '300', 'timestamp': 3.0, 'raw_extension': 'jpg', 'content_hash': 'b', 'preview_status': 'pending'}
+    ])
+    assert [picture['name'] for picture in new_pictures] == ['100', '300']
+    assert index.get('200')['blob_name'] == '100'
+    assert index.get('200')['raw_extension'] == 'jpg'
+
+    # The preview state is shared by all pictures of a blob
+    index.update_blob('100', preview_status='done', preview_size=10)
+    assert index.get('200')['preview_status'] == 'done'
+    assert index.get('300')['preview_status'] == 'pending'
+
+    assert not index.add_deduplicated([{'name': '400', 'timestamp': 4.0, 'raw_extension': 'jpg', 'content_hash': 'a'}])
+    assert index.get('400')['preview_size'] == 10
+
+    # Pictures whose raw image is still stored can't be referenced
+    assert index.add_deduplicated([{'name': '500', 'timestamp': 5.0, 'raw_extension': 'jpg', 'content_hash': 'c',
+                                    'preview_status': 'storing'}])
+    assert index.add_deduplicated([{'name': '600', 'timestamp': 6.0, 'raw_extension': 'jpg', 'content_hash': 'c'}])
+    index.remove(['500', '600'])
+
+    index.remove(['100'])
+    assert index.find_blob('100')['name'] in ('200', '400')
+    index.remove(['200', '400'])
+    assert index.find_blob('100') is None
+
+
+def test_import_existing_pictures(app):
+    """
+    Verifies that pictures uploaded before the index existed are imported on creation of the index.
+
+    :param Flask app: The flask application, used for its upload directory.
+    """
+    upload_dir = app.config['UPLOAD_DIR']
+    generate_test_images(upload_dir, 4, datetime.datetime(year=2020, month=1, day=10, hour=8, minute=10, second=5))
+    os.remove(os.path.join(upload_dir, PictureIndex.FILE_NAME))
+
+    index = PictureIndex.for_upload_dir(upload_dir)
+
+    pictures = index.latest()
+    assert len(pictures) == 4
+    assert [picture['raw_extension'] for picture in pictures] == ['jpg', 'png', 'jpg', 'png']
+    assert all(picture['raw_size'] and picture['preview_size'] for picture in pictures)
@@ -0,0 +1,111 @@
+import time
+
+import pytest
+from PIL import Image
+
+from berry_cam_server.common import recompression
+from berry_cam_server.common.layout import picture_file
+from berry_cam_server.common.picture_index import PictureIndex
+from berry_cam_server.common.recompression import RecompressionService
+from berry_cam_server.common.storage import FileSystemStorage
+from ..utils.image_generator import generate_camera_image
+
+
+def add_picture(storage, index, tmp_path, name, extension='png', image_format='PNG'):
+    """
+    Stores a generated picture and adds it to the index.
+
+    :param Storage storage: The storage to store the picture in.
+    :param PictureIndex index: The picture index.
+    :param Path tmp_path: Temporary directory to generate the picture in.
+    :param str name: The name of the picture.
+    :param str extension: The extension of the raw image.
+    :param str image_format: The format of the raw image.
+    :return: The size of the raw image.
+    :rtype: int
+    """
+    raw_image = str(tmp_path / '{}.{}'.format(name, extension))
+    generate_camera_image(raw_image, 320, 240, image_format)
+    size = storage.put_file(picture_file('raw', name, extension), raw_image)
+    index.add(name, time.time(), extension, raw_size=size)
+    return size
+
+
+def test_recompress(backend, tmp_path):
+    """
+    Verifies that PNG raw images are replaced by smaller WebP images.
+
+    :param Storage backend: The backend backend to test with.
+    :param Path tmp_path: Temporary directory for the index and the generated pictures.
+    """
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    original_size = add_picture(backend, index, tmp_path, '157864380512')
+    add_picture(backend, index, tmp_path, '157864380513', 'jpg', 'JPEG')
+
+    service = RecompressionService(backend, index, 'WEBP', quality=75)
+    assert service.run_once() == 1
+
+    picture = index.get('157864380512')
+    assert picture['raw_extension'] == 'webp'
+    assert picture['original_size'] == original_size
+    assert not backend.exists(picture_file('raw', '157864380512', 'png'))
+    assert backend.exists(picture_file('raw', '157864380512', 'webp'))
+
+    download = str(tmp_path / 'download.webp')
+    with open(download, 'wb') as raw_file:
+        raw_file.write(b''.join(backend.stream(picture_file('raw', '157864380512', 'webp'))))
+    with Image.open(download) as image:
+        assert image.format == 'WEBP'
+        assert image.size == (320, 240)
+
+    stats = service.stats()
+    assert stats['recompressed_pictures'] == 1
+    assert stats['saved_bytes'] == original_size - picture['raw_size'] > 0
+
+    # Nothing left to recompress
+    assert service.run_once() == 0
+
+
+def test_invalid_images_skipped(tmp_path):
+    """
+    Verifies that raw images which can't be recompressed are kept and not retried.
+
+    :param Path tmp_path: Temporary directory for the storage and the index.
+    """
+    storage = FileSystemStorage(str(tmp_path))
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    with open(str(tmp_path / 'broken.png'), 'wb') as raw_file:
+        raw_file.write(b'no image')
+    storage.put_file(picture_file('raw', '157864380512', 'png'), str(tmp_path / 'broken.png'))
+    index.add('157864380512', time.time(), 'png', raw_size=8)
+
+    service = RecompressionService(storage, index, 'AVIF')
+    assert service.run_once() == 1
+    assert index.get('157864380512')['raw_extension'] == 'png'
+    assert storage.exists(picture_file('raw', '157864380512', 'png'))
+    assert service.stats()['skipped_pictures'] == 1
+    assert service.run_once() == 0
+
+
+def test_unsupported_format(tmp_path):
+    """
+    Verifies that only supported formats can be configured.
+
+    :param Path tmp_path: Temporary directory for the index.
+    """
+    with pytest.raises(ValueError):
+        RecompressionService(FileSystemStorage(str(tmp_path)), None, 'GIF')
+
+    assert not RecompressionService(FileSystemStorage(str(tmp_path)), None).enabled
+
+
+def test_format_not_supported_by_pillow(tmp_path, monkeypatch):
+    """
+    Verifies that formats the installed Pillow can't write are rejected on start instead of failing each picture.
+
+    :param Path tmp_path: Temporary directory for the storage.
+    :param monkeypatch: Used to disable the Pillow features.
+    """
+    monkeypatch.setattr(recompression.features, 'check', lambda feature: False)
+    with pytest.raises(ValueError):
+        RecompressionService(FileSystemStorage(str(tmp_path)), None, 'WEBP')
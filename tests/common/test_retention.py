@@ -0,0 +1,204 @@
+import os
+import time
+
+import pytest
+
+from berry_cam_server.common.config_writer import ProcessLock
+from berry_cam_server.common.layout import picture_file
+from berry_cam_server.common.picture_index import PictureIndex
+from berry_cam_server.common.retention import RetentionService
+from berry_cam_server.common.storage import FileSystemStorage
+
+
+@pytest.fixture
+def index(tmp_path):
+    """
+    A picture index with six pictures of two cameras, one per hour, the newest one uploaded now.
+    Each picture has a raw image of 1000 bytes and previews of 100 bytes.
+
+    :param Path tmp_path: Temporary upload directory.
+    :return: The picture index.
+    :rtype: PictureIndex
+    """
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    now = time.time()
+    for hour in range(6):
+        timestamp = now - (5 - hour) * 60 * 60
+        name = '{}-{}-000'.format(int(timestamp * 100), 'front' if hour % 2 else 'back')
+        for file, size in ((picture_file(str(tmp_path / 'raw'), name, 'jpg'), 1000),
+                           (picture_file(str(tmp_path / 'previews'), name, 'jpg'), 100),
+                           (picture_file(str(tmp_path / 'previews' / '480'), name, 'jpg'), 100)):
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, 'wb') as picture:
+                picture.write(b'0' * size)
+
+        index.add(name, timestamp, 'jpg', raw_size=1000, preview_size=100,
+                  camera='front' if hour % 2 else 'back')
+
+    yield index
+    index.close()
+
+
+def remaining_files(upload_dir):
+    """
+    :param Path upload_dir: The upload directory.
+    :return: The amount of files in the upload directory, without the picture index.
+    :rtype: int
+    """
+    return sum(1 for _, _, files in os.walk(str(upload_dir)) for file in files if not file.startswith('pictures.'))
+
+
+def test_max_age(tmp_path, index):
+    """
+    Verifies that pictures older than the maximum age are deleted in batches, together with all previews.
+
+    :param Path tmp_path: Temporary upload directory.
+    :param PictureIndex index: The picture index.
+    """
+    service = RetentionService(FileSystemStorage(str(tmp_path)), index, (128, 480), max_age=150 * 60, batch_size=1)
+
+    assert service.run_once() == 3
+    assert index.count() == 3
+    assert remaining_files(tmp_path) == 9
+
+    stats = service.stats()
+    assert stats['runs'] == 1
+    assert stats['deleted_pictures'] == 3
+    assert stats['reclaimed_bytes'] == 3 * 1200
+    assert stats['policies']['max_age'] == 150 * 60
+
+    # Nothing left to delete
+    assert service.run_once() == 0
+
+
+def test_max_pictures_per_camera(tmp_path, index):
+    """
+    Verifies that only the newest pictures of each camera are kept.
+
+    :param Path tmp_path: Temporary upload directory.
+    :param PictureIndex index: The picture index.
+    """
+    newest = [picture['name'] for picture in index.latest(4)]
+    service = RetentionService(FileSystemStorage(str(tmp_path)), index, (128, 480), max_pictures_per_camera=2)
+
+    assert service.run_once() == 2
+    assert [picture['name'] for picture in index.latest()] == newest
+    assert index.camera_counts() == {'front': 2, 'back': 2}
+
+
+def test_max_bytes(tmp_path, index):
+    """
+    Verifies that the oldest pictures are deleted until all pictures fit into the maximum size.
+
+    :param Path tmp_path: Temporary upload directory.
+    :param PictureIndex index: The picture index.
+    """
+    service = RetentionService(FileSystemStorage(str(tmp_path)), index, (128, 480), max_bytes=2500, batch_size=2)
+
+    assert service.run_once() == 4
+    assert index.total_size() == 2200
+    assert remaining_files(tmp_path) == 6
+
+
+def test_background_thread(tmp_path, index):
+    """
+    Verifies that the policies are applied periodically by the background thread.
+
+    :param Path tmp_path: Temporary upload directory.
+    :param PictureIndex index: The picture index.
+    """
+    service = RetentionService(FileSystemStorage(str(tmp_path)), index, max_age=30 * 60, interval=0.01)
+    assert service.enabled
+    service.start()
+
+    for _ in range(500):
+        if index.count() == 1:
+            break
+        time.sleep(0.01)
+
+    service.stop()
+    assert index.count() == 1
+    assert service.stats()['runs'] >= 1
+
+
+def test_background_thread_single_process(tmp_path, index):
+    """
+    Verifies that the policies are only applied by the process holding the process lock.
+
+    :param Path tmp_path: Temporary upload directory.
+    :param PictureIndex index: The picture index.
+    """
+    other_process = ProcessLock(str(tmp_path / 'retention.lock'))
+    assert other_process.acquire()
+
+    service = RetentionService(FileSystemStorage(str(tmp_path)), index, max_age=30 * 60, interval=0.01,
+                               process_lock=ProcessLock(str(tmp_path / 'retention.lock')))
+    service.start()
+    time.sleep(0.1)
+    assert index.count() == 6
+    assert service.stats()['runs'] == 0
+
+    # Taken over once the other process stopped
+    other_process.release()
+    for _ in range(500):
+        if index.count() == 1:
+            break
+        time.sleep(0.01)
+
+    service.stop()
+    assert index.count() == 1
+    assert other_process.acquire()
+
+
+def test_cleanup(tmp_path, index):
+    """
+    Verifies that all pictures uploaded before the cleanup are deleted in the background.
+
+    :param Path tmp_path: Temporary upload directory.
+    :param PictureIndex index: The picture index.
+    """
+    index.add('new', time.time() + 60, 'jpg')
+    service = RetentionService(FileSystemStorage(str(tmp_path)), index, (128, 480), batch_size=2)
+    assert not service.enabled
+
+    service.start_cleanup().join(timeout=60)
+
+    assert [picture['name'] for picture in index.latest()] == ['new']
+    assert remaining_files(tmp_path) == 0
+    assert service.stats()['deleted_pictures'] == 6
+
+
+def test_disabled_without_policies(tmp_path, index):
+    """
+    Verifies that no thread is started if no policy is configured.
+
+    :param Path tmp_path: Temporary upload directory.
+    :param PictureIndex index: The picture index.
+    """
+    service = RetentionService(FileSystemStorage(str(tmp_path)), index)
+    assert not service.enabled
+    service.start()
+    assert service._thread is None
+
+
+def test_shared_blobs_kept(tmp_path, index):
+    """
+    Verifies that the files of pictures are kept as long as duplicates of the picture are left.
+
+    :param Path tmp_path: Temporary upload directory.
+    :param PictureIndex index: The picture index.
+    """
+    oldest = index.oldest(1)[0]
+    index.update(oldest['name'], content_hash='hash', blob_name=oldest['name'])
+    assert not index.add_deduplicated([{'name': oldest['name'][:-1] + '1', 'timestamp': time.time(),
+                                        'raw_extension': 'jpg', 'content_hash': 'hash'}])
+
+    service = RetentionService(FileSystemStorage(str(tmp_path)), index, (128, 480), max_age=270 * 60)
+
+    assert service.run_once() == 1
+    assert remaining_files(tmp_path) == 18
+    assert service.stats()['reclaimed_bytes'] == 0
+
+    service.max_age = 0
+    assert service.run_once() == 6
+    assert remaining_files(tmp_path) == 0
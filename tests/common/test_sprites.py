@@ -0,0 +1,106 @@
+from PIL import Image
+
+from berry_cam_server.common import sprites
+from berry_cam_server.common.picture_index import PictureIndex
+from berry_cam_server.common.retention import delete_pictures
+from berry_cam_server.common.sprites import SpriteSheets, sprite_key
+from berry_cam_server.common.storage import FileSystemStorage
+
+COLORS = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+
+
+def add_previews(tmp_path, sheets, index, timestamp=3600.0):
+    """
+    Adds single colored previews of three pictures to the sprite sheets.
+
+    :param Path tmp_path: Temporary directory for the previews.
+    :param SpriteSheets sheets: The sprite sheets.
+    :param PictureIndex index: The picture index.
+    :param float timestamp: The upload timestamp of the pictures.
+    :return: The sprite sheet and slot of each picture.
+    :rtype: list
+    """
+    positions = []
+    for number, color in enumerate(COLORS):
+        name = str(number)
+        index.add(name, timestamp, 'jpg')
+        Image.new('RGB', (128, 64), color).save(str(tmp_path / '{}.jpg'.format(name)))
+        positions.append(sheets.add(name, timestamp, str(tmp_path / '{}.jpg'.format(name))))
+
+    return positions
+
+
+def test_add(tmp_path):
+    """
+    Verifies that previews are added to consecutive cells of a sprite sheet and that the cells are only assigned to
+    the pictures once the sprite sheet is written.
+
+    :param Path tmp_path: Temporary directory for the storage.
+    """
+    storage = FileSystemStorage(str(tmp_path))
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    sheets = SpriteSheets(storage, index, str(tmp_path / 'sprites.lock'), delay=60)
+
+    assert add_previews(tmp_path, sheets, index) == [('1-000', 0), ('1-000', 1), ('1-000', 2)]
+    assert index.get('2')['sprite'] is None
+    assert not storage.exists(sprite_key('1-000'))
+
+    # All previews are written at once
+    sheets.flush()
+    assert [(index.get(str(slot))['sprite_slot'], index.get(str(slot))['sprite_version']) for slot in range(3)] == \
+        [(0, 1), (1, 1), (2, 1)]
+    assert sheets.add('2', 3600.0, str(tmp_path / '2.jpg')) == ('1-000', 2)
+
+    with Image.open(storage.local_path(sprite_key('1-000'))) as sprite_sheet:
+        assert sprite_sheet.size == (sprites.GRID_SIZE * 128, sprites.GRID_SIZE * 128)
+        for slot in range(len(COLORS)):
+            x, y = sprites.cell_position(slot)
+            # The previews are centered in the cells and the sheets are stored losslessly
+            with Image.open(str(tmp_path / '{}.jpg'.format(slot))) as preview:
+                assert sprite_sheet.getpixel((x + 64, y + 64)) == preview.getpixel((64, 32))
+            assert sprite_sheet.getpixel((x + 64, y + 10)) == sprites.BACKGROUND_COLOR
+
+    # Removed pictures are not added
+    assert sheets.add('missing', 3600.0, str(tmp_path / '0.jpg')) is None
+
+
+def test_full_sprite_sheets(tmp_path, monkeypatch):
+    """
+    Verifies that a new sprite sheet is started once a sheet is full and that unused sheets are deleted.
+
+    :param Path tmp_path: Temporary directory for the storage.
+    :param monkeypatch: Used to reduce the size of the sprite sheets.
+    """
+    monkeypatch.setattr(sprites, 'GRID_SIZE', 1)
+    storage = FileSystemStorage(str(tmp_path))
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    sheets = SpriteSheets(storage, index, str(tmp_path / 'sprites.lock'), delay=0)
+
+    assert add_previews(tmp_path, sheets, index, 7300.0) == [('2-000', 0), ('2-001', 0), ('2-002', 0)]
+
+    delete_pictures(storage, index, [index.get('0')], ())
+    assert not storage.exists(sprite_key('2-000'))
+    assert storage.exists(sprite_key('2-001'))
+
+
+def test_slots_not_reused(tmp_path):
+    """
+    Verifies that the slots of removed pictures are not assigned again, so that the cells never change.
+
+    :param Path tmp_path: Temporary directory for the storage.
+    """
+    storage = FileSystemStorage(str(tmp_path))
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    sheets = SpriteSheets(storage, index, str(tmp_path / 'sprites.lock'), delay=0)
+
+    add_previews(tmp_path, sheets, index)
+    delete_pictures(storage, index, [index.get('2')], ())
+
+    index.add('3', 3600.0, 'jpg')
+    assert sheets.add('3', 3600.0, str(tmp_path / '0.jpg')) == ('1-000', 3)
+
+    # Also after reopening the index
+    index.close()
+    index = PictureIndex(str(tmp_path / PictureIndex.FILE_NAME))
+    assert index.reserve_sprite('4', '1', 100) == ('1-000', 4)
+    assert index.get('3')['sprite_version'] == 4
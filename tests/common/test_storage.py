@@ -0,0 +1,148 @@
+import errno
+import io
+import os
+
+import pytest
+
+from berry_cam_server.common import storage
+from berry_cam_server.common.storage import FileSystemStorage, S3Storage, Storage
+from ..utils.fake_s3 import FakeS3Client
+
+
+def test_save_open_delete(backend):
+    """
+    Verifies that files can be stored, read and deleted.
+
+    :param Storage backend: The storage backend to test.
+    """
+    key = 'raw/2020/01/10/157864380512-front-000.jpg'
+    assert not backend.exists(key)
+
+    assert backend.save(key, io.BytesIO(b'picture')) == 7
+    assert backend.exists(key)
+    with backend.open(key) as stream:
+        assert stream.read() == b'picture'
+    assert b''.join(backend.stream(key, chunk_size=2)) == b'picture'
+
+    assert backend.delete(key) == 7
+    assert not backend.exists(key)
+    assert backend.delete(key) == 0
+
+    with pytest.raises(FileNotFoundError):
+        backend.open(key)
+
+
+def test_put_file(backend, tmp_path):
+    """
+    Verifies that local files are moved into the storage.
+
+    :param Storage backend: The storage backend to test.
+    :param Path tmp_path: Temporary directory for the local file.
+    """
+    local_file = tmp_path / 'upload.tmp'
+    local_file.write_bytes(b'picture')
+
+    assert backend.put_file('previews/157864380512.jpg', str(local_file)) == 7
+    assert not local_file.exists()
+    assert b''.join(backend.stream('previews/157864380512.jpg')) == b'picture'
+
+
+def test_put_file_other_file_system(tmp_path, monkeypatch):
+    """
+    Verifies that local files on another file system, e.g. a temporary directory on tmpfs, are copied.
+
+    :param Path tmp_path: Temporary directory for the storage and the local file.
+    :param monkeypatch: Used to let renames of the local file fail like across file systems.
+    """
+    backend = FileSystemStorage(str(tmp_path / 'storage'))
+    local_file = tmp_path / 'sprite.png'
+    local_file.write_bytes(b'picture')
+
+    replace = os.replace
+
+    def cross_device_replace(source, destination):
+        if source == str(local_file):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        replace(source, destination)
+
+    monkeypatch.setattr(storage.os, 'replace', cross_device_replace)
+
+    assert backend.put_file('sprites/1-000.png', str(local_file)) == 7
+    assert not local_file.exists()
+    assert b''.join(backend.stream('sprites/1-000.png')) == b'picture'
+    assert os.listdir(str(tmp_path / 'storage' / 'sprites')) == ['1-000.png']
+
+
+def test_list(backend):
+    """
+    Verifies that all files in a directory are listed, including sub directories.
+
+    :param Storage backend: The storage backend to test.
+    """
+    keys = ['raw/2020/01/10/1.jpg', 'raw/2020/01/11/2.png', 'raw/3.jpg']
+    for key in keys + ['previews/1.jpg']:
+        backend.save(key, io.BytesIO(b'picture'))
+
+    assert sorted(backend.list('raw')) == sorted(keys)
+
+    for key in keys:
+        backend.delete(key)
+    assert list(backend.list('raw')) == []
+
+
+def test_invalid_keys(backend):
+    """
+    Verifies that keys can't point outside of the storage.
+
+    :param Storage backend: The storage backend to test.
+    """
+    assert not backend.exists('../conf.yaml')
+    with pytest.raises(FileNotFoundError):
+        backend.open('raw/../../conf.yaml')
+
+
+def test_incomplete_backend():
+    """
+    Verifies that storage backends must implement all abstract methods.
+    """
+    class IncompleteStorage(Storage):
+        def save(self, key, stream):
+            return 0
+
+    with pytest.raises(TypeError):
+        IncompleteStorage()
+
+
+def test_file_system_removes_empty_directories(tmp_path):
+    """
+    Verifies that empty shard directories are removed together with their last file.
+
+    :param Path tmp_path: Temporary directory for the storage.
+    """
+    backend = FileSystemStorage(str(tmp_path))
+    backend.save('raw/2020/01/10/1.jpg', io.BytesIO(b'picture'))
+    assert backend.local_path('raw/2020/01/10/1.jpg') == os.path.join(str(tmp_path), 'raw', '2020', '01', '10', '1.jpg')
+
+    backend.delete('raw/2020/01/10/1.jpg')
+    assert os.listdir(str(tmp_path)) == ['raw']
+    assert os.listdir(str(tmp_path / 'raw')) == []
+
+
+def test_s3_multipart_upload(monkeypatch):
+    """
+    Verifies that large files are uploaded in chunks.
+
+    :param monkeypatch: Used to reduce the chunk size.
+    """
+    monkeypatch.setattr(storage, 'CHUNK_SIZE', 4)
+    client = FakeS3Client()
+    backend = S3Storage(client, 'pictures')
+
+    assert backend.save('raw/1.jpg', io.BytesIO(b'0123456789')) == 10
+    assert client.uploaded_parts == 3
+    assert client.objects[('pictures', 'raw/1.jpg')] == b'0123456789'
+    assert backend.local_path('raw/1.jpg') is None
+
+    # Small files are uploaded at once
+    backend.save('raw/2.jpg', io.BytesIO(b'012'))
+    assert client.uploaded_parts == 3
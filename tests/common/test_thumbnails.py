@@ -0,0 +1,131 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from PIL import Image
+
+from berry_cam_server.common import thumbnails
+from berry_cam_server.common.thumbnails import ThumbnailService
+
+TEST_IMAGE = os.path.join(os.path.dirname(__file__), '..', 'api', 'test_data', 'test.jpg')
+
+
+def test_worker_pool(tmp_path):
+    """
+    Verifies that previews are created by the worker processes.
+
+    :param Path tmp_path: Temporary directory for the images.
+    """
+    service = ThumbnailService(workers=1, queue_size=2, sizes=(32, 64))
+    results = []
+
+    for index in range(4):
+        raw_image = str(tmp_path / '{}.jpg'.format(index))
+        shutil.copy(TEST_IMAGE, raw_image)
+        service.submit(raw_image, str(tmp_path), str(index), lambda sizes, error: results.append((sizes, error)))
+
+    assert service.wait(timeout=60)
+    service.shutdown()
+
+    assert len(results) == 4
+    for sizes, error in results:
+        assert error is None
+        assert set(sizes) == {32, 64, thumbnails.PREVIEW_SIZE}
+
+    for size in (32, 64, thumbnails.PREVIEW_SIZE):
+        with Image.open(thumbnails.preview_file(str(tmp_path), '0', size)) as preview:
+            assert max(preview.size) == size
+
+
+def test_concurrent_previews(tmp_path):
+    """
+    Verifies that the same previews can be created concurrently without leaving temporary files.
+
+    :param Path tmp_path: Temporary directory for the images.
+    """
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(thumbnails.create_previews, TEST_IMAGE, str(tmp_path), 'test', (64,))
+                   for _ in range(8)]
+        for future in futures:
+            assert future.result()[64] > 0
+
+    preview_dir = os.path.dirname(thumbnails.preview_file(str(tmp_path), 'test', 64))
+    assert os.listdir(preview_dir) == ['test.jpg']
+
+
+def test_failed_jobs_retried(tmp_path, monkeypatch):
+    """
+    Verifies that failing jobs are retried and the error is reported after the last retry.
+
+    :param Path tmp_path: Temporary directory for the images.
+    :param monkeypatch: The pytest monkeypatch fixture.
+    """
+    attempts = []
+
+    def failing_previews(raw_image, previews_dir, name, sizes):
+        attempts.append(raw_image)
+        raise IOError("Failed")
+
+    monkeypatch.setattr(thumbnails, 'create_previews', failing_previews)
+
+    service = ThumbnailService(workers=0, retries=2)
+    results = []
+    service.submit(str(tmp_path / 'raw.jpg'), str(tmp_path), 'raw', lambda sizes, error: results.append((sizes, error)))
+
+    assert len(attempts) == 3
+    assert results[0][0] is None
+    assert isinstance(results[0][1], IOError)
+
+
+def test_broken_pool_replaced(tmp_path):
+    """
+    Verifies that the worker pool is replaced if a worker process died and that no queue slot is lost.
+
+    :param Path tmp_path: Temporary directory for the images.
+    """
+    service = ThumbnailService(workers=1, queue_size=1, retries=0)
+    results = []
+    raw_image = str(tmp_path / 'raw.jpg')
+    shutil.copy(TEST_IMAGE, raw_image)
+
+    broken_executor = service._executor
+    service.submit(raw_image, str(tmp_path), 'first', lambda sizes, error: results.append(error))
+    assert service.wait(timeout=60)
+    for process in list(broken_executor._processes.values()):
+        process.kill()
+        process.join()
+
+    # Either the submit or the job fails with the broken pool, the following jobs use a new pool
+    service.submit(raw_image, str(tmp_path), 'second', lambda sizes, error: results.append(error))
+    assert service.wait(timeout=60)
+    service.submit(raw_image, str(tmp_path), 'third', lambda sizes, error: results.append(error))
+    assert service.wait(timeout=60)
+    service.shutdown()
+
+    assert service._executor is not broken_executor
+    assert results[0] is None
+    assert results[-1] is None
+
+
+def test_slot_released_on_submit_failure(tmp_path, monkeypatch):
+    """
+    Verifies that the queue slot of a job is released if the job can't be submitted.
+
+    :param Path tmp_path: Temporary directory for the images.
+    :param monkeypatch: The pytest monkeypatch fixture.
+    """
+    service = ThumbnailService(workers=1, queue_size=1)
+
+    def failing_run(job, callback, attempt):
+        raise RuntimeError("Failed")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(service, '_run', failing_run)
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                service.submit(str(tmp_path / 'raw.jpg'), str(tmp_path), 'raw', lambda sizes, error: None)
+
+    assert service.wait(timeout=1)
+    service.shutdown()
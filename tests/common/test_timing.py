@@ -0,0 +1,62 @@
+import logging
+import os
+from http import HTTPStatus
+
+from berry_cam_server import Config
+
+
+def server_timing(response):
+    """
+    :param Response response: The response to get the spans from.
+    :return: The durations of the spans in the Server-Timing header by span name.
+    :rtype: dict
+    """
+    spans = {}
+    for span in response.headers['Server-Timing'].split(', '):
+        name, _, duration = span.partition(';dur=')
+        spans[name] = float(duration)
+
+    return spans
+
+
+def test_upload_spans(client):
+    """
+    Verifies that the spans of an upload are sent as Server-Timing header.
+
+    :param FlaskClient client: The flask client to use for the test.
+    """
+    test_file = os.path.join(os.path.dirname(__file__), '..', 'api', 'test_data', 'test.jpg')
+
+    with client:
+        response = client.post('/api/picture/', data={'api_key': Config.get_user_config('test')['api_key'],
+                                                      'file': (open(test_file, 'rb'), 'test.jpg')})
+        assert response.status_code == HTTPStatus.OK
+
+        spans = server_timing(response)
+        assert {'auth', 'save', 'pillow', 'total'} <= set(spans)
+        assert spans['total'] >= spans['save']
+
+
+def test_viewer_spans_and_slow_requests(app, client, auth, caplog):
+    """
+    Verifies that template rendering is measured and that requests slower than the threshold are logged.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The flask client to use for the test.
+    :param AuthActions auth: The authentication object to use for login.
+    :param LogCaptureFixture caplog: Captures the log messages.
+    """
+    with client:
+        auth.login()
+        Config.invalidate_cache()
+
+        with caplog.at_level(logging.WARNING, logger='berry_cam_server.common.timing'):
+            response = client.get('/')
+        assert {'auth', 'config', 'template', 'total'} <= set(server_timing(response))
+        assert not caplog.records
+
+        app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        with caplog.at_level(logging.WARNING, logger='berry_cam_server.common.timing'):
+            client.get('/')
+        assert 'Slow request GET /' in caplog.text
+        assert 'template;dur=' in caplog.text
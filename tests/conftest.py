@@ -15,19 +15,21 @@ def app():
     :rtype: Flask
     """
     # Copy config to temporary directory, to have always a clean config even on writes (e.g. on updates of api keys)
-    with tempfile.NamedTemporaryFile() as temp_config:
+    with tempfile.TemporaryDirectory() as config_dir:
+        Config.config_file = os.path.join(config_dir, 'conf.yaml')
         with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf.yaml')) as test_config:
-            temp_config.write(test_config.read().encode('utf-8'))
-            temp_config.flush()
-
-        Config.config_file = temp_config.name
+            with open(Config.config_file, 'w') as temp_config:
+                temp_config.write(test_config.read())
 
         # Use temp dir for image uploads
         with tempfile.TemporaryDirectory() as upload_dir:
             app = create_app({
                 'TESTING': True,
                 'SECRET_KEY': 'dev',
-                'UPLOAD_DIR': upload_dir
+                'UPLOAD_DIR': upload_dir,
+                # Create previews and sprite sheets synchronously, to have them available directly after uploads
+                'THUMBNAIL_WORKERS': 0,
+                'SPRITE_SHEET_DELAY': 0
             })
             yield app
 
@@ -48,3 +48,16 @@ def test_logout(client, auth):
     with client:
         auth.logout()
         assert 'username' not in session
+
+
+def test_api_key_user(client):
+    """
+    Verifies that the owner of a valid api key is available for the api handlers.
+
+    :param FlaskClient client: The client to use for the connection.
+    """
+    with client:
+        response = client.get('/api/camera/', data={'api_key': 'test_api_key', 'name': 'Unknown_Camera'})
+
+        assert response.status_code == HTTPStatus.OK
+        assert g.api_user == 'test'
@@ -2,8 +2,6 @@ from http import HTTPStatus
 from urllib.parse import urlparse
 from datetime import datetime, timezone
 
-import yaml
-
 from berry_cam_server import Config
 
 CAMERA_NAME = 'Test-Camera'
@@ -14,12 +12,8 @@ def update_camera_timestamp(date):
 
     :param Date date: The date to store for the camera
     """
-    with open(Config.config_file, 'r') as config_file:
-        config = yaml.safe_load(config_file)
-
-    with open(Config.config_file, 'w') as config_file:
-        config["cameras"][CAMERA_NAME]["last_connection"] = int(date.timestamp())
-        yaml.safe_dump(config, config_file)
+    camera = Config.get_camera(CAMERA_NAME)
+    Config.camera_states.heartbeat(CAMERA_NAME, camera["camera_enabled"], int(date.timestamp()))
 
 def test_cameras_no_login(client):
     """
@@ -1,4 +1,6 @@
+import json
 import os
+import re
 import datetime
 from datetime import timezone
 from http import HTTPStatus
@@ -6,6 +8,11 @@ from urllib.parse import urlparse
 
 from flask import g, session
 
+from berry_cam_server import Config
+from berry_cam_server.common.layout import picture_file
+from berry_cam_server.common.storage import S3Storage
+
+from .utils.fake_s3 import FakeS3Client
 from .utils.image_generator import generate_test_images
 
 
@@ -88,6 +95,75 @@ def test_viewer_also_older(app, client, auth):
         assert b'No older pictures.' not in response.data
 
 
+def test_viewer_pagination(app, client, auth):
+    """
+    Tests that the pictures are split into pages that can be browsed forward and backward.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    generate_test_images(app.config.get('UPLOAD_DIR'),
+                         12,
+                         datetime.datetime(year=2020, month=1, day=10, hour=8, minute=10, second=5,
+                                           tzinfo=timezone.utc))
+
+    auth.login()
+
+    with client:
+        response = client.get('/?limit=5')
+        assert response.status_code == HTTPStatus.OK
+        assert response.data.count(b'class="image_link"') == 5
+        assert b'Most recent pictures' in response.data
+        assert b'Newer pictures' not in response.data
+        assert b'1578643816.jpg' in response.data
+
+        second_page = re.search(rb'href="([^"]*before=[^"]*)"', response.data).group(1).decode().replace('&amp;', '&')
+        response = client.get(second_page)
+        assert response.data.count(b'class="image_link"') == 5
+        assert b'Most recent pictures' not in response.data
+        assert b'1578643811.jpg' in response.data
+
+        third_page = re.search(rb'href="([^"]*before=[^"]*)"', response.data).group(1).decode().replace('&amp;', '&')
+        response = client.get(third_page)
+        assert response.data.count(b'class="image_link"') == 2
+        assert b'Older pictures</a>' not in response.data
+
+        newer_page = re.search(rb'href="([^"]*after=[^"]*)"', response.data).group(1).decode().replace('&amp;', '&')
+        response = client.get(newer_page)
+        assert response.data.count(b'class="image_link"') == 5
+        assert b'1578643811.jpg' in response.data
+
+        response = client.get('/?before=invalid')
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_viewer_camera_filter(app, client, auth):
+    """
+    Tests that the pictures can be filtered by camera.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    index = app.extensions['picture_index']
+    for number in range(6):
+        index.add('{}-Camera{}-000'.format(100 + number, number % 2), 100 + number, 'jpg',
+                  camera='Camera{}'.format(number % 2))
+
+    auth.login()
+
+    with client:
+        response = client.get('/')
+        assert response.data.count(b'class="image_link"') == 6
+        assert b'href="/?camera=Camera1"' in response.data
+
+        response = client.get('/?camera=Camera1&limit=2')
+        assert response.data.count(b'class="image_link"') == 2
+        assert b'Camera0-000' not in response.data
+        assert b'camera=Camera1' in re.search(rb'href="([^"]*before=[^"]*)"', response.data).group(1)
+
+
 def test_authentication_access_no_login(app, client):
     """
     Verifies that image access is prohibited if the user is not logged in.
@@ -136,6 +212,72 @@ def test_authentication_access_login(app, client, auth):
         assert response.status_code == HTTPStatus.OK
 
 
+def test_preview_variants(app, client, auth):
+    """
+    Verifies that the viewer links the preview variants and that missing variants are created on first access.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    generate_test_images(app.config.get('UPLOAD_DIR'),
+                         1,
+                         datetime.datetime(year=2020, month=1, day=10, hour=8, minute=10, second=5,
+                                           tzinfo=timezone.utc))
+    auth.login()
+
+    with client:
+        response = client.get('/')
+        assert b'/previews/480/1578643805.jpg 480w' in response.data
+        assert b'href="/previews/1280/1578643805.jpg"' in response.data
+
+        preview = picture_file(os.path.join(app.config.get('UPLOAD_DIR'), 'previews', '480'), '1578643805', 'jpg')
+        assert not os.path.exists(preview)
+
+        response = client.get('/previews/480/1578643805.jpg')
+        assert response.status_code == HTTPStatus.OK
+        assert os.path.exists(preview)
+
+        # Only configured sizes are created
+        response = client.get('/previews/200/1578643805.jpg')
+        assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_image_caching(app, client, auth):
+    """
+    Verifies that images can be cached by the browser and that conditional and range requests are supported.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    generate_test_images(app.config.get('UPLOAD_DIR'),
+                         1,
+                         datetime.datetime(year=2020, month=1, day=10, hour=8, minute=10, second=5,
+                                           tzinfo=timezone.utc))
+    auth.login()
+
+    with client:
+        for url in ('/previews/1578643805.jpg', '/large/1578643805.png'):
+            response = client.get(url)
+            assert response.status_code == HTTPStatus.OK
+            assert response.cache_control.private
+            assert not response.cache_control.public
+            assert response.cache_control.immutable
+            assert response.cache_control.max_age == 365 * 24 * 60 * 60
+
+            etag, weak = response.get_etag()
+            assert etag and not weak
+
+            response = client.get(url, headers={'If-None-Match': '"{}"'.format(etag)})
+            assert response.status_code == HTTPStatus.NOT_MODIFIED
+            assert response.cache_control.immutable
+
+            response = client.get(url, headers={'Range': 'bytes=0-9'})
+            assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+            assert len(response.data) == 10
+
+
 def test_cleanup_images(app, client, auth):
     """
     Tests that cleanup of images works fine and remvoes all images.
@@ -154,11 +296,173 @@ def test_cleanup_images(app, client, auth):
         assert os.listdir(os.path.join(app.config.get('UPLOAD_DIR'), 'raw'))
         assert os.listdir(os.path.join(app.config.get('UPLOAD_DIR'), 'previews'))
 
-        response = client.get('/?cleanup=true', follow_redirects=True)
+        response = client.get('/?cleanup=true')
+        assert response.status_code == HTTPStatus.FOUND
+
+        # The pictures are deleted in the background
+        app.extensions['retention'].start_cleanup().join(timeout=60)
 
+        response = client.get('/')
         assert response.status_code == HTTPStatus.OK
-        assert urlparse(response.location).path == b''
         assert b'No recent pictures.' in response.data
         assert b'No older pictures.' in response.data
         assert not os.listdir(os.path.join(app.config.get('UPLOAD_DIR'), 'raw'))
-        assert not os.listdir(os.path.join(app.config.get('UPLOAD_DIR'), 'previews'))
\ No newline at end of file
+        assert not os.listdir(os.path.join(app.config.get('UPLOAD_DIR'), 'previews'))
+
+def test_sharded_layout_migration(app, client, auth):
+    """
+    Verifies that pictures are served from the flat layout as well as after migrating them to the sharded layout.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    generate_test_images(app.config.get('UPLOAD_DIR'),
+                         1,
+                         datetime.datetime(year=2020, month=1, day=10, hour=8, minute=10, second=5,
+                                           tzinfo=timezone.utc))
+    auth.login()
+
+    with client:
+        assert client.get('/previews/1578643805.jpg').status_code == HTTPStatus.OK
+        assert client.get('/large/1578643805.png').status_code == HTTPStatus.OK
+
+        result = app.test_cli_runner().invoke(args=['shard-uploads'])
+        assert 'Moved 2 files.' in result.output
+        assert not os.path.exists(os.path.join(app.config.get('UPLOAD_DIR'), 'raw', '1578643805.png'))
+
+        assert client.get('/previews/1578643805.jpg').status_code == HTTPStatus.OK
+        assert client.get('/large/1578643805.png').status_code == HTTPStatus.OK
+        assert client.get('/previews/480/1578643805.jpg').status_code == HTTPStatus.OK
+
+
+def test_retention_stats(app, client, auth):
+    """
+    Verifies that the retention statistics are only shown to logged in users.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    with client:
+        response = client.get('/retention')
+        assert response.status_code == HTTPStatus.FOUND
+
+        auth.login()
+        response = client.get('/retention')
+        assert response.status_code == HTTPStatus.OK
+        assert response.json['deleted_pictures'] == 0
+        assert response.json['policies']['max_age'] is None
+
+
+def test_s3_storage(app, client, auth):
+    """
+    Verifies that uploaded pictures are stored in and served from a S3 storage.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    s3_client = FakeS3Client()
+    app.extensions['storage'] = S3Storage(s3_client, 'pictures')
+    auth.login()
+
+    with client:
+        test_file = os.path.join(os.path.dirname(__file__), 'api', 'test_data', 'test.jpg')
+        response = client.post('/api/picture/', data={
+            'api_key': Config.get_user_config('test')['api_key'],
+            'file': (open(test_file, 'rb'), 'test.jpg')
+        })
+        assert response.status_code == HTTPStatus.OK
+
+        name = app.extensions['picture_index'].latest()[0]['name']
+        raw_key = picture_file('raw', name, 'jpg')
+        with open(test_file, 'rb') as raw_image:
+            assert s3_client.objects[('pictures', raw_key)] == raw_image.read()
+        assert not os.listdir(os.path.join(app.config.get('UPLOAD_DIR'), 'raw'))
+        assert not os.listdir(os.path.join(app.config.get('UPLOAD_DIR'), 'staging'))
+
+        response = client.get('/large/{}.jpg'.format(name))
+        assert response.status_code == HTTPStatus.OK
+        assert response.mimetype == 'image/jpeg'
+        assert response.data == s3_client.objects[('pictures', raw_key)]
+
+        response = client.get('/large/{}.jpg'.format(name), headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+        # Missing preview variants are created from the stored raw image
+        del s3_client.objects[('pictures', picture_file('previews/480', name, 'jpg'))]
+        response = client.get('/previews/480/{}.jpg'.format(name))
+        assert response.status_code == HTTPStatus.OK
+        assert ('pictures', picture_file('previews/480', name, 'jpg')) in s3_client.objects
+
+        assert client.get('/previews/{}.jpg'.format(name)).status_code == HTTPStatus.OK
+        assert client.get('/large/missing.jpg').status_code == HTTPStatus.NOT_FOUND
+
+
+def test_recompressed_raw_image(app, client, auth):
+    """
+    Verifies that the viewer links and serves recompressed raw images.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    generate_test_images(app.config.get('UPLOAD_DIR'),
+                         1,
+                         datetime.datetime(year=2020, month=1, day=10, hour=8, minute=10, second=5,
+                                           tzinfo=timezone.utc))
+    app.extensions['recompression'].image_format = 'WEBP'
+    assert app.extensions['recompression'].run_once() == 1
+    auth.login()
+
+    with client:
+        response = client.get('/')
+        assert b'/large/1578643805.webp' in response.data
+
+        response = client.get('/large/1578643805.webp')
+        assert response.status_code == HTTPStatus.OK
+        assert response.mimetype == 'image/webp'
+
+        response = client.get('/recompression')
+        assert response.json['recompressed_pictures'] == 1
+        assert response.json['saved_bytes'] > 0
+
+
+def test_live_feed(app, client, auth):
+    """
+    Verifies that new pictures are streamed to logged in users as server-sent events.
+
+    :param Flask app: The flask application to test.
+    :param FlaskClient client: The client to run the test with.
+    :param AuthActions auth: The authentication object to use for login.
+    """
+    generate_test_images(app.config.get('UPLOAD_DIR'),
+                         1,
+                         datetime.datetime(year=2020, month=1, day=10, hour=8, minute=10, second=5,
+                                           tzinfo=timezone.utc))
+    picture_events = app.extensions['picture_events']
+
+    with client:
+        assert client.get('/events').status_code == HTTPStatus.FOUND
+
+        auth.login()
+        response = client.get('/')
+        assert b'http-equiv="refresh"' not in response.data
+        assert b'/events' in response.data
+
+        response = client.get('/events', buffered=False)
+        assert response.mimetype == 'text/event-stream'
+        stream = iter(response.response)
+        assert next(stream).startswith(b'retry: ')
+        assert picture_events.subscribers == 1
+
+        # Unknown pictures, e.g. deleted in the meantime, are skipped
+        picture_events.publish({'name': 'missing'})
+        picture_events.publish({'name': '1578643805'})
+        event, name, data = next(stream).decode().splitlines()[:3]
+        assert (event, name) == ('event: picture', 'id: 1578643805')
+        assert '/large/1578643805.png' in json.loads(data[len('data: '):])['html']
+
+        response.close()
+        assert picture_events.subscribers == 0
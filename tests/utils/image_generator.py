@@ -1,17 +1,21 @@
 import os
 
-from PIL import Image, ImageDraw
+from PIL import Image, ImageChops, ImageDraw
+
+from berry_cam_server.common.picture_index import PictureIndex
 
 
 def generate_test_images(target_dir, count, start_date):
     """
     Generates dummy images in a given target directory where the name starts with given start_date for filename.
+    The images are also added to the picture index of the target directory.
 
     :param Path target_dir: The directory in which the images should be generated.
     :param int count: The amount of test images to generate.
     :param datetime.datetime start_date: The date as unix timestamp to use for filename.
     """
     start_date_unix = int(start_date.timestamp())
+    pictures = []
     for count in range(count):
         print("Writing image {}".format(start_date_unix + count))
         preview = Image.new('RGB', (128, 50), color=(75, 100, 130))
@@ -24,3 +28,58 @@ def generate_test_images(target_dir, count, start_date):
         drawer.text((30, 10), 'Test image {}'.format(count), fill=(255, 255, 0))
         extension = 'jpg' if count % 2 else 'png'
         raw.save(os.path.join(target_dir, 'raw', '{}.{}'.format(start_date_unix + count, extension)))
+        pictures.append({'name': str(start_date_unix + count),
+                         'timestamp': start_date_unix + count,
+                         'raw_extension': extension})
+
+    index = PictureIndex(os.path.join(target_dir, PictureIndex.FILE_NAME))
+    index.add_many(pictures)
+    index.close()
+
+
+def generate_camera_image(target_file, width, height, image_format='JPEG'):
+    """
+    Generates an image that resembles a camera picture: smooth gradients with sensor noise.
+    Compresses similar to real pictures, unlike single colored images.
+
+    :param str target_file: The file to write the image to.
+    :param int width: The width of the image.
+    :param int height: The height of the image.
+    :param str image_format: The image format to write, e.g. JPEG or PNG.
+    """
+    gradient = Image.radial_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 8)
+    channels = [ImageChops.add(gradient, noise, offset=-64),
+                ImageChops.invert(gradient),
+                ImageChops.add(gradient.transpose(Image.FLIP_LEFT_RIGHT), noise, offset=-64)]
+
+    image = Image.merge('RGB', channels)
+    ImageDraw.Draw(image).rectangle((width // 4, height // 4, width // 2, height // 2), fill=(200, 180, 40))
+    image.save(target_file, image_format)
+
+
+def generate_archive(target_dir, count, start_date, cameras=('Camera1', 'Camera2'), batch_size=10000):
+    """
+    Generates the picture index of an upload directory with the given amount of pictures, e.g. to measure the viewer
+    with large archives. Only the index entries are written, since the viewer doesn't read the image files.
+
+    :param str target_dir: The upload directory to generate the index in.
+    :param int count: The amount of pictures to generate.
+    :param datetime.datetime start_date: The upload date of the first picture, every picture is a second later.
+    :param list cameras: The cameras the pictures are assigned to alternately.
+    :param int batch_size: The amount of pictures written in a single transaction.
+    """
+    start_date_unix = int(start_date.timestamp())
+    index = PictureIndex(os.path.join(target_dir, PictureIndex.FILE_NAME))
+    for batch_start in range(0, count, batch_size):
+        index.add_many([{'name': '{}-{}-000'.format((start_date_unix + number) * 100, cameras[number % len(cameras)]),
+                         'timestamp': start_date_unix + number,
+                         'raw_extension': 'jpg' if number % 2 else 'png',
+                         'raw_size': 1000000,
+                         'preview_size': 5000,
+                         'width': 3264,
+                         'height': 2448,
+                         'camera': cameras[number % len(cameras)],
+                         'preview_status': 'done'}
+                        for number in range(batch_start, min(batch_start + batch_size, count))])
+    index.close()